@@ -0,0 +1,350 @@
+"""Approximate nearest neighbour index of track audio features, shared by every worker
+
+An inverted file (IVF) index: k-means clusters the normalized features of feature_matrix into
+lists, and a query only compares the tracks of the ANN_NPROBE lists whose centroids are closest.
+Each built index is a directory of .npy files under ANN_INDEX_PATH, memory-mapped read only so
+gunicorn workers share one copy through the page cache:
+    centroids.npy  centroid of each list
+    offsets.npy    first row of each list, and the row count last
+    vectors.npy    normalized features, sorted by list
+    norms.npy      squared length of each vector
+    ids.npy        track id of each vector
+    delta.bin      features saved since the build, appended by any process, searched exactly
+The CURRENT file names the index in use. A rebuild is queued once the delta holds ANN_MAX_DELTA
+tracks, and can be run by hand with: python ann_index.py
+"""
+
+import os
+import time
+import fcntl
+import shutil
+import threading
+import numpy as np
+from sqlalchemy import select
+from models import db, Track
+from feature_matrix import SIMILARITY_FEATURES, normalize, feature_rows
+import feature_matrix
+import task_queue
+import metrics
+
+ANN_INDEX_PATH = os.environ.get('ANN_INDEX_PATH', 'ann_index')
+
+# Lists searched per query: more is slower with better recall
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', 24))
+
+# Tracks added since the build that queue a rebuild
+ANN_MAX_DELTA = int(os.environ.get('ANN_MAX_DELTA', 50000))
+
+# Rows compared with the centroids at once, bounding memory while building
+ASSIGN_BLOCK_SIZE = 16384
+
+DIMENSIONS = len(SIMILARITY_FEATURES)
+DELTA_RECORD = np.dtype([('id', '<i8'), ('vector', '<f4', (DIMENSIONS,))])
+
+#====================================================================================
+# Building
+#====================================================================================
+
+def assign(vectors, centroids):
+    """Return the index of the closest centroid of each vector"""
+
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    labels = np.empty(len(vectors), dtype=np.int64)
+
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        block = vectors[start:start + ASSIGN_BLOCK_SIZE]
+        labels[start:start + len(block)] = (centroid_norms - 2 * (block @ centroids.T)).argmin(axis=1)
+
+    return labels
+
+
+def kmeans(vectors, nlist, rng, iterations=10):
+    """Return nlist centroids of vectors, trained on a sample of at most 64 vectors per list"""
+
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), 64 * nlist), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for i in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        for d in range(DIMENSIONS):
+            sums = np.bincount(labels, weights=sample[:, d], minlength=nlist)
+            centroids[filled, d] = sums[filled] / counts[filled]
+
+    return centroids
+
+
+def write_index(directory, ids, vectors, nlist=None, seed=0):
+    """Write an index of track ids with their normalized vectors to a new directory"""
+
+    ids = np.asarray(ids, dtype=np.int64)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    # About sqrt(n) lists of sqrt(n) tracks each
+    nlist = max(1, min(nlist or int(np.sqrt(len(ids))), len(ids)))
+
+    if len(ids):
+        centroids = kmeans(vectors, nlist, np.random.default_rng(seed))
+        labels = assign(vectors, centroids)
+    else:
+        centroids = np.zeros((nlist, DIMENSIONS), dtype=np.float32)
+        labels = np.zeros(0, dtype=np.int64)
+
+    order = np.argsort(labels, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))])
+    vectors = vectors[order]
+
+    os.makedirs(directory)
+    np.save(os.path.join(directory, 'centroids.npy'), centroids)
+    np.save(os.path.join(directory, 'offsets.npy'), offsets.astype(np.int64))
+    np.save(os.path.join(directory, 'vectors.npy'), vectors)
+    np.save(os.path.join(directory, 'norms.npy'), (vectors * vectors).sum(axis=1))
+    np.save(os.path.join(directory, 'ids.npy'), ids[order])
+    open(os.path.join(directory, 'delta.bin'), 'wb').close()
+
+#====================================================================================
+# Searching
+#====================================================================================
+
+class AnnIndex():
+    """A built index, memory-mapped read only, with the delta of tracks added since"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+        self.centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        self.norms = np.load(os.path.join(directory, 'norms.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+        self.delta_path = os.path.join(directory, 'delta.bin')
+        self.delta_size = -1
+        self.delta = (np.zeros(0, dtype=np.int64), np.zeros((0, DIMENSIONS), dtype=np.float32))
+        self.lock = threading.Lock()
+
+
+    def read_delta(self):
+        """Return (track ids, vectors) added since the build, the last vector of each track only"""
+
+        with self.lock:
+            try:
+                size = os.path.getsize(self.delta_path)
+            except FileNotFoundError:
+                # A later build removed this index: keep the delta last read until the worker reopens
+                return self.delta
+            count = size // DELTA_RECORD.itemsize
+            if size != self.delta_size:
+                records = np.memmap(self.delta_path, dtype=DELTA_RECORD, mode='r', shape=(count,)) if count else np.zeros(0, dtype=DELTA_RECORD)
+                ids, last = np.unique(records['id'][::-1], return_index=True)
+                self.delta = (ids, np.array(records['vector'][::-1][last]))
+                self.delta_size = size
+
+            return self.delta
+
+
+    def search(self, vector, k=20, exclude=None, nprobe=ANN_NPROBE):
+        """
+        Return (track ids, distances) of about the k tracks closest to a normalized vector, closest first
+        Optional exclude is a track id left out of the results
+        """
+
+        vector = np.asarray(vector, dtype=np.float32)
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(self.centroid_norms - 2 * (self.centroids @ vector), nprobe - 1)[:nprobe]
+
+        rows = [slice(self.offsets[i], self.offsets[i + 1]) for i in probe]
+        ids = np.concatenate([self.ids[row] for row in rows] + [np.zeros(0, dtype=np.int64)])
+        vectors = np.concatenate([self.vectors[row] for row in rows] + [np.zeros((0, DIMENSIONS), dtype=np.float32)])
+        norms = np.concatenate([self.norms[row] for row in rows] + [np.zeros(0, dtype=np.float32)])
+
+        # Tracks in the delta have newer features than the build
+        delta_ids, delta_vectors = self.read_delta()
+        current = ~np.isin(ids, delta_ids)
+        ids = np.concatenate([ids[current], delta_ids])
+        vectors = np.concatenate([vectors[current], delta_vectors])
+        norms = np.concatenate([norms[current], (delta_vectors * delta_vectors).sum(axis=1)])
+
+        distances = norms - 2 * (vectors @ vector) + vector @ vector
+        if exclude is not None:
+            distances[ids == exclude] = np.inf
+
+        k = min(k, int(np.isfinite(distances).sum()))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind='stable')]
+
+        return ids[top], np.sqrt(np.maximum(distances[top], 0))
+
+
+    def __len__(self):
+        return len(self.ids) + len(self.read_delta()[0])
+
+#====================================================================================
+# Shared index
+#====================================================================================
+
+_index = None
+_index_lock = threading.Lock()
+
+def current_version():
+    """Return the name of the index in use, or None if none was built"""
+
+    try:
+        with open(os.path.join(ANN_INDEX_PATH, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def get_ann_index():
+    """Return the index in use, reopened after a rebuild, or None if none was built"""
+
+    global _index
+
+    version = current_version()
+    if version is None:
+        return None
+
+    with _index_lock:
+        directory = os.path.join(ANN_INDEX_PATH, version)
+        if _index is None or _index.directory != directory:
+            _index = AnnIndex(directory)
+            metrics.register_gauge('ann_index.tracks', _index.__len__)
+
+        return _index
+
+
+def build_ann_index(nlist=None):
+    """
+    Build an index of every track with audio features from the db and make it the index in use
+    Tracks added to the previous index while building are carried over to the new delta
+    Return the name of the new index, or None if another process is building one
+    """
+
+    path = ANN_INDEX_PATH
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, 'build.lock'), 'w') as build_lock:
+        try:
+            fcntl.flock(build_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        start = time.perf_counter()
+        previous = current_version()
+        # Features in the delta now were committed first, so the db read below includes them
+        carried_from = os.path.getsize(os.path.join(path, previous, 'delta.bin')) if previous else 0
+
+        batches = list(feature_rows())
+        ids = np.concatenate([track_ids for track_ids, features in batches] + [np.zeros(0, dtype=np.int64)])
+        vectors = np.concatenate([normalize(features) for track_ids, features in batches] + [np.zeros((0, DIMENSIONS), dtype=np.float32)])
+
+        version = f'index-{time.time_ns()}'
+        write_index(os.path.join(path, version), ids, vectors, nlist)
+
+        if previous:
+            with open(os.path.join(path, previous, 'delta.bin'), 'rb') as delta:
+                # Holding the lock, no process appends to the previous delta until CURRENT changes
+                fcntl.flock(delta, fcntl.LOCK_EX)
+                delta.seek(carried_from)
+                with open(os.path.join(path, version, 'delta.bin'), 'ab') as f:
+                    f.write(delta.read())
+                set_current_version(version)
+        else:
+            set_current_version(version)
+
+        # Workers may still be reading the previous index: only older ones are removed
+        for name in os.listdir(path):
+            if name.startswith('index-') and name not in (version, previous):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+        metrics.observe('ann_index.build', time.perf_counter() - start)
+
+    return version
+
+
+def set_current_version(version):
+    """Atomically make an index the one in use"""
+
+    with open(os.path.join(ANN_INDEX_PATH, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(ANN_INDEX_PATH, 'CURRENT.tmp'), os.path.join(ANN_INDEX_PATH, 'CURRENT'))
+
+
+def add_track_features(rows):
+    """
+    Append rows of (track id, raw features in SIMILARITY_FEATURES order) just saved to the delta
+    of the index in use, if one was built. Queue a rebuild once the delta is large
+    """
+
+    if not rows:
+        return
+
+    records = np.zeros(len(rows), dtype=DELTA_RECORD)
+    records['id'] = [row[0] for row in rows]
+    records['vector'] = normalize([row[1:] for row in rows])
+
+    while True:
+        version = current_version()
+        if version is None:
+            return
+
+        with open(os.path.join(ANN_INDEX_PATH, version, 'delta.bin'), 'ab') as delta:
+            fcntl.flock(delta, fcntl.LOCK_EX)
+            # A rebuild may have replaced the index while waiting for the lock
+            if current_version() != version:
+                continue
+            delta.write(records.tobytes())
+            count = delta.tell() // DELTA_RECORD.itemsize
+            break
+
+    metrics.incr('ann_index.added', len(records))
+    if count - len(records) < ANN_MAX_DELTA <= count:
+        task_queue.enqueue('rebuild_ann_index')
+
+
+@task_queue.task('rebuild_ann_index')
+def rebuild_ann_index():
+    """Background task: rebuild the index from the db"""
+
+    build_ann_index()
+
+
+def track_vector(track_id):
+    """Return the normalized features of a track from the db, or None if it has none"""
+
+    row = db.session.execute(select(*[getattr(Track, name) for name in SIMILARITY_FEATURES]).where(Track.id == track_id)).first()
+    if row is None or None in row:
+        return None
+
+    return normalize(row)[0]
+
+
+def similar_tracks(track_id, k=20):
+    """
+    Return (track ids, distances) of the k tracks whose features are closest to a track's, or None if it has none
+    Uses the shared index if one was built, else this process's exact feature matrix
+    """
+
+    index = get_ann_index()
+    if index is None:
+        return feature_matrix.similar_tracks(track_id, k)
+
+    start = time.perf_counter()
+    vector = track_vector(track_id)
+    if vector is None:
+        return None
+
+    result = index.search(vector, k, exclude=track_id)
+    metrics.observe('ann_index.query', time.perf_counter() - start)
+
+    return result
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print('Built', build_ann_index())
@@ -1,7 +1,8 @@
 """Tuttitracks: Spotify track information gatherer and playlist editor"""
 
 import os
-from flask import Flask, render_template, request, redirect, flash, session, g, jsonify
+import math
+from flask import Flask, render_template, request, redirect, flash, session, g, jsonify, Response, stream_with_context
 from sqlalchemy import exc
 from sqlalchemy.exc import IntegrityError
 # from flask_debugtoolbar import DebugToolbarExtension
@@ -13,13 +14,26 @@ BASE_URL = 'https://api.spotify.com/v1'
 # Session key assigned to user object if user is logged in
 CURR_USER_KEY = 'curr_user'
 
-from models import db, connect_db, User, Track, Playlist
+from models import db, connect_db, User, Track, Playlist, LibraryImport
 from forms import SignupForm, LoginForm, SearchTracksForm, ChangePasswordForm
 from auth import get_spotify_user_code, get_bearer_token
 from middleware import requires_signed_in
-from db_api_methods import create_playlist, get_playlist_tracks, get_playlist_track_ids, append_playlist_tracks, insert_playlist_track, move_playlist_track, delete_playlist_track, get_playlist_item_info
+from db_api_methods import create_playlist, get_playlist_tracks, get_playlist_track_page, append_playlist_tracks, insert_playlist_track, move_playlist_track, delete_playlist_track, get_playlist_item_info
 from spotify_playlist import get_spotify_playlists, create_spotify_playlist, add_tracks_to_spotify_playlist, replace_spotify_playlist_items, update_spotify_playlist_details, delete_tracks_from_spotify_playlist
-from spotify_query_parse import get_spotify_liked_tracks, search_spotify, get_spotify_top_tracks
+from playlist_sync import sync_playlist_to_spotify, replace_playlist
+from playlist_order import order_playlist, camelot_code
+from library_import import start_library_import
+from playlist_mirror import mirror_spotify_playlists
+from catalog_search import search_catalog, search_local_catalog
+from track_query import query_tracks
+from ann_index import similar_tracks
+from catalog_export import check_format, export_tracks, export_playlists
+from spotify_query_parse import get_spotify_liked_tracks_page, search_spotify, get_spotify_top_tracks_page, ensure_fresh_token
+from cursors import encode_cursor, decode_cursor, encode_spotify_cursor, decode_spotify_cursor
+from spotify_client import RateLimited
+import metrics
+import task_queue
+import cache
 
 load_dotenv()
 
@@ -31,6 +45,14 @@ BASE_URL = 'https://api.spotify.com/v1'
 
 REDIRECT_URI = os.environ.get('REDIRECT_URI')
 
+# Most rows in a page of a local list
+PAGE_MAX_LIMIT = 500
+
+# Tracks in a page of Spotify saved or top tracks, shared with the pages' scripts
+TRACKS_PAGE_LIMIT = 25
+# Most items Spotify returns in a page of saved or top tracks
+SPOTIFY_MAX_LIMIT = 50
+
 
 
 app = Flask(__name__)
@@ -43,6 +65,7 @@ app.app_context().push()
 
 connect_db(app)
 db.create_all()
+task_queue.init_app(app)
 
 #====================================================================================
 # User signup/login/logout
@@ -277,8 +300,15 @@ def search():
         if not artist and not track and not album and not genre and not year:
             year = 2021
 
-        query_string = create_query(artist, track, album, genre, year)
-        tracks = search_spotify(query_string, QUERY_TYPE, QUERY_LIMIT, OFFSET)
+        # Answer from the local catalog when it holds enough matches. Genres are only known to Spotify
+        tracks = None
+        if not genre:
+            local_query = ' '.join(field for field in [artist, track, album] if field)
+            tracks = search_local_catalog(local_query, year, QUERY_LIMIT, OFFSET)
+
+        if tracks is None:
+            query_string = create_query(artist, track, album, genre, year)
+            tracks = search_spotify(query_string, QUERY_TYPE, QUERY_LIMIT, OFFSET)
 
         # Display nothing rather than None in query results
         if not query['year']:
@@ -295,12 +325,12 @@ def search():
 def get_liked_tracks():
     """Query Spotify for user's liked tracks"""
 
-    LIMIT = 25
     OFFSET = 0
 
-    tracks = get_spotify_liked_tracks(limit=LIMIT, offset=OFFSET)
+    page = get_spotify_liked_tracks_page(limit=TRACKS_PAGE_LIMIT, offset=OFFSET)
+    next_cursor = encode_spotify_cursor('liked_tracks', page['next'])
 
-    return render_template("liked_tracks.html", tracks=tracks)
+    return render_template("liked_tracks.html", tracks=page['tracks'], next_cursor=next_cursor, limit=TRACKS_PAGE_LIMIT)
 
 
 @app.get('/top')
@@ -308,15 +338,15 @@ def get_liked_tracks():
 def get_top_tracks():
     """Query Spotify for user's top tracks"""
 
-    LIMIT = 20
     OFFSET = 0
     # time_range is the time frame top tracks are calculated:
     # long_term=several years including new data as available, medium_term=approx 6 months (Spotify default), short_term=approx 4 weeks
     TIME_RANGE = 'medium_term'
 
-    tracks = get_spotify_top_tracks(limit=LIMIT, offset=OFFSET, time_range=TIME_RANGE)
+    page = get_spotify_top_tracks_page(limit=TRACKS_PAGE_LIMIT, offset=OFFSET, time_range=TIME_RANGE)
+    next_cursor = encode_spotify_cursor('top_tracks', page['next'])
 
-    return render_template("top_tracks.html", tracks=tracks)
+    return render_template("top_tracks.html", tracks=page['tracks'], next_cursor=next_cursor, limit=TRACKS_PAGE_LIMIT)
 
 
 @app.get('/playlists')
@@ -332,9 +362,11 @@ def playlist_management():
     OFFSET = 0
     spot_playlists = get_spotify_playlists(LIMIT, OFFSET)
     total_spot_playlists = spot_playlists['total']
-    parsed_playlists = get_playlist_item_info(spot_playlists['items'])
+    local_ids = mirror_spotify_playlists(g.user.username, spot_playlists['items'], g.headers)
+    parsed_playlists = get_playlist_item_info(spot_playlists['items'], local_ids)
+    next_cursor = encode_spotify_cursor('spotify_playlists', spot_playlists['next'])
 
-    return render_template("playlists.html", playlists=playlists, spot_playlists=parsed_playlists, total_spot_playlists=total_spot_playlists)
+    return render_template("playlists.html", playlists=playlists, spot_playlists=parsed_playlists, total_spot_playlists=total_spot_playlists, next_cursor=next_cursor)
 
 #====================================================================================
 # Database api routes
@@ -368,17 +400,25 @@ def convert_ms(m_seconds):
 def get_saved_tracks_route():
     """Get Spotify saved tracks for current user"""
 
-    offset = request.args.get('offset', 0)
-
     try:
-        tracks = get_spotify_liked_tracks(offset=offset, limit=25)
+        # A cursor wraps Spotify's url of the next page
+        args = decode_spotify_cursor('liked_tracks', request.args.get('cursor'))
+        limit = args.get('limit', max(1, min(request.args.get('limit', TRACKS_PAGE_LIMIT, type=int), SPOTIFY_MAX_LIMIT)))
+        offset = args.get('offset', 0)
+
+        page = get_spotify_liked_tracks_page(limit=limit, offset=offset)
         
         return jsonify({
             'success': True,
-            'track_dicts': tracks,
-            'tracks': tracks
+            'track_dicts': page['tracks'],
+            'tracks': page['tracks'],
+            'next': encode_spotify_cursor('liked_tracks', page['next'])
         }), 200
 
+    except RateLimited:
+        # Answered with a 429 by spotify_rate_limited
+        raise
+
     except:
         
         return jsonify({
@@ -387,24 +427,73 @@ def get_saved_tracks_route():
         }), 404
 
 
+@app.post('/api/me/library/import')
+@requires_signed_in
+def start_library_import_route():
+    """Import all of the current user's Spotify saved tracks in the background
+        An import that stopped part way resumes from its last checkpoint
+    """
+
+    try:
+        ensure_fresh_token()
+        library_import = start_library_import(g.user.username, g.headers)
+
+        return jsonify({
+            'success': True,
+            'import': library_import.serialize()
+        }), 200
+
+    except RateLimited:
+        raise
+
+    except:
+        return jsonify({
+            'success': False,
+            'message': "Unable to start library import"
+        }), 404
+
+
+@app.get('/api/me/library/import')
+@requires_signed_in
+def get_library_import_route():
+    """Get the progress of the current user's library import"""
+
+    library_import = db.session.get(LibraryImport, g.user.username)
+
+    if not library_import:
+        return jsonify({
+            'success': False,
+            'message': "No library import found"
+        }), 404
+
+    return jsonify({
+        'success': True,
+        'import': library_import.serialize()
+    }), 200
+
+
 @app.get('/api/me/top/tracks')
 def get_top_tracks_route():
     """Get Spotify top tracks for current user"""
 
-    offset = request.args.get('offset', 0)
-    limit = request.args.get('offset', 20)
-    time_range = request.args.get('time_range', 'medium-term')
-
-    get_spotify_top_tracks(limit=25, offset=0, time_range='medium_term')
-
     try:
-        tracks = get_spotify_top_tracks(limit=limit, offset=offset, time_range=time_range)
+        # A cursor wraps Spotify's url of the next page
+        args = decode_spotify_cursor('top_tracks', request.args.get('cursor'))
+        limit = args.get('limit', max(1, min(request.args.get('limit', TRACKS_PAGE_LIMIT, type=int), SPOTIFY_MAX_LIMIT)))
+        offset = args.get('offset', 0)
+        time_range = args.get('time_range', request.args.get('time_range', 'medium_term'))
+
+        page = get_spotify_top_tracks_page(limit=limit, offset=offset, time_range=time_range)
         
         return jsonify({
             'success': True,
-            'tracks': tracks
+            'tracks': page['tracks'],
+            'next': encode_spotify_cursor('top_tracks', page['next'])
         }), 200
 
+    except RateLimited:
+        raise
+
     except:
         
         return jsonify({
@@ -412,6 +501,70 @@ def get_top_tracks_route():
             'message': "Unable to fetch Spotify top tracks"
         }), 404
 
+@app.get('/api/tracks/search')
+def search_catalog_route():
+    """Search tracks in the local catalog, best matches first
+        total counts every match on the first page only, and is null on pages read with a cursor
+    """
+
+    query = request.args.get('q', '')
+    year = request.args.get('year')
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    try:
+        after = decode_cursor('track_search', request.args.get('cursor'))
+        tracks, total, next_after = search_catalog(query, year, limit, 0 if after else offset, after)
+
+        return jsonify({
+            'success': True,
+            'tracks': tracks,
+            'total': total,
+            'next': encode_cursor('track_search', next_after)
+        }), 200
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+    except:
+        return jsonify({
+            'success': False,
+            'message': "Unable to search tracks"
+        }), 404
+
+
+@app.get('/api/tracks/query')
+def query_tracks_route():
+    """Get a page of tracks in the local catalog within ranges of audio features"""
+
+    limit = request.args.get('limit', 20, type=int)
+
+    try:
+        after = decode_cursor('track_query', request.args.get('cursor'))
+        tracks, next_after = query_tracks(request.args, limit, after)
+
+        return jsonify({
+            'success': True,
+            'tracks': tracks,
+            'next': encode_cursor('track_query', next_after)
+        }), 200
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+    except:
+        return jsonify({
+            'success': False,
+            'message': "Unable to query tracks"
+        }), 404
+
+
 @app.get('/api/tracks/<int:track_id>')  
 def get_audio_features_route(track_id):
     """Get the audio features of a track from database"""
@@ -450,6 +603,39 @@ def get_audio_features_route(track_id):
         }), 404
 
 
+@app.get('/api/tracks/<int:track_id>/similar')
+def get_similar_tracks_route(track_id):
+    """Get the tracks whose audio features are closest to a track's, closest first"""
+
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+    try:
+        result = similar_tracks(track_id, limit)
+        if result is None:
+            return jsonify({
+                'success': False,
+                'message': "Track has no audio features"
+            }), 404
+
+        ids, distances = result
+        names = dict(db.session.query(Track.id, Track.name).filter(Track.id.in_(ids.tolist())).all())
+
+        return jsonify({
+            'success': True,
+            'tracks': [{
+                'id': id,
+                'name': names[id],
+                'distance': round(distance, 4)
+            } for id, distance in zip(ids.tolist(), distances.tolist()) if id in names]
+        }), 200
+
+    except:
+        return jsonify({
+            'success': False,
+            'message': "Unable to find similar tracks"
+        }), 404
+
+
 @app.post('/api/users/<username>/playlists')
 def create_playlist_route(username):
     """Create a playlist locally"""
@@ -516,15 +702,31 @@ def update_playlist_details_route(playlist_id):
 
 @app.get('/api/me/playlists')
 def get_my_playlists():
-    """Get current users playlists: return list of playlist objects"""
+    """Get a page of the current user's playlists: return list of playlist objects"""
+
+    limit = max(1, min(request.args.get('limit', 20, type=int), PAGE_MAX_LIMIT))
 
     try:
-        playlists = Playlist.query.filter(Playlist.username==g.user.username)
+        after = decode_cursor('my_playlists', request.args.get('cursor'))
+        query = Playlist.query.filter(Playlist.username==g.user.username)
+        if after is not None:
+            query = query.filter(Playlist.id > after)
+
+        # One extra row tells if there is a next page
+        playlists = query.order_by(Playlist.id).limit(limit + 1).all()
+        next_after = playlists[limit - 1].id if len(playlists) > limit else None
         
         return jsonify({
             'success': True,
-            'playlists': playlists
+            'playlists': [playlist.serialize() for playlist in playlists[:limit]],
+            'next': encode_cursor('my_playlists', next_after)
         }), 200
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     
     except:
         print(g.user.username)
@@ -554,17 +756,27 @@ def get_playlist(playlist_id):
 
 @app.get('/api/playlists/<int:playlist_id>/tracks')
 def get_playlist_track_ids_route(playlist_id):
-    """Get playlist tracks: return list of spotify track ids"""
+    """Get a page of playlist tracks: return list of spotify track ids in playlist order"""
+
+    limit = max(1, min(request.args.get('limit', 100, type=int), PAGE_MAX_LIMIT))
 
-    print('get_playlist_track_ids')
     try:
-        tracks = get_playlist_track_ids(playlist_id)
-        print(tracks)
+        # Cursors of one playlist can't be used to page through another
+        name = f'playlist_tracks/{playlist_id}'
+        tracks, next_after = get_playlist_track_page(playlist_id, limit, decode_cursor(name, request.args.get('cursor')))
+
         return jsonify({
             'success': True,
-            'tracks': tracks
+            'tracks': tracks,
+            'next': encode_cursor(name, next_after)
         }), 200
 
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
     except:
         return jsonify({
             'success': False,
@@ -621,12 +833,15 @@ def update_playlist_tracks(playlist_id):
 
     try:
         playlist = Playlist.query.get_or_404(playlist_id)
-        replace_spotify_playlist_items(playlist.spotify_playlist_id, tracks)
+        replace_playlist(playlist, tracks)
         return jsonify({
             'success': True,
             'playlist': playlist_id
         }), 200
 
+    except RateLimited:
+        raise
+
     except:
         return jsonify({
             'success': False,
@@ -634,6 +849,32 @@ def update_playlist_tracks(playlist_id):
         }), 404    
 
 
+@app.post('/api/playlists/<int:playlist_id>/tracks/order')
+def order_playlist_route(playlist_id):
+    """Reorder a playlist's tracks for smooth key and tempo transitions"""
+
+    try:
+        Playlist.query.get_or_404(playlist_id)
+        rows = order_playlist(playlist_id)
+
+        return jsonify({
+            'success': True,
+            'playlist': playlist_id,
+            'tracks': [{
+                'id': row.track_id,
+                'name': row.name,
+                'key': camelot_code(row.key, row.mode),
+                'tempo': row.tempo
+            } for row in rows]
+        }), 200
+
+    except:
+        return jsonify({
+            'success': False,
+            'message': "Unable to order playlist"
+        }), 404
+
+
 @app.patch('/api/playlists/<int:playlist_id>/tracks')
 def delete_playlist_track_route(playlist_id):
     """Delete a track from a playlist in database"""
@@ -660,7 +901,9 @@ def delete_playlist_route(playlist_id):
 
     try:
         playlist = Playlist.query.get_or_404(playlist_id)
+        username = playlist.username
         Playlist.delete(playlist)
+        cache.invalidate(cache.user_namespace(username))
 
         return jsonify({
             'success': True,
@@ -676,28 +919,21 @@ def delete_playlist_route(playlist_id):
 @app.post('/api/spotify/<int:id>/playlists')
 def update_playlist_to_spotify(id):
     """Create new playlist on Spotify from local playlist
-        If playlist already exists, replace existing tracks on Spotify with current tracks from database
+        If playlist already exists, send only the changes since the last sync to Spotify
     """
 
     try:
-        playlist =  Playlist.query.get_or_404(id)
-        tracks = get_playlist_tracks(id)
-
-        # Create Spotify playlist and add tracks
-        if not playlist.spotify_playlist_id:
-            print('New Playlist')
-            new_playlist = create_spotify_playlist(id)
-            replace_spotify_playlist_items(new_playlist.spotify_playlist_id, tracks)
-        else:
-            # Playlist alread exists on Spotify, update tracks only
-            print('Playlist exists')
-            replace_spotify_playlist_items(playlist.spotify_playlist_id, tracks)
+        sync_playlist_to_spotify(id)
+        playlist = Playlist.query.get_or_404(id)
 
         return jsonify({
             'success': True,
             'playlist': playlist.serialize()
         }), 200
 
+    except RateLimited:
+        raise
+
     except:
         return jsonify({
             'success': False,
@@ -709,20 +945,27 @@ def update_playlist_to_spotify(id):
 def get_spotify_playlists_route():
     """Get current user's spotify playlists"""
 
-    limit = request.args.get('limit', 20)
-    offset = request.args.get('offset', 0)
-
     try:
+        # A cursor wraps Spotify's url of the next page
+        args = decode_spotify_cursor('spotify_playlists', request.args.get('cursor'))
+        limit = args.get('limit', request.args.get('limit', 20))
+        offset = args.get('offset', 0)
+
         playlists = get_spotify_playlists(limit, offset)
         total_spot_playlists = playlists['total']
-        parsed_playlists = get_playlist_item_info(playlists['items'])
+        local_ids = mirror_spotify_playlists(g.user.username, playlists['items'], g.headers)
+        parsed_playlists = get_playlist_item_info(playlists['items'], local_ids)
 
         return jsonify({
             "success": True,
             "spot_playlists": parsed_playlists,
-            "total_spot_playlists": total_spot_playlists
+            "total_spot_playlists": total_spot_playlists,
+            "next": encode_spotify_cursor('spotify_playlists', playlists['next'])
         }), 200
 
+    except RateLimited:
+        raise
+
     except:
         return jsonify({
             "success": False,
@@ -730,6 +973,54 @@ def get_spotify_playlists_route():
         }), 404
 
 
+@app.get('/api/export/tracks')
+@requires_signed_in
+def export_tracks_route():
+    """Stream the tracks in the current user's playlists with album, artists and audio features
+        format=ndjson (default) or csv
+    """
+
+    return export_response('tracks', export_tracks)
+
+
+@app.get('/api/export/playlists')
+@requires_signed_in
+def export_playlists_route():
+    """Stream the current user's playlists with their ordered tracks
+        format=ndjson (default) or csv
+    """
+
+    return export_response('playlists', export_playlists)
+
+
+def export_response(name, export):
+    """Return a streaming response of export(username, format) as a file download"""
+
+    format = request.args.get('format', 'ndjson')
+
+    try:
+        content_type = check_format(format)
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+    return Response(stream_with_context(export(g.user.username, format)), content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename={name}.{format}'})
+
+
+@app.get('/api/metrics')
+def get_metrics_route():
+    """Get this worker's metrics: Spotify requests, rate limiting and time spent throttled"""
+
+    return jsonify({
+        "success": True,
+        "metrics": metrics.snapshot()
+    }), 200
+
+
 #====================================================================================
 # error handlers
 #====================================================================================
@@ -753,6 +1044,22 @@ def resource_not_found(error):
 def resource_not_found(error):
     return render_template('/errors/500.html'), 500
 
+
+@app.errorhandler(RateLimited)
+def spotify_rate_limited(error):
+    """Spotify still answered 429 after every retry: ask the client to try again after Retry-After"""
+
+    retry_after = {'Retry-After': str(math.ceil(error.retry_after))}
+
+    if request.path.startswith('/api/'):
+        return jsonify({
+            'success': False,
+            'message': "Spotify is busy. Please try again later."
+        }), 429, retry_after
+
+    flash("Spotify is busy. Please try again later.", 'danger')
+    return redirect('/'), 302, retry_after
+
 #====================================================================================
 # Turn off all caching in Flask -- DEV only: comment out when in production
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
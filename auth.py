@@ -1,8 +1,11 @@
 """Authentication tools for Tuttitracks"""
 
 import os
+import time
 import base64
+import threading
 import requests
+import spotify_client
 from flask import redirect, session, g
 from models import User
 from dotenv import load_dotenv
@@ -20,6 +23,8 @@ AUTH_URL = 'https://accounts.spotify.com/authorize'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
 
 REDIRECT_URI = os.environ.get('REDIRECT_URI')
+# Refresh bearer tokens this many seconds before they expire
+REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 60))
 SCOPE = "user-library-read playlist-read-private playlist-modify-private playlist-modify-public user-top-read"
 
 # Create headers for get_bearer_token and refresh_token
@@ -38,14 +43,16 @@ HEADERS = {
 #====================================================================================
 
 def get_spotify_user_code():
-    """Get url containing spotify user coded needed to request bearer token"""
+    """Get url containing spotify user coded needed to request bearer token
+    The url is only built here: the user's browser is redirected to it
+    """
 
-    r = requests.get(AUTH_URL, {
+    r = requests.Request('GET', AUTH_URL, params={
         'client_id': CLIENT_ID,
         'response_type': 'code',
         'redirect_uri': REDIRECT_URI,
         "scope": SCOPE
-    })
+    }).prepare()
 
     return r.url
 
@@ -57,7 +64,7 @@ def get_user_id(token):
     'Authorization': f'Bearer {token}'
     }
 
-    r = requests.get(BASE_URL + '/me', headers=headers)
+    r = spotify_client.get(BASE_URL + '/me', headers=headers)
 
     g.user.spotify_user_id = r.json()['id']
     g.user.spotify_display_name = r.json()['display_name']
@@ -76,7 +83,7 @@ def get_bearer_token(code):
     }
 
     try:
-        r = requests.post(TOKEN_URL, headers=HEADERS, data=data)
+        r = spotify_client.post(TOKEN_URL, headers=HEADERS, data=data)
     except:
         return {
             "error": "Authorization Error",
@@ -96,6 +103,7 @@ def get_bearer_token(code):
             "token_type": r.json()['token_type'],
             "scope": r.json()['scope'],
             "expires_in": r.json()['expires_in'],
+            "expires_at": time.time() + r.json()['expires_in'],
             "refresh_token": r.json()['refresh_token'],
             }
 
@@ -113,7 +121,7 @@ def refresh_token (refresh_token):
     }
 
     try:
-        r = requests.post(TOKEN_URL, headers=HEADERS, data=data)
+        r = spotify_client.post(TOKEN_URL, headers=HEADERS, data=data)
     except:
         return {
             "error": "Authorization Error",
@@ -130,10 +138,102 @@ def refresh_token (refresh_token):
             "access_token": r.json()['access_token'],
             "token_type": r.json()['token_type'],
             "scope": r.json()['scope'],
-            "expires_in": r.json()['expires_in']
+            "expires_in": r.json()['expires_in'],
+            "expires_at": time.time() + r.json()['expires_in']
             }
+        # Spotify may issue a new refresh token
+        if 'refresh_token' in r.json():
+            session['refresh'] = r.json()['refresh_token']
 
         new_bearer = r.json()['access_token']
         return {
             'Authorization': f'Bearer {new_bearer}'
+        }
+
+#====================================================================================
+# Token refresh helpers
+#====================================================================================
+
+# One lock per user so concurrent refreshes in this process collapse into a single call to Spotify
+# Each entry is [lock, number of requests holding or waiting on it], dropped when that reaches 0
+# Workers don't share locks: each gunicorn process may refresh a user's token once
+_refresh_locks = {}
+_refresh_locks_guard = threading.Lock()
+# Latest refreshed auth per user, reused by requests that waited on the lock, dropped once expired
+_refreshed = {}
+# App token from the client credentials flow, shared by background tasks
+_client_auth = {}
+_client_auth_lock = threading.Lock()
+
+def token_expiring(auth):
+    """Return True if the bearer token in auth expires within REFRESH_MARGIN seconds
+    Tokens saved without an expiry time are refreshed when Spotify returns a 401
+    """
+
+    if not auth or 'expires_at' not in auth:
+        return False
+
+    return auth['expires_at'] - time.time() < REFRESH_MARGIN
+
+
+def evict_refreshed():
+    """Drop refreshed tokens that have expired. Call holding _refresh_locks_guard"""
+
+    now = time.time()
+    for key in [key for key, latest in _refreshed.items() if latest['auth'].get('expires_at', 0) <= now]:
+        del _refreshed[key]
+
+
+def refresh_user_token(username, refresh, stale_token=None):
+    """Refresh a user's bearer token, at most once at a time per user in this process
+    stale_token is the token the caller holds. If another request already replaced it with
+    a token that is still fresh, that token is reused without calling Spotify
+    Return header with the bearer token
+    """
+
+    key = username or refresh
+    with _refresh_locks_guard:
+        evict_refreshed()
+        entry = _refresh_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            latest = _refreshed.get(key)
+            if latest and latest['auth']['access_token'] != stale_token and not token_expiring(latest['auth']):
+                session['auth'] = latest['auth']
+                return {
+                    'Authorization': f"Bearer {latest['auth']['access_token']}"
+                }
+
+            headers = refresh_token(refresh)
+            if 'error' not in headers:
+                with _refresh_locks_guard:
+                    _refreshed[key] = {"auth": session['auth']}
+
+            return headers
+
+    finally:
+        with _refresh_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _refresh_locks[key]
+
+
+def get_client_headers():
+    """Return header with an app bearer token from the client credentials flow
+    Used by background tasks that run outside a user's session (audio features, search)
+    The token is cached until shortly before it expires
+    """
+
+    with _client_auth_lock:
+        if not _client_auth or token_expiring(_client_auth):
+            r = spotify_client.post(TOKEN_URL, headers=HEADERS, data={"grant_type": "client_credentials"})
+            r.raise_for_status()
+
+            _client_auth['access_token'] = r.json()['access_token']
+            _client_auth['expires_at'] = time.time() + r.json()['expires_in']
+
+        return {
+            'Authorization': f"Bearer {_client_auth['access_token']}"
         }
\ No newline at end of file
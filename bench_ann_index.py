@@ -0,0 +1,67 @@
+"""Benchmark: recall and latency of the approximate index against exact search
+
+Builds indexes of random tracks in a temporary directory, the db is not used:
+python bench_ann_index.py
+"""
+
+import time
+import tempfile
+import os
+import numpy as np
+
+from app import app
+from feature_matrix import FeatureMatrix, SIMILARITY_FEATURES, normalize
+from ann_index import write_index, AnnIndex
+
+CATALOG_SIZES = [100000, 1000000]
+NPROBES = [8, 24, 64]
+QUERIES = 200
+K = 20
+
+
+def random_features(rng, count):
+    """Return count rows of raw features, grouped around random styles like real tracks"""
+
+    low = np.array([low for low, high in SIMILARITY_FEATURES.values()])
+    high = np.array([high for low, high in SIMILARITY_FEATURES.values()])
+    styles = rng.random((20, len(SIMILARITY_FEATURES)))
+    points = styles[rng.integers(0, len(styles), count)] + rng.normal(0, 0.25, (count, len(SIMILARITY_FEATURES)))
+    return low + np.clip(points, 0, 1) * (high - low)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>8} {'search':<10} {'build s':>8} {'recall':>7} {'query ms':>9} {'max ms':>8}")
+
+    for size in CATALOG_SIZES:
+        features = random_features(rng, size)
+        track_ids = np.arange(1, size + 1)
+        queries = rng.integers(1, size + 1, QUERIES)
+
+        matrix = FeatureMatrix()
+        matrix.upsert(track_ids, features)
+
+        exact = {}
+        times = []
+        for track_id in queries:
+            start = time.perf_counter()
+            exact[track_id] = set(matrix.nearest(matrix.vector(track_id), k=K, exclude=track_id)[0].tolist())
+            times.append((time.perf_counter() - start) * 1000)
+        print(f"{size:>8} {'exact':<10} {'':>8} {1:>7.3f} {np.mean(times):>9.2f} {max(times):>8.2f}")
+
+        with tempfile.TemporaryDirectory() as path:
+            start = time.perf_counter()
+            write_index(os.path.join(path, 'index'), track_ids, normalize(features))
+            build = time.perf_counter() - start
+            index = AnnIndex(os.path.join(path, 'index'))
+
+            for nprobe in NPROBES:
+                found = 0
+                times = []
+                for track_id in queries:
+                    start = time.perf_counter()
+                    ids, distances = index.search(matrix.vector(track_id), k=K, exclude=track_id, nprobe=nprobe)
+                    times.append((time.perf_counter() - start) * 1000)
+                    found += len(exact[track_id] & set(ids.tolist()))
+
+                print(f"{size:>8} {f'nprobe {nprobe}':<10} {build:>8.2f} {found / (K * QUERIES):>7.3f} {np.mean(times):>9.2f} {max(times):>8.2f}")
@@ -0,0 +1,45 @@
+"""Benchmark: similar track queries over an in-memory feature matrix of random tracks
+
+Only builds the matrix in memory, the db is not used:
+python bench_feature_matrix.py
+"""
+
+import time
+import numpy as np
+
+from app import app
+from feature_matrix import FeatureMatrix, SIMILARITY_FEATURES
+
+CATALOG_SIZES = [10000, 100000, 1000000]
+QUERIES = 100
+
+
+def random_features(rng, count):
+    """Return count rows of raw features spread over their ranges"""
+
+    low = np.array([low for low, high in SIMILARITY_FEATURES.values()])
+    high = np.array([high for low, high in SIMILARITY_FEATURES.values()])
+    return low + rng.random((count, len(SIMILARITY_FEATURES))) * (high - low)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>8} {'build s':>8} {'query ms':>9} {'max ms':>8}")
+
+    for size in CATALOG_SIZES:
+        features = random_features(rng, size)
+
+        start = time.perf_counter()
+        matrix = FeatureMatrix()
+        # Ingested in batches, as get_audio_features saves them
+        for i in range(0, size, 10000):
+            matrix.upsert(np.arange(i, min(i + 10000, size)) + 1, features[i:i + 10000])
+        build = time.perf_counter() - start
+
+        times = []
+        for track_id in rng.integers(1, size + 1, QUERIES):
+            start = time.perf_counter()
+            matrix.nearest(matrix.vector(track_id), k=20, exclude=track_id)
+            times.append((time.perf_counter() - start) * 1000)
+
+        print(f"{size:>8} {build:>8.2f} {np.mean(times):>9.2f} {max(times):>8.2f}")
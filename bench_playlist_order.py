@@ -0,0 +1,80 @@
+"""Benchmark: ordering a local playlist for smooth transitions, by playlist size
+
+Drops and recreates all tables, so it only runs against the test database:
+ENV=test python bench_playlist_order.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from sqlalchemy.dialects.postgresql import insert
+
+if os.getenv('ENV') != 'test':
+    sys.exit('Set ENV=test: this benchmark drops all tables in the database')
+
+from app import app
+from models import db, User, Track, Album, Playlist, PlaylistTrack
+from playlist_order import order_playlist, transition_costs, path_cost
+
+PLAYLIST_SIZES = [100, 500, 2000]
+
+
+def seed(size, rng):
+    """Create a user, album, tracks with random keys and tempos and one playlist of them. Return the playlist id"""
+
+    db.session.add(User(username='benchuser', password='benchpassword', email='bench@test.com'))
+    album = Album(spotify_album_id='benchalbum', name='benchalbum', image='http://www.test.com')
+    db.session.add(album)
+    db.session.flush()
+
+    track_ids = db.session.execute(insert(Track).values([{
+        "spotify_track_id": f"benchtrack{i}",
+        "name": f"benchtrack{i}",
+        "spotify_track_uri": f"spotify:track:benchtrack{i}",
+        "release_year": 2000,
+        "duration_ms": 1000,
+        "album_id": album.id,
+        "key": int(rng.integers(0, 12)),
+        "mode": int(rng.integers(0, 2)),
+        "tempo": float(rng.uniform(70, 170))
+    } for i in range(size)]).returning(Track.id)).scalars().all()
+
+    playlist = Playlist(username='benchuser', name='benchplaylist')
+    db.session.add(playlist)
+    db.session.flush()
+
+    db.session.execute(insert(PlaylistTrack).values([{
+        "playlist_id": playlist.id,
+        "track_id": track_id,
+        "index": i
+    } for i, track_id in enumerate(track_ids)]))
+    db.session.commit()
+
+    return playlist.id
+
+
+def cost(rows):
+    """Total transition cost of rows in their order"""
+
+    costs = transition_costs([row.key for row in rows], [row.mode for row in rows], [row.tempo for row in rows])
+    return path_cost(costs, range(len(rows)))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>8} {'cost before':>12} {'cost after':>12} {'ms':>10}")
+
+    for size in PLAYLIST_SIZES:
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        playlist_id = seed(size, rng)
+
+        before = db.session.query(Track.key, Track.mode, Track.tempo).join(PlaylistTrack).order_by(PlaylistTrack.index).all()
+
+        start = time.perf_counter()
+        rows = order_playlist(playlist_id)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        print(f"{size:>8} {cost(before):>12.1f} {cost(rows):>12.1f} {elapsed:>10.1f}")
@@ -0,0 +1,83 @@
+"""Benchmark: queries used to read a local playlist's tracks, by playlist size
+
+Drops and recreates all tables, so it only runs against the test database:
+ENV=test python bench_playlist_queries.py
+"""
+
+import os
+import sys
+import time
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+
+if os.getenv('ENV') != 'test':
+    sys.exit('Set ENV=test: this benchmark drops all tables in the database')
+
+from app import app
+from models import db, User, Track, Album, Playlist, PlaylistTrack
+from db_api_methods import get_playlist_tracks, get_playlist_track_ids
+
+PLAYLIST_SIZES = [10, 100, 1000, 10000]
+
+
+def seed(size):
+    """Create a user, album, tracks and one playlist with size tracks. Return the playlist id"""
+
+    db.session.add(User(username='benchuser', password='benchpassword', email='bench@test.com'))
+    album = Album(spotify_album_id='benchalbum', name='benchalbum', image='http://www.test.com')
+    db.session.add(album)
+    db.session.flush()
+
+    track_ids = db.session.execute(insert(Track).values([{
+        "spotify_track_id": f"benchtrack{i}",
+        "name": f"benchtrack{i}",
+        "spotify_track_uri": f"spotify:track:benchtrack{i}",
+        "release_year": 2000,
+        "duration_ms": 1000,
+        "album_id": album.id
+    } for i in range(size)]).returning(Track.id)).scalars().all()
+
+    playlist = Playlist(username='benchuser', name='benchplaylist')
+    db.session.add(playlist)
+    db.session.flush()
+
+    # Store tracks in reverse so index order differs from id order
+    db.session.execute(insert(PlaylistTrack).values([{
+        "playlist_id": playlist.id,
+        "track_id": track_id,
+        "index": size - i
+    } for i, track_id in enumerate(track_ids)]))
+    db.session.commit()
+
+    return playlist.id
+
+
+def count_queries(f, *args):
+    """Run f and return (number of SQL statements executed, milliseconds)"""
+
+    count = [0]
+
+    def counter(*args, **kwargs):
+        count[0] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    start = time.perf_counter()
+    f(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    event.remove(db.engine, 'before_cursor_execute', counter)
+
+    return count[0], elapsed
+
+
+if __name__ == '__main__':
+    print(f"{'tracks':>8} {'function':<24} {'queries':>8} {'ms':>10}")
+
+    for size in PLAYLIST_SIZES:
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        playlist_id = seed(size)
+
+        for f in [get_playlist_tracks, get_playlist_track_ids]:
+            queries, elapsed = count_queries(f, playlist_id)
+            print(f"{size:>8} {f.__name__:<24} {queries:>8} {elapsed:>10.1f}")
@@ -0,0 +1,57 @@
+"""Benchmark: Spotify requests to sync an edited playlist, diff sync vs replacing every item
+
+Only plans the syncs, no requests are sent to Spotify:
+python bench_playlist_sync.py
+"""
+
+import random
+import time
+
+from app import app
+from playlist_sync import plan_playlist_sync, replace_cost
+
+PLAYLIST_SIZES = [100, 1000, 10000]
+
+
+def edits(uris, rng):
+    """Return named edited copies of a playlist"""
+
+    moved = list(uris)
+    moved.insert(len(moved) // 10, moved.pop(len(moved) // 2))
+
+    added = list(uris)
+    for i in range(10):
+        added.insert(rng.randrange(len(added) + 1), f'spotify:track:new{i}')
+
+    removed = list(uris)
+    for i in range(5):
+        removed.pop(rng.randrange(len(removed)))
+
+    appended = uris + [f'spotify:track:appended{i}' for i in range(100)]
+
+    shuffled = list(uris)
+    rng.shuffle(shuffled)
+
+    return {
+        'move one track': moved,
+        'add 10 tracks': added,
+        'remove 5 tracks': removed,
+        'append 100 tracks': appended,
+        'shuffle': shuffled
+    }
+
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    print(f"{'tracks':>8} {'edit':<20} {'replace':>8} {'diff':>8} {'ms':>8}")
+
+    for size in PLAYLIST_SIZES:
+        uris = [f'spotify:track:track{i}' for i in range(size)]
+
+        for name, new_uris in edits(uris, rng).items():
+            start = time.perf_counter()
+            plan = plan_playlist_sync(uris, new_uris)
+            elapsed = (time.perf_counter() - start) * 1000
+
+            diff = 'replace' if plan is None else len(plan)
+            print(f"{size:>8} {name:<20} {replace_cost(new_uris):>8} {diff:>8} {elapsed:>8.1f}")
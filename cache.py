@@ -0,0 +1,222 @@
+"""Response cache for Tuttitracks
+
+Entries expire after a time to live and the least recently used entries of each cache are evicted
+past its maximum size: 'responses' holds per user responses, 'search' search results shared by
+all users. Each entry belongs to a namespace, e.g. one user's responses, that can be
+invalidated at once. CACHE_BACKEND selects where entries live:
+    memory: in each app process
+    db:     in the cache_entries table, shared by all workers
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, CacheEntry
+import metrics
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+
+# Time to live in seconds of cached Spotify responses
+LIKED_TRACKS_TTL = int(os.environ.get('CACHE_LIKED_TRACKS_TTL', 300))
+TOP_TRACKS_TTL = int(os.environ.get('CACHE_TOP_TRACKS_TTL', 21600))
+
+# Search results are the same for every user
+SEARCH_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 3600))
+SEARCH_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 5000))
+
+CACHE_SIZES = {
+    "responses": CACHE_MAX_ENTRIES,
+    "search": SEARCH_MAX_ENTRIES
+}
+
+#====================================================================================
+# Cache backends
+#====================================================================================
+
+class MemoryCache():
+    """LRU cache with time to live, in this process only"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return (True, value) for a live entry, else (False, None)"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            namespace, value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+
+    def set(self, key, namespace, value, ttl):
+        """Save an entry, evicting the least recently used past max_entries"""
+
+        with self.lock:
+            self.entries[key] = (namespace, value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                metrics.incr('cache.evictions')
+
+
+    def invalidate(self, namespace):
+        """Delete every entry of a namespace"""
+
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[0] == namespace]:
+                del self.entries[key]
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DbCache():
+    """LRU cache with time to live in the cache_entries table, shared by all workers"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, name='responses'):
+        self.max_entries = max_entries
+        self.name = name
+
+
+    def get(self, key):
+        """Return (True, value) for a live entry, else (False, None)"""
+
+        entries = CacheEntry.__table__
+        now = time.time()
+        stmt = entries.update().where(entries.c.key == key, entries.c.expires_at > now).values(used_at=now).returning(entries.c.value)
+
+        with db.engine.begin() as conn:
+            row = conn.execute(stmt).first()
+
+        if row is None:
+            return False, None
+        return True, row.value
+
+
+    def set(self, key, namespace, value, ttl):
+        """Save an entry, then delete expired entries and the least recently used past max_entries"""
+
+        entries = CacheEntry.__table__
+        now = time.time()
+        stmt = insert(entries).values(key=key, cache_name=self.name, namespace=namespace, value=value, expires_at=now + ttl, used_at=now)
+        stmt = stmt.on_conflict_do_update(index_elements=['key'], set_={
+            "cache_name": stmt.excluded.cache_name,
+            "namespace": stmt.excluded.namespace,
+            "value": stmt.excluded.value,
+            "expires_at": stmt.excluded.expires_at,
+            "used_at": stmt.excluded.used_at
+        })
+
+        oldest = select(entries.c.key).where(entries.c.cache_name == self.name).order_by(entries.c.used_at.desc()).offset(self.max_entries)
+
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+            evicted = conn.execute(entries.delete().where(
+                entries.c.cache_name == self.name, (entries.c.expires_at <= now) | entries.c.key.in_(oldest)
+            )).rowcount
+
+        metrics.incr('cache.evictions', evicted)
+
+
+    def invalidate(self, namespace):
+        """Delete every entry of a namespace"""
+
+        entries = CacheEntry.__table__
+        with db.engine.begin() as conn:
+            conn.execute(entries.delete().where(entries.c.cache_name == self.name, entries.c.namespace == namespace))
+
+
+    def __len__(self):
+        with db.engine.connect() as conn:
+            entries = CacheEntry.__table__
+            return conn.execute(select(func.count()).select_from(entries).where(entries.c.cache_name == self.name)).scalar()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(name='responses'):
+    """Return this process's backend for the cache called name, chosen by CACHE_BACKEND"""
+
+    with _backends_lock:
+        if name not in _backends:
+            if CACHE_BACKEND == 'db':
+                backend = DbCache(CACHE_SIZES[name], name)
+            else:
+                backend = MemoryCache(CACHE_SIZES[name])
+            _backends[name] = backend
+            metrics.register_gauge(f'cache.{name}.entries', backend.__len__)
+
+    return _backends[name]
+
+#====================================================================================
+# Cache helpers
+#====================================================================================
+
+def user_namespace(username):
+    """Namespace of the cached responses of one user"""
+
+    return f'user:{username}'
+
+
+def make_key(namespace, name, **params):
+    """Key of a cached response: its namespace, name and parameters in a fixed order"""
+
+    return f'{namespace}:{name}:{json.dumps(params, sort_keys=True)}'
+
+
+def cached(namespace, name, ttl, fetch, store='responses', **params):
+    """
+    Return the cached response for namespace, name and params from the cache called store
+    On a miss, call fetch(**params), cache what it returns for ttl seconds and return it
+    """
+
+    backend = get_backend(store)
+    key = make_key(namespace, name, **params)
+
+    try:
+        found, value = backend.get(key)
+    except SQLAlchemyError:
+        # Never fail a request because the cache is unavailable
+        metrics.incr('cache.errors')
+        found, value = False, None
+
+    if found:
+        metrics.incr(f'cache.{name}.hits')
+        return value
+
+    metrics.incr(f'cache.{name}.misses')
+    value = fetch(**params)
+
+    try:
+        backend.set(key, namespace, value, ttl)
+    except SQLAlchemyError:
+        metrics.incr('cache.errors')
+
+    return value
+
+
+def invalidate(namespace, store='responses'):
+    """Drop every cached response of a namespace"""
+
+    metrics.incr('cache.invalidations')
+    try:
+        get_backend(store).invalidate(namespace)
+    except SQLAlchemyError:
+        metrics.incr('cache.errors')
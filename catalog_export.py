@@ -0,0 +1,146 @@
+"""Streaming export of a user's catalog and playlists as NDJSON or CSV
+
+A user's catalog is every track in the user's playlists, with its album, artists and audio features.
+Rows are read from a server-side cursor EXPORT_BATCH_SIZE at a time and written out as they arrive,
+so an export of any size runs in constant memory
+"""
+
+import os
+import io
+import csv
+import json
+from itertools import groupby
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from models import db, Track, Album, Artist, TrackArtist, Playlist, PlaylistTrack
+import metrics
+
+# Rows fetched from the server-side cursor at a time
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+TRACK_COLUMNS = [
+    'id', 'spotify_track_id', 'name', 'spotify_track_uri', 'release_year', 'popularity', 'duration_ms',
+    'acousticness', 'danceability', 'energy', 'tempo', 'instrumentalness', 'liveness', 'loudness',
+    'speechiness', 'valence', 'mode', 'key', 'time_signature'
+]
+
+PLAYLIST_COLUMNS = ['id', 'name', 'description', 'spotify_playlist_id', 'public', 'collaborative']
+
+PLAYLIST_TRACK_COLUMNS = ['position', 'spotify_track_id', 'name']
+
+
+def check_format(format):
+    """Return the content type of an export format, raise ValueError for an unknown format"""
+
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {format}")
+
+    return EXPORT_FORMATS[format]
+
+
+def stream_rows(stmt):
+    """Yield batches of rows of stmt read from a server-side cursor"""
+
+    with db.engine.connect() as conn:
+        result = conn.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(stmt)
+        for rows in result.partitions():
+            metrics.incr('export.rows', len(rows))
+            yield rows
+
+
+def csv_lines(rows):
+    """Return rows, each a list of values, as CSV text"""
+
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+
+    return out.getvalue()
+
+#====================================================================================
+# Tracks
+#====================================================================================
+
+def user_tracks_query(username):
+    """Return the SELECT statement of the tracks in a user's playlists, in track id order"""
+
+    artists = select(
+        func.array_agg(aggregate_order_by(Artist.name, Artist.id))
+    ).join(TrackArtist, TrackArtist.artist_id==Artist.id).where(TrackArtist.track_id==Track.id).scalar_subquery()
+
+    in_playlists = select(PlaylistTrack.track_id).join(
+        Playlist, Playlist.id==PlaylistTrack.playlist_id
+    ).where(Playlist.username==username)
+
+    return select(
+        *[getattr(Track, column) for column in TRACK_COLUMNS],
+        Album.spotify_album_id, Album.name.label('album_name'), artists.label('artists')
+    ).outerjoin(Album, Album.id==Track.album_id).where(Track.id.in_(in_playlists)).order_by(Track.id)
+
+
+def export_tracks(username, format):
+    """Yield the text of the tracks in a user's playlists as NDJSON, one track per line, or CSV"""
+
+    columns = TRACK_COLUMNS + ['spotify_album_id', 'album_name', 'artists']
+
+    if format == 'csv':
+        yield csv_lines([columns])
+
+    for rows in stream_rows(user_tracks_query(username)):
+        if format == 'csv':
+            # Artists are one field, names separated by ;
+            yield csv_lines([[*row[:-1], ';'.join(row.artists or [])] for row in rows])
+        else:
+            yield ''.join(json.dumps({**row._asdict(), 'artists': row.artists or []}) + '\n' for row in rows)
+
+#====================================================================================
+# Playlists
+#====================================================================================
+
+def user_playlists_query(username):
+    """Return the SELECT statement of a user's playlists joined to their tracks, in playlist order"""
+
+    return select(
+        *[getattr(Playlist, column) for column in PLAYLIST_COLUMNS],
+        Track.spotify_track_id.label('track_spotify_id'), Track.name.label('track_name')
+    ).outerjoin(PlaylistTrack, PlaylistTrack.playlist_id==Playlist.id).outerjoin(
+        Track, Track.id==PlaylistTrack.track_id
+    ).where(Playlist.username==username).order_by(Playlist.id, PlaylistTrack.index, PlaylistTrack.id)
+
+
+def playlist_entries(username):
+    """Yield (playlist row, list of its track rows) for each of a user's playlists, one playlist in memory at a time"""
+
+    rows = (row for batch in stream_rows(user_playlists_query(username)) for row in batch)
+
+    for _, playlist_rows in groupby(rows, key=lambda row: row.id):
+        playlist_rows = list(playlist_rows)
+        # A playlist without tracks has one row with no track
+        yield playlist_rows[0], [row for row in playlist_rows if row.track_spotify_id is not None]
+
+
+def export_playlists(username, format):
+    """
+    Yield the text of a user's playlists as NDJSON, one playlist with its ordered tracks per line,
+    or CSV, one row per playlist track with the playlist's columns repeated
+    """
+
+    if format == 'csv':
+        yield csv_lines([[f'playlist_{column}' for column in PLAYLIST_COLUMNS] + PLAYLIST_TRACK_COLUMNS])
+
+    for playlist, tracks in playlist_entries(username):
+        details = [getattr(playlist, column) for column in PLAYLIST_COLUMNS]
+
+        if format == 'csv':
+            yield csv_lines([details + [position, track.track_spotify_id, track.track_name] for position, track in enumerate(tracks)]
+                or [details + [None, None, None]])
+        else:
+            yield json.dumps({
+                **dict(zip(PLAYLIST_COLUMNS, details)),
+                'tracks': [{'position': position, 'spotify_track_id': track.track_spotify_id, 'name': track.track_name}
+                    for position, track in enumerate(tracks)]
+            }) + '\n'
@@ -0,0 +1,131 @@
+"""Search the local catalog of ingested tracks
+
+Each track holds a weighted tsvector of its name, artists, album and lyrics, with a GIN index.
+Where the pg_trgm extension is installed (python migrate.py enables it), misspelled queries also
+match by trigram word similarity on the same text. /search answers from the catalog when it holds
+enough matches and asks Spotify otherwise
+"""
+
+import os
+from sqlalchemy import text, select, func, literal, or_, tuple_, cast, Float
+from models import db, Track
+import metrics
+
+# Matches the catalog must hold for /search to skip Spotify
+LOCAL_SEARCH_MIN_RESULTS = int(os.environ.get('LOCAL_SEARCH_MIN_RESULTS', 30))
+
+UPDATE_SEARCH_DOCUMENTS = text("""
+    UPDATE tracks SET search_vector = doc.vector, search_text = doc.text
+    FROM (
+        SELECT t.id,
+            setweight(to_tsvector('simple', t.name), 'A') ||
+            setweight(to_tsvector('simple', coalesce(string_agg(ar.name, ' '), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(al.name, '')), 'C') ||
+            setweight(to_tsvector('simple', coalesce(t.lyrics, '')), 'D') AS vector,
+            lower(concat_ws(' ', t.name, string_agg(ar.name, ' '), al.name)) AS text
+        FROM tracks t
+        LEFT JOIN albums al ON al.id = t.album_id
+        LEFT JOIN tracks_artists ta ON ta.track_id = t.id
+        LEFT JOIN artists ar ON ar.id = ta.artist_id
+        WHERE t.id = ANY(:track_ids)
+        GROUP BY t.id, al.name
+    ) AS doc
+    WHERE tracks.id = doc.id
+""")
+
+_trigram = None
+
+#====================================================================================
+# Search documents
+#====================================================================================
+
+def update_search_documents(track_ids):
+    """Rebuild the search documents of tracks, e.g. once their artists are linked. The caller commits"""
+
+    if track_ids:
+        db.session.execute(UPDATE_SEARCH_DOCUMENTS, {"track_ids": list(track_ids)})
+
+
+def has_trigram():
+    """Return True if the pg_trgm extension is installed. Checked once per process"""
+
+    global _trigram
+
+    if _trigram is None:
+        _trigram = db.session.execute(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")).scalar()
+
+    return _trigram
+
+#====================================================================================
+# Catalog search
+#====================================================================================
+
+def search_catalog(query, year=None, limit=20, offset=0, after=None):
+    """
+    Rank local tracks matching every word of query, best first
+    Optional year keeps tracks released that year
+    A page starts at offset, or after the [rank, popularity, id] of the last track of the previous page
+    Return (a page of track dicts, total number of matches or None for a page after a cursor,
+    [rank, popularity, id] of the page's last track or None on the last page)
+
+    Only pages without after count every match. No index orders tracks by rank, so every page still
+    ranks every match to find its top rows: a cursor keeps pages stable as tracks are added and
+    saves reading past the offset, but a deep page costs about as much as the first
+    """
+
+    query = ' '.join(query.lower().split())
+    if not query and not year:
+        return [], 0, None
+
+    rank = literal(0.0)
+    conditions = []
+
+    if query:
+        tsquery = func.plainto_tsquery('simple', query)
+        matches = Track.search_vector.op('@@')(tsquery)
+        rank = func.ts_rank_cd(Track.search_vector, tsquery)
+
+        if has_trigram():
+            matches = or_(matches, literal(query).op('<%')(Track.search_text))
+            rank = rank + func.word_similarity(query, Track.search_text)
+
+        conditions.append(matches)
+
+    if year:
+        conditions.append(Track.release_year == int(year))
+
+    # The rank is a double so the rank sent back in a cursor compares equal to the row's own
+    rank = cast(rank, Float)
+    popularity = func.coalesce(Track.popularity, -1)
+    columns = [Track.id, Track.name, Track.spotify_track_id, rank.label('rank'), popularity.label('popularity')]
+
+    if after is None:
+        columns.append(func.count().over().label('total'))
+    else:
+        conditions.append(tuple_(rank, popularity, Track.id) < tuple_(*after))
+
+    # One extra row tells if there is a next page
+    stmt = select(*columns).where(*conditions).order_by(rank.desc(), popularity.desc(), Track.id.desc()).limit(limit + 1).offset(offset)
+    rows = db.session.execute(stmt).all()
+
+    tracks = [{"name": row.name, "id": row.id, "spotify_track_id": row.spotify_track_id} for row in rows[:limit]]
+    total = None if after is not None else rows[0].total if rows else 0
+    next_after = [rows[limit - 1].rank, rows[limit - 1].popularity, rows[limit - 1].id] if len(rows) > limit else None
+
+    return tracks, total, next_after
+
+
+def search_local_catalog(query, year=None, limit=20, offset=0):
+    """
+    Return a page of local search results if the catalog holds at least LOCAL_SEARCH_MIN_RESULTS
+    matches and a full page at offset, else None: the caller asks Spotify instead
+    """
+
+    tracks, total, next_after = search_catalog(query, year, limit, offset)
+
+    if total < max(LOCAL_SEARCH_MIN_RESULTS, offset + limit):
+        metrics.incr('search.spotify')
+        return None
+
+    metrics.incr('search.local')
+    return tracks
@@ -0,0 +1,246 @@
+"""Columnar snapshot of the audio feature catalog for analytics
+
+The snapshot is a directory under CATALOG_SNAPSHOT_PATH of zstd compressed Parquet parts, one
+written per run, holding every track with audio features and its album, artists and genres:
+    part-00001.parquet  tracks whose features were saved since the previous part,
+                        sorted by release_year with one row group per year
+    MANIFEST.json       the parts in order, and the db time the last run read features up to
+The first run takes every track with features, including any saved without a features_updated_at.
+Later runs append a part of the tracks whose features_updated_at is past the last run's, so the
+tracks table is only read in full once. Parts are memory-mapped when read, so analytics and
+the feature matrix can load the catalog without querying Postgres. A track whose features are
+saved again appears in a later part too: read_snapshot keeps its latest row.
+Run on a schedule, e.g. with the Heroku Scheduler, with: python catalog_snapshot.py
+"""
+
+import os
+import time
+import json
+import fcntl
+from datetime import datetime, timedelta
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from models import db, Track, Album, Artist, TrackArtist, Genre, TrackGenre
+import metrics
+
+CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH', 'catalog_snapshot')
+
+# Features saved by transactions that commit this long after they start may be read again
+SNAPSHOT_OVERLAP = timedelta(seconds=300)
+
+# Rows read from the db per round trip
+SNAPSHOT_BATCH_SIZE = 50000
+
+# Most rows in one row group: a year with more tracks is split into several groups
+ROW_GROUP_SIZE = 500000
+
+FEATURE_COLUMNS = [
+    'acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'loudness',
+    'speechiness', 'valence', 'tempo'
+]
+
+SNAPSHOT_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('spotify_track_id', pa.string()),
+    ('name', pa.string()),
+    ('release_year', pa.int32()),
+    ('popularity', pa.int32()),
+    ('duration_ms', pa.int32()),
+    *[(column, pa.float64()) for column in FEATURE_COLUMNS],
+    ('mode', pa.int32()),
+    ('key', pa.int32()),
+    ('time_signature', pa.int32()),
+    ('features_updated_at', pa.timestamp('us')),
+    ('spotify_album_id', pa.string()),
+    ('album_name', pa.string()),
+    ('artists', pa.list_(pa.string())),
+    ('genres', pa.list_(pa.string()))
+])
+
+#====================================================================================
+# Reading
+#====================================================================================
+
+def read_manifest(path=None):
+    """Return the snapshot's manifest, or None if no snapshot was written"""
+
+    try:
+        with open(os.path.join(path or CATALOG_SNAPSHOT_PATH, 'MANIFEST.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def read_parts(manifest, columns=None, filters=None, path=None):
+    """Return a table of the rows of every part in order, with duplicate tracks"""
+
+    path = path or CATALOG_SNAPSHOT_PATH
+    tables = [pq.read_table(os.path.join(path, part), columns=columns, filters=filters, memory_map=True)
+        for part in manifest['parts']]
+
+    return pa.concat_tables(tables) if tables else SNAPSHOT_SCHEMA.empty_table().select(columns or SNAPSHOT_SCHEMA.names)
+
+
+def read_snapshot(columns=None, filters=None, path=None):
+    """
+    Return (a table of the latest row of each track in the snapshot, db time the snapshot was
+    read up to), or (None, None) if no snapshot was written
+    Optional filters, e.g. [('release_year', '>=', 2016)], skip row groups by their statistics and
+    are applied before older rows of a track are dropped: filter on columns that don't change
+    """
+
+    manifest = read_manifest(path)
+    if manifest is None:
+        return None, None
+
+    columns = columns if columns is None or 'id' in columns else ['id', *columns]
+    table = read_parts(manifest, columns, filters, path)
+
+    # Later parts hold newer rows: keep the last row of each track id
+    ids = table['id'].to_numpy()
+    ids, last = np.unique(ids[::-1], return_index=True)
+    table = table.take(np.sort(len(table) - 1 - last))
+
+    return table, parse_time(manifest['synced_at'])
+
+
+def parse_time(value):
+    """Return a datetime from the manifest's ISO format"""
+
+    return datetime.fromisoformat(value)
+
+#====================================================================================
+# Writing
+#====================================================================================
+
+def snapshot_query(since=None):
+    """
+    Return the SELECT statement of tracks with features saved since a time, or of every track with
+    features if since is None, by release_year
+    """
+
+    artists = select(
+        func.array_agg(aggregate_order_by(Artist.name, Artist.id))
+    ).join(TrackArtist, TrackArtist.artist_id==Artist.id).where(TrackArtist.track_id==Track.id).scalar_subquery()
+
+    genres = select(
+        func.array_agg(aggregate_order_by(Genre.name, Genre.id))
+    ).join(TrackGenre, TrackGenre.genre_id==Genre.id).where(TrackGenre.track_id==Track.id).scalar_subquery()
+
+    stmt = select(
+        Track.id, Track.spotify_track_id, Track.name, Track.release_year, Track.popularity, Track.duration_ms,
+        *[getattr(Track, column) for column in FEATURE_COLUMNS],
+        Track.mode, Track.key, Track.time_signature, Track.features_updated_at,
+        Album.spotify_album_id, Album.name.label('album_name'), artists.label('artists'), genres.label('genres')
+    ).outerjoin(Album, Album.id==Track.album_id)
+
+    # Features saved before features_updated_at existed have no time: select on the features themselves
+    if since is None:
+        stmt = stmt.where(Track.tempo.isnot(None))
+    else:
+        stmt = stmt.where(Track.features_updated_at >= since)
+
+    return stmt.order_by(Track.release_year, Track.id)
+
+
+def db_now():
+    """Return the db server's current time"""
+
+    with db.engine.connect() as conn:
+        return conn.execute(select(func.localtimestamp())).scalar()
+
+
+def written_since(manifest, since):
+    """Return the set of (track id, features_updated_at) already written with features saved since a time"""
+
+    if manifest is None or since is None:
+        return set()
+
+    table = read_parts(manifest, ['id', 'features_updated_at'], [('features_updated_at', '>=', since)])
+
+    return set(zip(table['id'].to_pylist(), table['features_updated_at'].to_pylist()))
+
+
+def write_part(filename, rows):
+    """
+    Write batches of rows to a Parquet file, one row group per release_year
+    Return the number of rows written
+    """
+
+    count = 0
+    group = []
+
+    with pq.ParquetWriter(filename, SNAPSHOT_SCHEMA, compression='zstd') as writer:
+        for batch in rows:
+            for row in batch:
+                if group and (row.release_year != group[-1]['release_year'] or len(group) >= ROW_GROUP_SIZE):
+                    writer.write_table(pa.Table.from_pylist(group, schema=SNAPSHOT_SCHEMA), row_group_size=ROW_GROUP_SIZE)
+                    count += len(group)
+                    group = []
+                group.append({**row._asdict(), 'artists': row.artists or [], 'genres': row.genres or []})
+
+        if group:
+            writer.write_table(pa.Table.from_pylist(group, schema=SNAPSHOT_SCHEMA), row_group_size=ROW_GROUP_SIZE)
+            count += len(group)
+
+    return count
+
+
+def snapshot_catalog(path=None):
+    """
+    Append a part of the tracks with features saved since the last run to the snapshot
+    Return the number of tracks written, or None if another process is writing the snapshot
+    """
+
+    path = path or CATALOG_SNAPSHOT_PATH
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, 'snapshot.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        start = time.perf_counter()
+        manifest = read_manifest(path) or {'parts': [], 'synced_at': None}
+        synced_at = db_now()
+        since = parse_time(manifest['synced_at']) - SNAPSHOT_OVERLAP if manifest['synced_at'] else None
+
+        # Rows read again in the overlap are only written if their features changed
+        written = written_since(manifest if manifest['parts'] else None, since)
+        stmt = snapshot_query(since)
+
+        def new_rows():
+            with db.engine.connect() as conn:
+                result = conn.execution_options(yield_per=SNAPSHOT_BATCH_SIZE).execute(stmt)
+                for rows in result.partitions():
+                    yield [row for row in rows if (row.id, row.features_updated_at) not in written]
+
+        part = f'part-{len(manifest["parts"]) + 1:05d}.parquet'
+        count = write_part(os.path.join(path, part + '.tmp'), new_rows())
+
+        if count:
+            os.replace(os.path.join(path, part + '.tmp'), os.path.join(path, part))
+            manifest['parts'].append(part)
+        else:
+            os.remove(os.path.join(path, part + '.tmp'))
+
+        manifest['synced_at'] = synced_at.isoformat()
+        with open(os.path.join(path, 'MANIFEST.json.tmp'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(os.path.join(path, 'MANIFEST.json.tmp'), os.path.join(path, 'MANIFEST.json'))
+
+        metrics.incr('catalog_snapshot.rows', count)
+        metrics.observe('catalog_snapshot.write', time.perf_counter() - start)
+
+    return count
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print('Wrote', snapshot_catalog(), 'tracks')
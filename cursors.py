@@ -0,0 +1,70 @@
+"""Opaque cursors for paginated list endpoints
+
+A cursor holds where the next page of a list starts: the sort key of the last row of a local
+list, e.g. (index, id) of a playlist track, or Spotify's next url for a list proxied from Spotify.
+Reading a page from a cursor seeks to its key instead of counting past an offset.
+Cursors are signed with the app's secret key, so a client can't edit one, e.g. to point a
+proxied list at another Spotify url. Each cursor names its list and is refused by any other
+"""
+
+from urllib.parse import urlsplit, parse_qs
+from itsdangerous import URLSafeSerializer, BadSignature
+from flask import current_app
+from app import BASE_URL
+
+
+def serializer():
+    """Serializer signing cursors with the app's secret key"""
+
+    return URLSafeSerializer(current_app.secret_key, salt='cursor')
+
+
+def encode_cursor(name, position):
+    """Return the cursor of the list called name starting after position, or None if position is None"""
+
+    if position is None:
+        return None
+
+    return serializer().dumps([name, position])
+
+
+def decode_cursor(name, cursor):
+    """
+    Return the position of a cursor of the list called name, or None if cursor is empty
+    Raise ValueError for a cursor that was edited or made for another list
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        cursor_name, position = serializer().loads(cursor)
+    except (BadSignature, ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+    if cursor_name != name:
+        raise ValueError("Invalid cursor")
+
+    return position
+
+
+def encode_spotify_cursor(name, next_url):
+    """Return the cursor wrapping the next url of a page from Spotify, or None on the last page"""
+
+    if not next_url:
+        return None
+
+    return encode_cursor(name, next_url[len(BASE_URL):] if next_url.startswith(BASE_URL) else next_url)
+
+
+def decode_spotify_cursor(name, cursor):
+    """
+    Return the query string arguments of the Spotify url wrapped by a cursor, e.g. offset and limit,
+    or an empty dict if cursor is empty
+    """
+
+    url = decode_cursor(name, cursor)
+    if url is None:
+        return {}
+
+    return {key: values[0] for key, values in parse_qs(urlsplit(url).query).items()}
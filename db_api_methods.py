@@ -2,6 +2,15 @@
 
 from models import db, Track, Playlist, PlaylistTrack
 from flask import g
+from sqlalchemy import text, tuple_
+import task_queue
+import cache
+
+# PlaylistTrack.index is an ordering key, not a position: keys are spaced INDEX_GAP apart
+# so a track can be moved or inserted by giving it a key between its new neighbours
+INDEX_GAP = 65536
+# Rebalance a playlist in the background once neighbouring keys are this close
+MIN_INDEX_GAP = 64
 
 #====================================================================================
 # Database API CRUD methods
@@ -28,9 +37,10 @@ def create_playlist(name="New Playlist", description=None, tracks=[], public=Tru
             index = index
         )
         playlist_tracks.append(new_playlist_track)
-        index += 1
+        index += INDEX_GAP
     db.session.add_all(playlist_tracks)
     db.session.commit()
+    playlist_written(new_playlist.id)
 
     return new_playlist
 
@@ -41,20 +51,7 @@ def get_playlist_tracks(playlist_id):
     Return a list of spotify uris in index order
     """
 
-    playlist_tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index).all()
-
-    # track_ids = [item.track_id for item in playlist_tracks]
-    # # track_ids are in index order
-    # # The following line returns the tracks no longer in order by index
-    # tracks = Track.query.filter(Track.id.in_(track_ids)).all()
-    # spotify_uris = [item.spotify_track_uri for item in tracks]
-
-    spotify_uris = []
-    for item in playlist_tracks:
-        track = Track.query.get_or_404(item.track_id)
-        spotify_uris.append(track.spotify_track_uri)
-
-    return spotify_uris
+    return get_playlist_column(playlist_id, Track.spotify_track_uri)
 
 
 def get_playlist_track_ids(playlist_id):
@@ -62,82 +59,109 @@ def get_playlist_track_ids(playlist_id):
     Return a list of spotify ids in index order
     """
 
-    playlist_tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index).all()
+    return get_playlist_column(playlist_id, Track.spotify_track_id)
+
+
+def get_playlist_column(playlist_id, column):
+    """Return one Track column for every track of a playlist in index order
+    A single query joins playlists_tracks to tracks, whatever the size of the playlist
+    """
+
+    rows = db.session.query(column).join(PlaylistTrack, PlaylistTrack.track_id==Track.id).filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index).all()
 
-    # track_ids = [item.track_id for item in playlist_tracks]
-    # # track_ids are in index order
-    # # The following line returns the tracks no longer in order by index
-    # tracks = Track.query.filter(Track.id.in_(track_ids)).all()
-    # spotify_ids = [item.spotify_track_id for item in tracks]
+    return [row[0] for row in rows]
 
-    # Old way
-    spotify_ids = []
-    for item in playlist_tracks:
-        track = Track.query.get_or_404(item.track_id)
-        spotify_ids.append(track.spotify_track_id)
 
-    return spotify_ids
+def get_playlist_track_page(playlist_id, limit, after=None):
+    """Get a page of a local playlist's tracks, seeking past after: the [index, id] of the last track of the previous page
+    Return (list of spotify ids in index order, [index, id] of the page's last track or None on the last page)
+    """
+
+    query = db.session.query(Track.spotify_track_id, PlaylistTrack.index, PlaylistTrack.id).join(
+        PlaylistTrack, PlaylistTrack.track_id==Track.id
+    ).filter(PlaylistTrack.playlist_id==playlist_id)
+
+    if after is not None:
+        query = query.filter(tuple_(PlaylistTrack.index, PlaylistTrack.id) > tuple_(*after))
+
+    # One extra row tells if there is a next page
+    rows = query.order_by(PlaylistTrack.index, PlaylistTrack.id).limit(limit + 1).all()
+    next_after = [rows[limit - 1].index, rows[limit - 1].id] if len(rows) > limit else None
+
+    return [row.spotify_track_id for row in rows[:limit]], next_after
 
 
 def append_playlist_tracks(playlist_id, track_ids):
     """Append a list of track ids to existing playlist"""
 
+    # Concurrent appends would read the same last key and add tracks at equal keys
+    lock_playlist(playlist_id)
     last_track = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index.desc()).first()
 
     if last_track:
-        index = last_track.index + 1
+        index = last_track.index + INDEX_GAP
     else:
         index = 0
-    
+
+    playlist_tracks = []
     for track in track_ids:
         new_playlist_track = PlaylistTrack(
             playlist_id = playlist_id,
             track_id = track,
             index = index
         )
-        PlaylistTrack.insert(new_playlist_track)
-        index += 1
+        playlist_tracks.append(new_playlist_track)
+        index += INDEX_GAP
+    db.session.add_all(playlist_tracks)
+    db.session.commit()
+    playlist_written(playlist_id)
 
 
 def insert_playlist_track(playlist_id, track_id, index):
-    """Insert a track into an existing playlist"""
+    """Insert a track into an existing playlist
+    index is the 0 based position of the new track: only the new row is written
+    """
 
     # Check current user owns playlist
 
-    playlist_tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index >= index).order_by(PlaylistTrack.index).all()
-
-    for track in playlist_tracks:
-        track.index += 1
+    lock_playlist(playlist_id)
+    key, crowded = place_between(playlist_id, index - 1, index)
     new_playlist_track = PlaylistTrack(
         playlist_id = playlist_id,
         track_id = track_id,
-        index = index
+        index = key
     )
     PlaylistTrack.insert(new_playlist_track)
+    playlist_written(playlist_id)
+
+    if crowded:
+        task_queue.enqueue('rebalance_playlist', playlist_id=int(playlist_id))
 
 
 def move_playlist_track(playlist_id, current_index, new_index):
-    """Move a playlist track from its current index to a new index"""
+    """Move a playlist track from its current index to a new index
+    Indexes are 0 based positions: only the moved row is written
+    """
 
-    track_to_move = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id,PlaylistTrack.index==current_index).first()
+    if current_index == new_index:
+        return
 
-    if new_index > current_index:
-        
-        tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index > current_index).order_by(PlaylistTrack.index).all()
-        for track in tracks:
-            if track.index <= new_index:
-                track.index -= 1
-        track_to_move.index = new_index
+    lock_playlist(playlist_id)
+    track_to_move = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index).offset(current_index).first()
 
+    # Neighbours at the new position, counted with the moved track still in place
+    if new_index > current_index:
+        positions = (new_index, new_index + 1)
     else:
-        tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index >= new_index).order_by(PlaylistTrack.index).all()
-        
-        for track in tracks:
-            if track.index <= current_index:
-                track.index += 1
-        track_to_move.index = new_index        
+        positions = (new_index - 1, new_index)
+
+    track_to_move.index, crowded = place_between(playlist_id, *positions)
 
     PlaylistTrack.update()
+    playlist_written(playlist_id)
+
+    if crowded:
+        task_queue.enqueue('rebalance_playlist', playlist_id=int(playlist_id))
 
 
 def move_playlist_track_by_track(playlist_id, track_id, new_index):
@@ -147,39 +171,112 @@ def move_playlist_track_by_track(playlist_id, track_id, new_index):
     """
 
     track_to_move = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.track_id==track_id).first()
-    current_index = track_to_move.index
-    if new_index > current_index:
-        
-        tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index > current_index).order_by(PlaylistTrack.index).all()
-        for track in tracks:
-            if track.index <= new_index:
-                track.index -= 1
-        track_to_move.index = new_index
+    current_index = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index < track_to_move.index).count()
+
+    move_playlist_track(playlist_id, current_index, new_index)
 
-    else:
-        tracks = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index >= new_index).order_by(PlaylistTrack.index).all()
-        
-        for track in tracks:
-            if track.index <= current_index:
-                track.index += 1
-        track_to_move.index = new_index
-   
 
 def delete_playlist_track(playlist_id, track_id):
-    """Delete a track from a playlist"""
+    """Delete a track from a playlist
+    The tracks after it keep their keys: their positions move up by one
+    """
 
-    track = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.track_id==track_id).first()
-    index = track.index
+    track = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.track_id==track_id).order_by(PlaylistTrack.index).first()
     PlaylistTrack.delete(track)
+    playlist_written(playlist_id)
 
-    tracks_after = PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id, PlaylistTrack.index > index).order_by(PlaylistTrack.index).all()
-    for track in tracks_after:
-        track.index -= 1
-    PlaylistTrack.update()
+#====================================================================================
+# Playlist ordering helpers
+#====================================================================================
+
+def get_neighbour_keys(playlist_id, before_index, after_index):
+    """Return the keys of the tracks at two adjacent 0 based positions
+    None stands for the start or end of the playlist
+    """
+
+    start = max(before_index, 0)
+    keys = [row.index for row in db.session.query(PlaylistTrack.index).filter(PlaylistTrack.playlist_id==playlist_id).order_by(PlaylistTrack.index).offset(start).limit(after_index - start + 1)]
+
+    before = keys[0] if before_index >= 0 and keys else None
+    after = keys[-1] if len(keys) > after_index - start else None
+
+    # Position past the end of the playlist: place after the last track
+    if before_index >= 0 and not keys:
+        before = db.session.query(db.func.max(PlaylistTrack.index)).filter(PlaylistTrack.playlist_id==playlist_id).scalar()
+
+    return before, after
+
+
+def key_between(before, after):
+    """Return a key between two keys, or None if no key fits between them
+    before is None at the start of the playlist and after is None at the end
+    """
+
+    if before is None and after is None:
+        return 0
+    if before is None:
+        return after - INDEX_GAP
+    if after is None:
+        return before + INDEX_GAP
+    if after - before < 2:
+        return None
+
+    return (before + after) // 2
+
+
+def place_between(playlist_id, before_index, after_index):
+    """Return (key, crowded) for a track placed between two 0 based positions
+    If the neighbouring keys are adjacent the playlist is rebalanced first
+    crowded is True when the keys are getting close: the caller queues a rebalance once its row is saved
+    """
 
+    before, after = get_neighbour_keys(playlist_id, before_index, after_index)
+    key = key_between(before, after)
 
-def get_playlist_item_info(playlists):
-    """Parse playlist item info, return list of dicts"""
+    if key is None:
+        rebalance_playlist(playlist_id)
+        lock_playlist(playlist_id)
+        before, after = get_neighbour_keys(playlist_id, before_index, after_index)
+        key = key_between(before, after)
+
+    crowded = before is not None and after is not None and after - before < MIN_INDEX_GAP
+
+    return key, crowded
+
+
+def lock_playlist(playlist_id):
+    """Lock the playlist row until commit so reorders and rebalances of one playlist run one at a time"""
+
+    db.session.query(Playlist.id).filter(Playlist.id==playlist_id).with_for_update().first()
+
+
+def playlist_written(playlist_id):
+    """Invalidation hook run after a playlist changes: drop its owner's cached responses"""
+
+    username = db.session.query(Playlist.username).filter(Playlist.id==playlist_id).scalar()
+    cache.invalidate(cache.user_namespace(username))
+
+
+@task_queue.task('rebalance_playlist')
+def rebalance_playlist(playlist_id):
+    """Respace a playlist's keys INDEX_GAP apart in their current order, in one statement"""
+
+    lock_playlist(playlist_id)
+    db.session.execute(text("""
+        UPDATE playlists_tracks SET index = ordered.position * :gap
+        FROM (
+            SELECT id, row_number() OVER (ORDER BY index, id) - 1 AS position
+            FROM playlists_tracks WHERE playlist_id = :playlist_id
+        ) AS ordered
+        WHERE playlists_tracks.id = ordered.id
+    """), {"gap": INDEX_GAP, "playlist_id": playlist_id})
+    db.session.commit()
+
+
+def get_playlist_item_info(playlists, local_ids={}):
+    """Parse playlist item info, return list of dicts
+    local_ids maps spotify_playlist_id to the id of the local playlist mirroring it
+    """
 
     playlist_info = []
     for playlist in playlists:
@@ -192,6 +289,6 @@ def get_playlist_item_info(playlists):
         collaborative = playlist['collaborative']
         owner = playlist['owner']['display_name']
 
-        playlist_info.append({"name": name, "description": description, "spotify_playlist_id": spotify_playlist_id, "snapshot_id": snapshot_id, "num_tracks": num_tracks, "public": public, "collborative": collaborative, "owner": owner})
+        playlist_info.append({"id": local_ids.get(spotify_playlist_id), "name": name, "description": description, "spotify_playlist_id": spotify_playlist_id, "snapshot_id": snapshot_id, "num_tracks": num_tracks, "public": public, "collborative": collaborative, "owner": owner})
 
     return playlist_info
\ No newline at end of file
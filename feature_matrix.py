@@ -0,0 +1,257 @@
+"""In-memory matrix of track audio features for similarity search
+
+Each app process holds one row of normalized audio features per track that has them, built from
+the tracks table on first use. Features saved by this process are added right away; features
+saved by other workers are read back every FEATURE_MATRIX_REFRESH seconds by their
+features_updated_at. With FEATURE_MATRIX_FROM_SNAPSHOT = 'true', the matrix is built from the
+memory-mapped catalog snapshot, see catalog_snapshot, and only features saved since the snapshot
+are read from the db. Nearest neighbours are found with one matrix-vector product over every row
+"""
+
+import os
+import time
+import threading
+from datetime import timedelta
+import numpy as np
+from sqlalchemy import select, func
+from models import db, Track
+import catalog_snapshot
+import metrics
+
+# Seconds between reads of features saved by other processes
+FEATURE_MATRIX_REFRESH = int(os.environ.get('FEATURE_MATRIX_REFRESH', 60))
+
+# Build the matrix from the catalog snapshot when one was written
+FROM_SNAPSHOT = os.environ.get('FEATURE_MATRIX_FROM_SNAPSHOT', 'false').lower() == 'true'
+
+# Features saved by transactions that commit this long after they start may be read again
+REFRESH_OVERLAP = timedelta(seconds=300)
+
+# Rows read from the db per round trip when building the matrix
+LOAD_BATCH_SIZE = 50000
+
+# Audio features compared for similarity, with the range scaled to 0-1
+SIMILARITY_FEATURES = {
+    "acousticness": (0.0, 1.0),
+    "danceability": (0.0, 1.0),
+    "energy": (0.0, 1.0),
+    "instrumentalness": (0.0, 1.0),
+    "liveness": (0.0, 1.0),
+    "loudness": (-60.0, 0.0),
+    "speechiness": (0.0, 1.0),
+    "valence": (0.0, 1.0),
+    "tempo": (0.0, 250.0),
+    "mode": (0.0, 1.0)
+}
+
+FEATURE_MIN = np.array([low for low, high in SIMILARITY_FEATURES.values()], dtype=np.float32)
+FEATURE_SCALE = np.array([high - low for low, high in SIMILARITY_FEATURES.values()], dtype=np.float32)
+
+
+def normalize(features):
+    """Scale an array of feature rows, in SIMILARITY_FEATURES order, to 0-1"""
+
+    features = np.asarray(features, dtype=np.float32).reshape(-1, len(SIMILARITY_FEATURES))
+    return np.clip((features - FEATURE_MIN) / FEATURE_SCALE, 0.0, 1.0)
+
+#====================================================================================
+# Feature matrix
+#====================================================================================
+
+class FeatureMatrix():
+    """Normalized audio features of tracks, one row per track id"""
+
+    def __init__(self, capacity=1024):
+        self.vectors = np.zeros((capacity, len(SIMILARITY_FEATURES)), dtype=np.float32)
+        self.norms = np.zeros(capacity, dtype=np.float32)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        # Row of each track id, -1 for tracks without features
+        self.rows = np.full(capacity, -1, dtype=np.int64)
+        self.size = 0
+        self.lock = threading.Lock()
+
+
+    def upsert(self, track_ids, features):
+        """Add or replace the rows of track_ids with their raw features"""
+
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        if not len(track_ids):
+            return
+        vectors = normalize(features)
+
+        with self.lock:
+            # The last features of a track id given twice win
+            track_ids, first = np.unique(track_ids[::-1], return_index=True)
+            vectors = vectors[::-1][first]
+
+            if track_ids[-1] >= len(self.rows):
+                rows = np.full(max(track_ids[-1] + 1, 2 * len(self.rows)), -1, dtype=np.int64)
+                rows[:len(self.rows)] = self.rows
+                self.rows = rows
+
+            rows = self.rows[track_ids]
+            new = rows < 0
+            count = int(new.sum())
+            if self.size + count > len(self.ids):
+                self._grow(self.size + count)
+
+            rows[new] = np.arange(self.size, self.size + count)
+            self.rows[track_ids[new]] = rows[new]
+            self.ids[rows] = track_ids
+            self.vectors[rows] = vectors
+            self.norms[rows] = (vectors * vectors).sum(axis=1)
+            self.size += count
+
+
+    def _grow(self, size):
+        """Reallocate the row arrays to hold at least size rows"""
+
+        capacity = max(size, 2 * len(self.ids))
+        for name in ('vectors', 'norms', 'ids'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+
+    def vector(self, track_id):
+        """Return the normalized features of a track, or None if it has none"""
+
+        with self.lock:
+            if track_id < 0 or track_id >= len(self.rows) or self.rows[track_id] < 0:
+                return None
+            return self.vectors[self.rows[track_id]].copy()
+
+
+    def nearest(self, vector, k=20, exclude=None):
+        """
+        Return (track ids, distances) of the k rows closest to a normalized vector, closest first
+        Optional exclude is a track id left out of the results
+        """
+
+        with self.lock:
+            vectors = self.vectors[:self.size]
+            # Squared euclidean distances: |v|^2 - 2 v.q + |q|^2
+            distances = self.norms[:self.size] - 2 * (vectors @ vector) + vector @ vector
+            excluded = exclude is not None and 0 <= exclude < len(self.rows) and self.rows[exclude] >= 0
+            if excluded:
+                distances[self.rows[exclude]] = np.inf
+            ids = self.ids[:self.size]
+
+        k = min(k, len(distances) - excluded)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind='stable')]
+
+        return ids[top], np.sqrt(np.maximum(distances[top], 0))
+
+
+    def __len__(self):
+        return self.size
+
+#====================================================================================
+# Process matrix
+#====================================================================================
+
+_matrix = None
+_synced_at = None
+_checked_at = 0
+_matrix_lock = threading.Lock()
+
+def feature_rows(updated_since=None):
+    """Yield batches of (track ids, raw features) of tracks with every similarity feature"""
+
+    columns = [getattr(Track, name) for name in SIMILARITY_FEATURES]
+    stmt = select(Track.id, *columns).where(*[column.isnot(None) for column in columns])
+    if updated_since is not None:
+        stmt = stmt.where(Track.features_updated_at >= updated_since)
+
+    with db.engine.connect() as conn:
+        result = conn.execution_options(yield_per=LOAD_BATCH_SIZE).execute(stmt)
+        for rows in result.partitions():
+            data = np.array(rows, dtype=np.float64)
+            yield data[:, 0].astype(np.int64), data[:, 1:]
+
+
+def snapshot_feature_rows():
+    """
+    Return ((track ids, raw features) of tracks in the catalog snapshot with every similarity feature,
+    db time the snapshot was read up to), or (None, None) if no snapshot was written
+    """
+
+    table, synced_at = catalog_snapshot.read_snapshot(['id', *SIMILARITY_FEATURES])
+    if table is None:
+        return None, None
+
+    data = np.column_stack([table[name].to_numpy(zero_copy_only=False) for name in ['id', *SIMILARITY_FEATURES]]).astype(np.float64)
+    data = data[~np.isnan(data).any(axis=1)]
+
+    return (data[:, 0].astype(np.int64), data[:, 1:]), synced_at
+
+
+def db_now():
+    """Return the db server's current time"""
+
+    with db.engine.connect() as conn:
+        return conn.execute(select(func.localtimestamp())).scalar()
+
+
+def get_feature_matrix():
+    """Return this process's feature matrix, built on first use and caught up with other processes"""
+
+    global _matrix, _synced_at, _checked_at
+
+    with _matrix_lock:
+        if _matrix is None:
+            start = time.perf_counter()
+            synced_at = db_now()
+            matrix = FeatureMatrix()
+            snapshot, snapshot_synced_at = snapshot_feature_rows() if FROM_SNAPSHOT else (None, None)
+            if snapshot is not None:
+                # Catch up with features saved since the snapshot
+                matrix.upsert(*snapshot)
+                for track_ids, features in feature_rows(snapshot_synced_at - REFRESH_OVERLAP):
+                    matrix.upsert(track_ids, features)
+            else:
+                for track_ids, features in feature_rows():
+                    matrix.upsert(track_ids, features)
+            _matrix, _synced_at, _checked_at = matrix, synced_at, time.time()
+            metrics.observe('feature_matrix.load', time.perf_counter() - start)
+            metrics.register_gauge('feature_matrix.rows', matrix.__len__)
+
+        elif time.time() - _checked_at >= FEATURE_MATRIX_REFRESH:
+            synced_at = db_now()
+            for track_ids, features in feature_rows(_synced_at - REFRESH_OVERLAP):
+                _matrix.upsert(track_ids, features)
+            _synced_at, _checked_at = synced_at, time.time()
+
+    return _matrix
+
+
+def add_track_features(rows):
+    """
+    Add rows of (track id, raw features in SIMILARITY_FEATURES order) just saved by this process
+    The matrix is only updated if it was already built
+    """
+
+    if _matrix is not None and rows:
+        track_ids = [row[0] for row in rows]
+        _matrix.upsert(track_ids, [row[1:] for row in rows])
+
+
+def similar_tracks(track_id, k=20):
+    """Return (track ids, distances) of the k tracks whose features are closest to a track's, or None if it has none"""
+
+    start = time.perf_counter()
+    matrix = get_feature_matrix()
+
+    vector = matrix.vector(track_id)
+    if vector is None:
+        return None
+
+    result = matrix.nearest(vector, k, exclude=track_id)
+    metrics.observe('feature_matrix.query', time.perf_counter() - start)
+
+    return result
@@ -0,0 +1,90 @@
+"""Import a user's whole library of saved Spotify tracks into the db
+
+The import runs as a background task, reading pages of saved tracks concurrently and saving them
+through process_tracks in batches, so audio features are fetched in bulk by the enrich_tracks task.
+The offset reached is saved after every batch: an import stopped by an expired token or a
+restarted worker resumes from there when it is started again
+"""
+
+import time
+from sqlalchemy.dialects.postgresql import insert
+from models import db, LibraryImport
+from spotify_query_parse import spotify_pages, process_tracks, INGEST_BATCH_SIZE
+import task_queue
+import metrics
+
+# Seconds without progress after which a queued or running import is assumed lost
+IMPORT_STALE_AFTER = task_queue.STALE_AFTER
+
+
+def start_library_import(username, headers):
+    """
+    Start a user's library import, or resume it from its last checkpoint
+    headers hold the user's bearer token and are kept in memory only
+    Return the LibraryImport
+    """
+
+    # Add the row if missing, then lock it: concurrent starts run one at a time, and the
+    # later ones return the import the first one queued
+    db.session.execute(insert(LibraryImport).values(username=username, status='queued', offset=0).on_conflict_do_nothing())
+    job = db.session.get(LibraryImport, username, with_for_update=True, populate_existing=True)
+
+    if job.updated_at and job.status in ('queued', 'running') and job.updated_at > time.time() - IMPORT_STALE_AFTER:
+        db.session.commit()
+        return job
+
+    if job.status == 'done':
+        # Import again from the start to pick up tracks saved since
+        job.offset = 0
+
+    job.status = 'queued'
+    job.error = None
+    job.started_at = job.updated_at = time.time()
+    job.finished_at = None
+    db.session.commit()
+
+    task_queue.enqueue('import_library', durable=False, username=username, headers=headers)
+
+    return job
+
+
+@task_queue.task('import_library')
+def import_library(username, headers):
+    """Import a user's saved tracks from the last checkpoint to the end of the library"""
+
+    job = db.session.get(LibraryImport, username)
+    job.status = 'running'
+    job.updated_at = time.time()
+    db.session.commit()
+
+    try:
+        batch = []
+        for page in spotify_pages('/me/tracks', offset=job.offset, headers=headers):
+            batch.extend(item['track'] for item in page['items'] if item['track'])
+            end = page['offset'] + len(page['items'])
+
+            if len(batch) >= INGEST_BATCH_SIZE or end >= page['total']:
+                process_tracks(batch)
+                metrics.incr('library_import.tracks', len(batch))
+                batch = []
+
+                job.offset = end
+                job.total = page['total']
+                job.updated_at = time.time()
+                db.session.commit()
+
+        # Library shrank while importing: save what is left
+        if batch:
+            process_tracks(batch)
+
+        job.status = 'done'
+        job.finished_at = time.time()
+        db.session.commit()
+
+    except Exception as e:
+        db.session.rollback()
+        job.status = 'failed'
+        job.error = str(e)
+        job.updated_at = time.time()
+        db.session.commit()
+        raise
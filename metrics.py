@@ -0,0 +1,60 @@
+"""In-process metrics for Tuttitracks
+Each gunicorn worker keeps its own counters: totals are the sum across workers
+"""
+
+import os
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timers = {}
+_gauges = {}
+
+#====================================================================================
+# Metric helpers
+#====================================================================================
+
+def incr(name, value=1):
+    """Increase a counter"""
+
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, seconds):
+    """Record a duration in seconds: keeps the count, total and max for the timer"""
+
+    with _lock:
+        timer = _timers.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timer['count'] += 1
+        timer['total'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+
+def register_gauge(name, func):
+    """Register a function returning the current value of a gauge, read on each snapshot"""
+
+    _gauges[name] = func
+
+
+def snapshot():
+    """Return the current metrics as a dictionary"""
+
+    with _lock:
+        counters = dict(_counters)
+        timers = {name: dict(timer) for name, timer in _timers.items()}
+
+    gauges = {}
+    for name, func in _gauges.items():
+        try:
+            gauges[name] = func()
+        except Exception:
+            gauges[name] = None
+
+    return {
+        "pid": os.getpid(),
+        "counters": counters,
+        "timers": timers,
+        "gauges": gauges
+    }
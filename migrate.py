@@ -0,0 +1,155 @@
+"""Upgrade an existing Tuttitracks database to the current schema
+
+New tables are created by db.create_all() when the app starts, but create_all does not
+change tables that already exist. Every step below is safe to run more than once
+
+Run with: python migrate.py
+"""
+
+from sqlalchemy import text
+from app import app
+from models import db
+
+#====================================================================================
+# Migration steps: (description, SQL)
+#====================================================================================
+
+MIGRATIONS = [
+    ("Merge duplicate tracks into the lowest track id", """
+        CREATE TEMP TABLE duplicate_tracks ON COMMIT DROP AS
+            SELECT id, keep_id FROM (
+                SELECT id, min(id) OVER (PARTITION BY spotify_track_id) AS keep_id FROM tracks
+            ) AS t WHERE id <> keep_id;
+        UPDATE playlists_tracks SET track_id = d.keep_id FROM duplicate_tracks d WHERE playlists_tracks.track_id = d.id;
+        INSERT INTO tracks_artists (track_id, artist_id)
+            SELECT d.keep_id, ta.artist_id FROM tracks_artists ta JOIN duplicate_tracks d ON ta.track_id = d.id
+            ON CONFLICT DO NOTHING;
+        DELETE FROM tracks_artists USING duplicate_tracks d WHERE tracks_artists.track_id = d.id;
+        INSERT INTO tracks_genres (track_id, genre_id)
+            SELECT d.keep_id, tg.genre_id FROM tracks_genres tg JOIN duplicate_tracks d ON tg.track_id = d.id
+            ON CONFLICT DO NOTHING;
+        DELETE FROM tracks_genres USING duplicate_tracks d WHERE tracks_genres.track_id = d.id;
+        DELETE FROM tracks USING duplicate_tracks d WHERE tracks.id = d.id;
+    """),
+    ("Merge duplicate albums into the lowest album id", """
+        CREATE TEMP TABLE duplicate_albums ON COMMIT DROP AS
+            SELECT id, keep_id FROM (
+                SELECT id, min(id) OVER (PARTITION BY spotify_album_id) AS keep_id FROM albums
+            ) AS a WHERE id <> keep_id;
+        UPDATE tracks SET album_id = d.keep_id FROM duplicate_albums d WHERE tracks.album_id = d.id;
+        DELETE FROM albums USING duplicate_albums d WHERE albums.id = d.id;
+    """),
+    ("Merge duplicate artists into the lowest artist id", """
+        CREATE TEMP TABLE duplicate_artists ON COMMIT DROP AS
+            SELECT id, keep_id FROM (
+                SELECT id, min(id) OVER (PARTITION BY spotify_artist_id) AS keep_id FROM artists
+            ) AS a WHERE id <> keep_id;
+        INSERT INTO tracks_artists (track_id, artist_id)
+            SELECT ta.track_id, d.keep_id FROM tracks_artists ta JOIN duplicate_artists d ON ta.artist_id = d.id
+            ON CONFLICT DO NOTHING;
+        DELETE FROM tracks_artists USING duplicate_artists d WHERE tracks_artists.artist_id = d.id;
+        DELETE FROM artists USING duplicate_artists d WHERE artists.id = d.id;
+    """),
+    ("Add unique indexes on Spotify ids", """
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_tracks_spotify_track_id ON tracks (spotify_track_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_albums_spotify_album_id ON albums (spotify_album_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_artists_spotify_artist_id ON artists (spotify_artist_id);
+    """),
+    ("Add covering index on playlists_tracks (playlist_id, index)", """
+        CREATE INDEX IF NOT EXISTS ix_playlists_tracks_playlist_id_index ON playlists_tracks (playlist_id, index) INCLUDE (track_id);
+    """),
+    ("Space playlist track keys for gapped ordering", """
+        ALTER TABLE playlists_tracks ALTER COLUMN index TYPE BIGINT;
+        UPDATE playlists_tracks SET index = ordered.position * 65536
+        FROM (
+            SELECT id, row_number() OVER (PARTITION BY playlist_id ORDER BY index, id) - 1 AS position
+            FROM playlists_tracks
+        ) AS ordered
+        WHERE playlists_tracks.id = ordered.id;
+    """),
+    ("Add last synced Spotify uris to playlists", """
+        ALTER TABLE playlists ADD COLUMN IF NOT EXISTS spotify_synced_uris JSON;
+    """),
+    ("Bound cache entries per cache", """
+        ALTER TABLE cache_entries ADD COLUMN IF NOT EXISTS cache_name TEXT NOT NULL DEFAULT 'responses';
+        DROP INDEX IF EXISTS ix_cache_entries_used_at;
+        CREATE INDEX IF NOT EXISTS ix_cache_entries_cache_name_used_at ON cache_entries (cache_name, used_at);
+    """),
+    ("Add local catalog search documents to tracks", """
+        ALTER TABLE tracks ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+        ALTER TABLE tracks ADD COLUMN IF NOT EXISTS search_text TEXT;
+        CREATE INDEX IF NOT EXISTS ix_tracks_search_vector ON tracks USING gin (search_vector);
+        UPDATE tracks SET search_vector = doc.vector, search_text = doc.text
+        FROM (
+            SELECT t.id,
+                setweight(to_tsvector('simple', t.name), 'A') ||
+                setweight(to_tsvector('simple', coalesce(string_agg(ar.name, ' '), '')), 'B') ||
+                setweight(to_tsvector('simple', coalesce(al.name, '')), 'C') ||
+                setweight(to_tsvector('simple', coalesce(t.lyrics, '')), 'D') AS vector,
+                lower(concat_ws(' ', t.name, string_agg(ar.name, ' '), al.name)) AS text
+            FROM tracks t
+            LEFT JOIN albums al ON al.id = t.album_id
+            LEFT JOIN tracks_artists ta ON ta.track_id = t.id
+            LEFT JOIN artists ar ON ar.id = ta.artist_id
+            GROUP BY t.id, al.name
+        ) AS doc
+        WHERE tracks.id = doc.id;
+    """),
+    ("Add trigram index for fuzzy catalog search where pg_trgm is available", """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                EXECUTE 'CREATE INDEX IF NOT EXISTS ix_tracks_search_text_trgm ON tracks USING gin (search_text gin_trgm_ops)';
+            END IF;
+        END
+        $$;
+    """),
+    ("Add audio features timestamp to tracks", """
+        ALTER TABLE tracks ADD COLUMN IF NOT EXISTS features_updated_at TIMESTAMP;
+        CREATE INDEX IF NOT EXISTS ix_tracks_features_updated_at ON tracks (features_updated_at);
+        UPDATE tracks SET features_updated_at = localtimestamp WHERE features_updated_at IS NULL AND tempo IS NOT NULL;
+    """),
+    ("Index track features for range queries", """
+        CREATE INDEX IF NOT EXISTS ix_tracks_acousticness ON tracks (acousticness);
+        CREATE INDEX IF NOT EXISTS ix_tracks_danceability ON tracks (danceability);
+        CREATE INDEX IF NOT EXISTS ix_tracks_energy ON tracks (energy);
+        CREATE INDEX IF NOT EXISTS ix_tracks_instrumentalness ON tracks (instrumentalness);
+        CREATE INDEX IF NOT EXISTS ix_tracks_liveness ON tracks (liveness);
+        CREATE INDEX IF NOT EXISTS ix_tracks_loudness ON tracks (loudness);
+        CREATE INDEX IF NOT EXISTS ix_tracks_speechiness ON tracks (speechiness);
+        CREATE INDEX IF NOT EXISTS ix_tracks_valence ON tracks (valence);
+        CREATE INDEX IF NOT EXISTS ix_tracks_tempo ON tracks (tempo);
+        CREATE INDEX IF NOT EXISTS ix_tracks_popularity ON tracks (popularity);
+        CREATE INDEX IF NOT EXISTS ix_tracks_release_year ON tracks (release_year);
+    """),
+    ("Merge duplicate mirrored playlists into the lowest playlist id", """
+        CREATE TEMP TABLE duplicate_playlists ON COMMIT DROP AS
+            SELECT id FROM (
+                SELECT id, min(id) OVER (PARTITION BY username, spotify_playlist_id) AS keep_id
+                FROM playlists WHERE spotify_playlist_id IS NOT NULL
+            ) AS p WHERE id <> keep_id;
+        DELETE FROM playlists_tracks USING duplicate_playlists d WHERE playlists_tracks.playlist_id = d.id;
+        DELETE FROM playlists USING duplicate_playlists d WHERE playlists.id = d.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_playlists_username_spotify_playlist_id ON playlists (username, spotify_playlist_id);
+    """),
+    ("Add skipped Spotify items flag to playlists", """
+        ALTER TABLE playlists ADD COLUMN IF NOT EXISTS spotify_items_skipped BOOLEAN NOT NULL DEFAULT false;
+    """),
+    ("Add worker heartbeat to task jobs", """
+        ALTER TABLE task_jobs ADD COLUMN IF NOT EXISTS heartbeat_at DOUBLE PRECISION;
+    """),
+]
+
+
+def migrate():
+    """Run every migration step in a single transaction"""
+
+    with db.engine.begin() as conn:
+        for description, sql in MIGRATIONS:
+            print(description)
+            conn.execute(text(sql))
+
+
+if __name__ == '__main__':
+    migrate()
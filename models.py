@@ -2,6 +2,7 @@
 
 import os
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from flask_bcrypt import Bcrypt
 from dotenv import load_dotenv
 
@@ -132,13 +133,24 @@ class User(db.Model):
 # Track Model
 #==================================================================================================
 
+# Track features filtered by range, each with a B-tree index
+TRACK_RANGE_FEATURES = [
+    'acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'loudness',
+    'speechiness', 'valence', 'tempo', 'popularity', 'release_year'
+]
+
 class Track(db.Model):
     """Model for music track class"""
 
     __tablename__ = 'tracks'
+    __table_args__ = (
+        db.Index('ix_tracks_search_vector', 'search_vector', postgresql_using='gin'),
+        # Feature range queries (track_query) combine these in bitmap index scans
+        *[db.Index(f'ix_tracks_{feature}', feature) for feature in TRACK_RANGE_FEATURES],
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    spotify_track_id = db.Column(db.Text, nullable=False)
+    spotify_track_id = db.Column(db.Text, nullable=False, unique=True, index=True)
     name = db.Column(db.Text, nullable=False)
     spotify_track_uri = db.Column(db.Text, nullable=False)
     release_year = db.Column(db.Integer, nullable=False)
@@ -161,8 +173,15 @@ class Track(db.Model):
     key = db.Column(db.Integer) # (0-11: 0=C, 1=D-flat/C-sharp, 11=B)
     time_signature = db.Column(db.Integer) # (number beats/measure)
 
+    # When the audio features were last saved, read by feature_matrix to catch up
+    features_updated_at = db.Column(db.DateTime, index=True)
+
     lyrics = db.Column(db.Text)
 
+    # Search document of the name, artists, album and lyrics, updated by catalog_search
+    search_vector = db.Column(TSVECTOR)
+    search_text = db.Column(db.Text)
+
     def __repr__(self):
         """Show info about a Track"""
 
@@ -199,11 +218,19 @@ class Playlist(db.Model):
     """Model for music track playlist class"""
 
     __tablename__ = 'playlists'
+    __table_args__ = (
+        # A user's Spotify playlist is mirrored to one local playlist
+        db.Index('ix_playlists_username_spotify_playlist_id', 'username', 'spotify_playlist_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(25), db.ForeignKey('users.username'), nullable=False)
     spotify_playlist_id = db.Column(db.Text)
     spotify_snapshot_id = db.Column(db.Text)
+    # Spotify uris of the tracks as of spotify_snapshot_id, the base for diff syncs
+    spotify_synced_uris = db.Column(db.JSON)
+    # Spotify items without a local track (local files, podcast episodes) were left out of spotify_synced_uris
+    spotify_items_skipped = db.Column(db.Boolean, nullable=False, default=False)
     image = db.Column(db.Text)
     public = db.Column(db.Boolean, default=True)
     collaborative = db.Column(db.Boolean, default=False)
@@ -264,13 +291,18 @@ class PlaylistTrack(db.Model):
     """Model joins playlists to tracks"""
 
     __tablename__ = 'playlists_tracks'
+    __table_args__ = (
+        # Playlist operations filter on playlist_id and range or sort on index
+        # Including track_id lets a playlist's tracks be read from the index alone
+        db.Index('ix_playlists_tracks_playlist_id_index', 'playlist_id', 'index', postgresql_include=['track_id']),
+    )
 
     # Playlists can have the same track in multiple slots
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id'), nullable=False)
     track_id = db.Column(db.Integer, db.ForeignKey('tracks.id'), nullable=False)
-    # Playlists need an order
-    index = db.Column(db.Integer, nullable=False)
+    # Playlists need an order: index is a sparse ordering key, see db_api_methods.INDEX_GAP
+    index = db.Column(db.BigInteger, nullable=False)
 
 
     def __repr__(self):
@@ -311,7 +343,7 @@ class Album(db.Model):
     __tablename__ = 'albums'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    spotify_album_id = db.Column(db.Text, nullable=False)
+    spotify_album_id = db.Column(db.Text, nullable=False, unique=True, index=True)
     name = db.Column(db.Text, nullable=False)
     image = db.Column(db.Text, nullable=False)
 
@@ -355,7 +387,7 @@ class Artist(db.Model):
     __tablename__ = 'artists'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    spotify_artist_id = db.Column(db.Text, nullable=False)
+    spotify_artist_id = db.Column(db.Text, nullable=False, unique=True, index=True)
     name = db.Column(db.Text, nullable=False)
 
     tracks = db.relationship('Track', secondary='tracks_artists', backref='artists')
@@ -459,4 +491,120 @@ class TrackGenre(db.Model):
     def __repr__(self):
         """Show info about track-genre relationship"""
 
-        return f"<TrackGenre {self.track_id} {self.genre_id}>"
\ No newline at end of file
+        return f"<TrackGenre {self.track_id} {self.genre_id}>"
+
+#==================================================================================================
+# Rate Limit Model
+#==================================================================================================
+class RateLimit(db.Model):
+    """Token bucket shared by all app workers to rate limit requests to Spotify"""
+
+    __tablename__ = 'rate_limits'
+
+    name = db.Column(db.Text, primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    # Times are epoch seconds
+    updated_at = db.Column(db.Float, nullable=False)
+    blocked_until = db.Column(db.Float, nullable=False, default=0)
+
+
+    def __repr__(self):
+        """Show info about rate limit bucket"""
+
+        return f"<RateLimit {self.name} {self.tokens} {self.updated_at} {self.blocked_until}>"
+
+#==================================================================================================
+# Task Job Model
+#==================================================================================================
+class TaskJob(db.Model):
+    """Background task saved so it survives a worker restart"""
+
+    __tablename__ = 'task_jobs'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.Text, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.Text, nullable=False, default='queued', index=True)
+    error = db.Column(db.Text)
+    # Times are epoch seconds
+    created_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float)
+    # Last time the worker running the task showed it was alive
+    heartbeat_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+
+
+    def __repr__(self):
+        """Show info about task job"""
+
+        return f"<TaskJob {self.id} {self.name} {self.status}>"
+
+#==================================================================================================
+# Library Import Model
+#==================================================================================================
+class LibraryImport(db.Model):
+    """Import of all of a user's saved Spotify tracks into the db, resumable from offset"""
+
+    __tablename__ = 'library_imports'
+
+    username = db.Column(db.String(25), db.ForeignKey('users.username', ondelete='CASCADE'), primary_key=True)
+    # queued, running, done or failed
+    status = db.Column(db.Text, nullable=False, default='queued')
+    # Saved tracks imported so far: the next run starts here
+    offset = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    # Times are epoch seconds
+    started_at = db.Column(db.Float)
+    updated_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+
+
+    def __repr__(self):
+        """Show info about library import"""
+
+        return f"<LibraryImport {self.username} {self.status} {self.offset} {self.total}>"
+
+
+    def serialize(self):
+        """Turn object into dictionary"""
+
+        return {
+            "username": self.username,
+            "status": self.status,
+            "offset": self.offset,
+            "total": self.total,
+            "error": self.error,
+            "started_at": self.started_at,
+            "updated_at": self.updated_at,
+            "finished_at": self.finished_at
+        }
+
+#==================================================================================================
+# Cache Entry Model
+#==================================================================================================
+class CacheEntry(db.Model):
+    """Cached response shared by all app workers when CACHE_BACKEND is 'db'"""
+
+    __tablename__ = 'cache_entries'
+    __table_args__ = (
+        # Least recently used entries of one cache are evicted first
+        db.Index('ix_cache_entries_cache_name_used_at', 'cache_name', 'used_at'),
+    )
+
+    key = db.Column(db.Text, primary_key=True)
+    # Caches are bounded separately, e.g. per user responses and shared search results
+    cache_name = db.Column(db.Text, nullable=False, default='responses')
+    # Entries of one namespace are invalidated together, e.g. all of a user's responses
+    namespace = db.Column(db.Text, nullable=False, index=True)
+    value = db.Column(db.JSON)
+    # Times are epoch seconds
+    expires_at = db.Column(db.Float, nullable=False)
+    used_at = db.Column(db.Float, nullable=False)
+
+
+    def __repr__(self):
+        """Show info about cache entry"""
+
+        return f"<CacheEntry {self.key} {self.expires_at}>"
@@ -0,0 +1,135 @@
+"""Mirror a user's Spotify playlists into local playlists
+
+Every Spotify playlist listed for a user is kept as a local Playlist with the same
+spotify_playlist_id, so it can be edited locally and synced back. Listing playlists is one request
+per page: the tracks of a playlist are only fetched again when the snapshot_id in the listing
+differs from the one saved locally, by a background task.
+A playlist with local changes not yet synced to Spotify is not refetched
+"""
+
+import threading
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Playlist, PlaylistTrack
+from db_api_methods import get_playlist_tracks, lock_playlist, playlist_written, INDEX_GAP
+from spotify_query_parse import spotify_paginate, process_tracks, INGEST_BATCH_SIZE
+import task_queue
+import metrics
+
+# Largest page Spotify returns for playlist items
+PLAYLIST_ITEMS_LIMIT = 100
+
+# Only the item fields process_tracks reads
+PLAYLIST_ITEMS_FIELDS = 'total,offset,next,items(track(id,type,name,popularity,uri,duration_ms,album(id,name,release_date,images),artists(id,name)))'
+
+# (playlist id, snapshot_id) of mirror tasks queued in this process
+_mirroring = set()
+_mirroring_lock = threading.Lock()
+
+
+def mirror_spotify_playlists(username, spotify_playlists, headers):
+    """
+    Save a page of Spotify playlist objects as local playlists of username
+    Queue a refetch of the tracks of playlists that are new or whose snapshot_id changed
+    headers hold the user's bearer token and are kept in memory only
+    Return a dict of local playlist id by spotify_playlist_id
+    """
+
+    if not spotify_playlists:
+        return {}
+
+    # Insert in key order, so concurrent listings of the same playlists can't deadlock
+    rows = sorted({playlist['id']: {
+        "username": username,
+        "spotify_playlist_id": playlist['id'],
+        "name": playlist['name'],
+        "description": playlist['description'],
+        "public": playlist['public'],
+        "collaborative": playlist['collaborative'],
+        "image": playlist['images'][0]['url'] if playlist['images'] else None
+    } for playlist in spotify_playlists}.values(), key=lambda row: row['spotify_playlist_id'])
+
+    # Concurrent listings of a new playlist update the row the first one inserted
+    stmt = insert(Playlist).values(rows)
+    stmt = stmt.on_conflict_do_update(index_elements=['username', 'spotify_playlist_id'], set_={
+        "name": stmt.excluded.name,
+        "description": stmt.excluded.description,
+        "public": stmt.excluded.public,
+        "collaborative": stmt.excluded.collaborative,
+        "image": func.coalesce(stmt.excluded.image, Playlist.image)
+    }).returning(Playlist.id, Playlist.spotify_playlist_id, Playlist.spotify_snapshot_id, Playlist.spotify_synced_uris)
+
+    local = {row.spotify_playlist_id: row for row in db.session.execute(stmt)}
+    db.session.commit()
+
+    changed = [(local[playlist['id']], playlist['snapshot_id']) for playlist in spotify_playlists
+        if local[playlist['id']].spotify_snapshot_id != playlist['snapshot_id']]
+
+    for playlist, snapshot_id in changed:
+        # Local edits not yet synced win: the next sync replaces the Spotify playlist
+        if locally_edited(playlist.id, playlist.spotify_synced_uris):
+            continue
+
+        with _mirroring_lock:
+            if (playlist.id, snapshot_id) in _mirroring:
+                continue
+            _mirroring.add((playlist.id, snapshot_id))
+
+        metrics.incr('playlist_mirror.refetched')
+        task_queue.enqueue('mirror_playlist_items', durable=False, playlist_id=playlist.id, snapshot_id=snapshot_id, headers=headers)
+
+    metrics.incr('playlist_mirror.unchanged', len(spotify_playlists) - len(changed))
+
+    return {spotify_id: playlist.id for spotify_id, playlist in local.items()}
+
+
+def locally_edited(playlist_id, synced_uris):
+    """
+    Return True if a playlist's tracks changed locally since it was last mirrored or synced
+    Without synced uris, e.g. before its first mirror, only a playlist with tracks counts as edited
+    """
+
+    return get_playlist_tracks(playlist_id) != (synced_uris if synced_uris is not None else [])
+
+
+@task_queue.task('mirror_playlist_items')
+def mirror_playlist_items(playlist_id, snapshot_id, headers):
+    """Replace the tracks of a local playlist with the items of its Spotify playlist"""
+
+    try:
+        playlist = db.session.get(Playlist, playlist_id)
+        url = f'/playlists/{playlist.spotify_playlist_id}/tracks?fields={PLAYLIST_ITEMS_FIELDS}'
+
+        items = list(spotify_paginate(url, limit=PLAYLIST_ITEMS_LIMIT, headers=headers))
+        # Local files and podcast episodes have no Spotify track to save
+        tracks = [item['track'] for item in items if item['track'] and item['track']['type'] == 'track' and item['track']['id']]
+
+        track_ids = []
+        for i in range(0, len(tracks), INGEST_BATCH_SIZE):
+            track_ids.extend(track['id'] for track in process_tracks(tracks[i:i + INGEST_BATCH_SIZE]))
+
+        # The playlist may have been edited locally while its items were fetched
+        lock_playlist(playlist_id)
+        if locally_edited(playlist_id, playlist.spotify_synced_uris):
+            db.session.rollback()
+            return
+
+        PlaylistTrack.query.filter(PlaylistTrack.playlist_id==playlist_id).delete()
+        if track_ids:
+            db.session.execute(insert(PlaylistTrack).values([{
+                "playlist_id": playlist_id,
+                "track_id": track_id,
+                "index": i * INDEX_GAP
+            } for i, track_id in enumerate(track_ids)]))
+
+        playlist.spotify_snapshot_id = snapshot_id
+        # The kept tracks are the base for spotting local edits. If items were left out, positions
+        # on Spotify don't match the local tracks, so the next sync replaces the Spotify playlist
+        playlist.spotify_synced_uris = [track['uri'] for track in tracks]
+        playlist.spotify_items_skipped = len(tracks) != len(items)
+        db.session.commit()
+        playlist_written(playlist_id)
+
+    finally:
+        with _mirroring_lock:
+            _mirroring.discard((playlist_id, snapshot_id))
@@ -0,0 +1,179 @@
+"""Order a playlist for smooth DJ style transitions
+
+Each track's key and mode are placed on the Camelot wheel: neighbouring numbers with the same
+letter, or the same number with the other letter, mix harmonically. The cost of playing one track
+after another adds the steps between their keys to their tempo difference, where half and double
+tempo match. The cheapest order is an open traveling salesman path over the matrix of costs:
+built nearest neighbour first, then improved by 2-opt moves until none helps or time runs out
+"""
+
+import os
+import time
+import numpy as np
+from sqlalchemy import text
+from models import db, Track, PlaylistTrack
+from db_api_methods import lock_playlist, playlist_written, INDEX_GAP
+import metrics
+
+# Seconds spent improving an order, bounding a request for a long playlist
+ORDER_TIME_LIMIT = float(os.environ.get('PLAYLIST_ORDER_TIME_LIMIT', 0.5))
+
+# Tempo difference costing as much as one step on the Camelot wheel
+TEMPO_STEP = 0.06
+
+# Cost of a key change from or to a track without a known key
+UNKNOWN_KEY_COST = 2.0
+
+#====================================================================================
+# Transition costs
+#====================================================================================
+
+def camelot_numbers(keys, modes):
+    """
+    Return (numbers 1-12, letters 0 for A minor or 1 for B major) of Spotify keys and modes
+    Unknown keys, -1 or None, have number 0
+    """
+
+    keys = np.array([-1 if key is None else key for key in keys], dtype=np.int64)
+    modes = np.array([-1 if mode is None else mode for mode in modes], dtype=np.int64)
+
+    # C major is 8B and each fifth up is one step clockwise, A minor shares 8 with C major
+    numbers = np.where(modes == 1, (7 * keys + 7) % 12, (7 * keys + 4) % 12) + 1
+    known = (keys >= 0) & (modes >= 0)
+
+    return np.where(known, numbers, 0), np.where(known, modes, -1)
+
+
+def camelot_code(key, mode):
+    """Return the Camelot code of a Spotify key and mode, e.g. 8B for C major, or None"""
+
+    numbers, letters = camelot_numbers([key], [mode])
+    if not numbers[0]:
+        return None
+
+    return f"{numbers[0]}{'B' if letters[0] else 'A'}"
+
+
+def transition_costs(keys, modes, tempos):
+    """Return the matrix of costs of playing track i then track j"""
+
+    numbers, letters = camelot_numbers(keys, modes)
+    steps = np.abs(numbers[:, None] - numbers[None, :])
+    steps = np.minimum(steps, 12 - steps) + (letters[:, None] != letters[None, :])
+    known = numbers > 0
+    key_costs = np.where(known[:, None] & known[None, :], steps, UNKNOWN_KEY_COST)
+
+    tempos = np.array([np.nan if tempo is None or tempo <= 0 else tempo for tempo in tempos], dtype=np.float64)
+    octaves = np.abs(np.log2(tempos[:, None] / tempos[None, :])) % 1
+    # Relative tempo change to the nearest of the same, half or double tempo
+    tempo_costs = np.exp2(np.minimum(octaves, 1 - octaves)) - 1
+    tempo_costs = np.nan_to_num(tempo_costs, nan=0.0) / TEMPO_STEP
+
+    return (key_costs + tempo_costs).astype(np.float32)
+
+
+def path_cost(costs, order):
+    """Return the total cost of the transitions of an order"""
+
+    order = np.asarray(order)
+    return float(costs[order[:-1], order[1:]].sum())
+
+#====================================================================================
+# Ordering
+#====================================================================================
+
+def nearest_neighbour_path(costs, start=0):
+    """Return an order starting at start that always plays the cheapest next track"""
+
+    n = len(costs)
+    played = np.zeros(n, dtype=bool)
+    order = [start]
+    played[start] = True
+
+    for i in range(n - 1):
+        row = np.where(played, np.inf, costs[order[-1]])
+        order.append(int(row.argmin()))
+        played[order[-1]] = True
+
+    return order
+
+
+def two_opt(costs, tour, deadline):
+    """
+    Improve a closed tour by reversing the segment between two transitions while that makes it cheaper
+    For each first transition the best second one is found for every position at once
+    """
+
+    tour = np.asarray(tour)
+    n = len(tour)
+    improved = True
+
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(n - 2):
+            a, b = tour[i], tour[i + 1]
+            c = tour[i + 2:]
+            d = np.roll(tour, -1)[i + 2:]
+            gains = costs[a, b] + costs[c, d] - costs[a, c] - costs[b, d]
+            if i == 0:
+                # The last transition returns to a, reversing up to it changes nothing
+                gains[-1] = 0
+            j = int(gains.argmax())
+            if gains[j] > 1e-6:
+                tour[i + 1:i + j + 3] = tour[i + 1:i + j + 3][::-1].copy()
+                improved = True
+            if time.perf_counter() >= deadline:
+                break
+
+    return tour
+
+
+def order_tracks(costs, time_limit=ORDER_TIME_LIMIT):
+    """Return an order of the tracks of a cost matrix with cheap transitions, starting from track 0"""
+
+    n = len(costs)
+    if n < 3:
+        return list(range(n))
+
+    deadline = time.perf_counter() + time_limit
+
+    # A free extra stop closes the path into a tour, so either end of the path can change
+    tour_costs = np.zeros((n + 1, n + 1), dtype=np.float32)
+    tour_costs[:n, :n] = costs
+    tour = [n] + nearest_neighbour_path(costs)
+    tour = two_opt(tour_costs, tour, deadline)
+
+    return [int(track) for track in tour[1:]]
+
+
+def order_playlist(playlist_id, time_limit=ORDER_TIME_LIMIT):
+    """
+    Reorder the tracks of a local playlist for smooth key and tempo transitions
+    Every track gets its new key in one UPDATE statement
+    Return the playlist's rows of (id, track id, name, key, mode, tempo) in their new order
+    """
+
+    start = time.perf_counter()
+    lock_playlist(playlist_id)
+
+    rows = db.session.query(
+        PlaylistTrack.id, PlaylistTrack.track_id, Track.name, Track.key, Track.mode, Track.tempo
+    ).join(Track, Track.id == PlaylistTrack.track_id).filter(
+        PlaylistTrack.playlist_id == playlist_id
+    ).order_by(PlaylistTrack.index, PlaylistTrack.id).all()
+
+    costs = transition_costs([row.key for row in rows], [row.mode for row in rows], [row.tempo for row in rows])
+    order = order_tracks(costs, time_limit)
+    rows = [rows[i] for i in order]
+
+    db.session.execute(text("""
+        UPDATE playlists_tracks SET index = (new.position - 1) * :gap
+        FROM unnest(CAST(:ids AS integer[])) WITH ORDINALITY AS new(id, position)
+        WHERE playlists_tracks.id = new.id
+    """), {"ids": [row.id for row in rows], "gap": INDEX_GAP})
+    db.session.commit()
+    playlist_written(playlist_id)
+
+    metrics.observe('playlist_order.order', time.perf_counter() - start)
+
+    return rows
@@ -0,0 +1,237 @@
+"""Sync local playlists to Spotify with the fewest playlist requests
+
+The uris last written to Spotify are saved on the playlist with the snapshot_id Spotify returned.
+When the playlist on Spotify still has that snapshot_id, only the difference between the saved
+uris and the local tracks is sent: removals, moves of whole runs of tracks, then insertions.
+Otherwise, or when the difference costs more requests than rewriting the playlist, all items are replaced
+"""
+
+from collections import Counter
+from models import Playlist
+from db_api_methods import get_playlist_tracks, playlist_written
+from spotify_playlist import create_spotify_playlist, add_tracks_to_spotify_playlist, replace_spotify_playlist_items, reorder_spotify_playlist_items, delete_tracks_from_spotify_playlist, get_spotify_playlist_snapshot_id
+import metrics
+
+# Maximum uris Spotify accepts in one add, replace or remove request
+SPOTIFY_ITEMS_LIMIT = 100
+
+#==================================================================================================
+# Sync planning
+#==================================================================================================
+
+def chunk_list(items, size=SPOTIFY_ITEMS_LIMIT):
+    """Split a list into lists of at most size items"""
+
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def replace_cost(new_uris):
+    """Number of requests needed to replace every item of a playlist with new_uris"""
+
+    return max(1, len(chunk_list(new_uris)))
+
+
+def number_occurrences(uris):
+    """Pair every uri with its occurrence number so repeated tracks can be told apart"""
+
+    seen = Counter()
+    numbered = []
+    for uri in uris:
+        numbered.append((uri, seen[uri]))
+        seen[uri] += 1
+
+    return numbered
+
+
+def plan_playlist_sync(old_uris, new_uris):
+    """
+    Plan the Spotify requests turning a playlist of old_uris into new_uris
+
+    Return a list of operations, applied in order:
+        ('remove', [uri, ...])                               every occurrence of each uri
+        ('reorder', range_start, insert_before, range_length)
+        ('add', position, [uri, ...])
+    Return None when replacing all items takes fewer requests
+    """
+
+    old_count = Counter(old_uris)
+    new_count = Counter(new_uris)
+
+    # Spotify removes every occurrence of a uri, so a uri losing any occurrence is removed
+    # entirely and its remaining occurrences are added back
+    removed = [uri for uri in old_count if old_count[uri] > new_count[uri]]
+    removed_set = set(removed)
+
+    kept_old = number_occurrences([uri for uri in old_uris if uri not in removed_set])
+    kept_count = Counter(uri for uri, n in kept_old)
+
+    # Tracks of new_uris that are already on Spotify, and the positions that must be added
+    kept_new = []
+    added = []
+    for position, (uri, n) in enumerate(number_occurrences(new_uris)):
+        if n < kept_count[uri]:
+            kept_new.append((uri, n))
+        else:
+            added.append(position)
+
+    # Group added positions into runs of consecutive positions
+    runs = []
+    for position in added:
+        if runs and runs[-1][0] + len(runs[-1][1]) == position:
+            runs[-1][1].append(new_uris[position])
+        else:
+            runs.append((position, [new_uris[position]]))
+
+    add_ops = []
+    for position, uris in runs:
+        for i, chunk in enumerate(chunk_list(uris)):
+            add_ops.append(('add', position + i * SPOTIFY_ITEMS_LIMIT, chunk))
+
+    remove_ops = [('remove', chunk) for chunk in chunk_list(removed)]
+
+    budget = replace_cost(new_uris) - len(remove_ops) - len(add_ops)
+    if budget < 0:
+        return None
+
+    reorder_ops = plan_reorders(kept_old, kept_new, budget)
+    if reorder_ops is None:
+        return None
+
+    return remove_ops + reorder_ops + add_ops
+
+
+def plan_reorders(current, target, budget):
+    """
+    Plan moves turning the list current into the list target, which hold the same items
+    Each move takes the longest run of items already in target order
+    Return None if more than budget moves are needed
+    """
+
+    current = list(current)
+    ops = []
+    i = 0
+
+    while i < len(target):
+        if current[i] == target[i]:
+            i += 1
+            continue
+
+        if len(ops) == budget:
+            return None
+
+        start = current.index(target[i], i + 1)
+        length = 1
+        while start + length < len(current) and i + length < len(target) and current[start + length] == target[i + length]:
+            length += 1
+
+        ops.append(('reorder', start, i, length))
+        current[i:i] = current[start:start + length]
+        del current[start + length:start + 2 * length]
+        i += length
+
+    return ops
+
+
+def apply_operation(uris, op):
+    """Return the uris of a playlist after Spotify applies op"""
+
+    if op[0] == 'remove':
+        removed = set(op[1])
+        return [uri for uri in uris if uri not in removed]
+
+    if op[0] == 'reorder':
+        __, start, before, length = op
+        moved = uris[start:start + length]
+        rest = uris[:start] + uris[start + length:]
+        if before > start:
+            before -= length
+        return rest[:before] + moved + rest[before:]
+
+    __, position, added = op
+    return uris[:position] + added + uris[position:]
+
+#==================================================================================================
+# Sync execution
+#==================================================================================================
+
+def sync_playlist_to_spotify(playlist_id):
+    """
+    Create or update the Spotify copy of a local playlist of any size
+    Return the number of Spotify playlist requests sent: at most one per 100 tracks, plus two
+    """
+
+    playlist = Playlist.query.get_or_404(playlist_id)
+    new_uris = get_playlist_tracks(playlist_id)
+    requests_sent = 0
+
+    if not playlist.spotify_playlist_id:
+        create_spotify_playlist(playlist_id)
+        requests_sent += 1
+        plan = plan_playlist_sync([], new_uris)
+    elif playlist.spotify_synced_uris is None or playlist.spotify_items_skipped:
+        plan = None
+    else:
+        requests_sent += 1
+        if get_spotify_playlist_snapshot_id(playlist.spotify_playlist_id) == playlist.spotify_snapshot_id:
+            plan = plan_playlist_sync(playlist.spotify_synced_uris, new_uris)
+        else:
+            # Playlist changed on Spotify since the last sync: the saved uris can't be trusted
+            plan = None
+
+    if plan is None:
+        requests_sent += replace_playlist(playlist, new_uris)
+        metrics.incr('playlist_sync.replaced')
+    else:
+        requests_sent += apply_plan(playlist, plan, new_uris)
+        metrics.incr('playlist_sync.diffed')
+
+    metrics.incr('playlist_sync.requests', requests_sent)
+    playlist_written(playlist_id)
+
+    return requests_sent
+
+
+def replace_playlist(playlist, uris):
+    """
+    Replace every item of a Spotify playlist with any number of uris. Return the requests sent
+
+    The first 100 uris replace the items, the rest are appended 100 at a time in order.
+    The uris on Spotify are saved after every chunk, so if a chunk fails the next sync
+    resumes from the last chunk sent instead of starting over
+    """
+
+    chunks = chunk_list(uris) or [[]]
+    replace_spotify_playlist_items(playlist.spotify_playlist_id, chunks[0])
+    sent = len(chunks[0])
+
+    for chunk in chunks[1:]:
+        sent += len(chunk)
+        add_tracks_to_spotify_playlist(playlist.spotify_playlist_id, chunk, synced_uris=uris[:sent])
+
+    return len(chunks)
+
+
+def apply_plan(playlist, plan, uris):
+    """
+    Send a planned list of operations to Spotify in order. Return the requests sent
+    The snapshot_id returned by each request is passed to the next, and the uris on Spotify
+    are saved after every request so a failed sync resumes where it stopped
+    """
+
+    spotify_playlist_id = playlist.spotify_playlist_id
+    snapshot_id = playlist.spotify_snapshot_id
+    synced_uris = playlist.spotify_synced_uris
+
+    for op in plan:
+        synced_uris = apply_operation(synced_uris, op)
+
+        if op[0] == 'remove':
+            snapshot_id = delete_tracks_from_spotify_playlist(spotify_playlist_id, [{"uri": uri} for uri in op[1]], snapshot_id, synced_uris)
+        elif op[0] == 'reorder':
+            __, start, before, length = op
+            snapshot_id = reorder_spotify_playlist_items(spotify_playlist_id, start, before, length, snapshot_id, synced_uris)
+        else:
+            __, position, added = op
+            snapshot_id = add_tracks_to_spotify_playlist(spotify_playlist_id, added, position, synced_uris)
+
+    return len(plan)
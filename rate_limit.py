@@ -0,0 +1,134 @@
+"""Token bucket rate limiter for Spotify requests, shared by all workers through the database"""
+
+import os
+import time
+import random
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from models import db, RateLimit
+import metrics
+
+# Sustained requests per second and burst size allowed across all workers
+RATE = float(os.environ.get('SPOTIFY_RATE_LIMIT', 10))
+BURST = float(os.environ.get('SPOTIFY_RATE_BURST', 20))
+
+# Maximum random seconds added to a wait so workers don't all wake at once
+MAX_JITTER = float(os.environ.get('SPOTIFY_RATE_JITTER', 0.5))
+
+# Most seconds one request waits for the limiter and Retry-After periods, well under the gunicorn timeout
+MAX_WAIT = float(os.environ.get('SPOTIFY_MAX_WAIT', 5))
+
+SPOTIFY_BUCKET = 'spotify'
+
+
+
+class RateLimited(Exception):
+    """Spotify asked for, or the limiter needs, a longer wait than a request may spend"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Spotify rate limit exceeded: retry after {retry_after:g} seconds")
+        self.retry_after = retry_after
+
+#====================================================================================
+# Rate limit helpers
+#====================================================================================
+
+def _reserve(name, now):
+    """Take a token from the bucket and return (tokens left, blocked_until)
+    tokens left is negative when the token is borrowed from the future: the caller waits for it
+    Return None if the bucket does not exist yet
+    """
+
+    bucket = RateLimit.__table__
+    elapsed = func.greatest(now - bucket.c.updated_at, 0)
+    tokens = func.least(bucket.c.tokens + elapsed * RATE, BURST) - 1
+
+    stmt = bucket.update().where(bucket.c.name == name).values(
+        tokens=tokens,
+        updated_at=func.greatest(bucket.c.updated_at, now)
+    ).returning(bucket.c.tokens, bucket.c.blocked_until)
+
+    with db.engine.begin() as conn:
+        return conn.execute(stmt).first()
+
+
+def _create_bucket(name, now):
+    """Create a full bucket. Another worker may create it first"""
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(RateLimit.__table__.insert().values(name=name, tokens=BURST, updated_at=now, blocked_until=0))
+    except IntegrityError:
+        pass
+
+
+def _refund(name):
+    """Give back a token taken by a request that won't be sent"""
+
+    bucket = RateLimit.__table__
+    with db.engine.begin() as conn:
+        conn.execute(bucket.update().where(bucket.c.name == name).values(tokens=bucket.c.tokens + 1))
+
+
+def acquire(name=SPOTIFY_BUCKET, max_wait=None):
+    """Wait until a request may be sent. Requests queue here rather than fail
+    Raise RateLimited, without waiting, if the wait would be longer than max_wait seconds
+    Return the number of seconds spent waiting
+    """
+
+    now = time.time()
+    try:
+        row = _reserve(name, now)
+        if row is None:
+            _create_bucket(name, now)
+            row = _reserve(name, now)
+    except SQLAlchemyError:
+        # Never fail a request because the limiter is unavailable
+        metrics.incr('rate_limit.errors')
+        return 0
+
+    tokens, blocked_until = row
+    wait = max(-tokens / RATE, blocked_until - now, 0)
+    if blocked_until > now:
+        wait += random.uniform(0, MAX_JITTER)
+
+    if max_wait is not None and wait > max_wait:
+        metrics.incr('rate_limit.gave_up')
+        try:
+            _refund(name)
+        except SQLAlchemyError:
+            metrics.incr('rate_limit.errors')
+        raise RateLimited(wait)
+
+    if wait > 0:
+        metrics.incr('rate_limit.throttled')
+        metrics.observe('rate_limit.throttled_seconds', wait)
+        time.sleep(wait)
+
+    return wait
+
+
+def block(seconds, name=SPOTIFY_BUCKET):
+    """Pause all workers for a number of seconds, e.g. from a Retry-After header"""
+
+    bucket = RateLimit.__table__
+    until = time.time() + seconds
+    stmt = bucket.update().where(bucket.c.name == name).values(blocked_until=func.greatest(bucket.c.blocked_until, until))
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+    except SQLAlchemyError:
+        metrics.incr('rate_limit.errors')
+        time.sleep(min(seconds, MAX_WAIT))
+
+
+def retry_after(response, attempt, base_delay=1):
+    """Seconds to wait before retrying a 429 response
+    Use the Retry-After header if provided, else back off exponentially
+    """
+
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return base_delay * 2 ** attempt
@@ -176,6 +176,7 @@ test_track_1 = Track(
     mode=TEST_TRACK_1['mode'],
     key=TEST_TRACK_1['key'],
     time_signature=TEST_TRACK_1['time_signature'],
+    features_updated_at=db.func.localtimestamp(),
     lyrics=TEST_TRACK_1['lyrics']
 )
 test_track_2 = Track(
@@ -199,6 +200,7 @@ test_track_2 = Track(
     mode=TEST_TRACK_2['mode'],
     key=TEST_TRACK_2['key'],
     time_signature=TEST_TRACK_2['time_signature'],
+    features_updated_at=db.func.localtimestamp(),
     lyrics=TEST_TRACK_2['lyrics']
 )
 
@@ -223,6 +225,7 @@ test_track_3 = Track(
     mode=TEST_TRACK_3['mode'],
     key=TEST_TRACK_3['key'],
     time_signature=TEST_TRACK_3['time_signature'],
+    features_updated_at=db.func.localtimestamp(),
     lyrics=TEST_TRACK_3['lyrics']
 )
 
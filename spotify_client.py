@@ -0,0 +1,145 @@
+"""Pooled HTTP client for the Spotify Web API and Spotify accounts service"""
+
+import os
+import time
+import threading
+import importlib.util
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import rate_limit
+from rate_limit import RateLimited
+import metrics
+
+load_dotenv()
+
+# httpx (with the h2 package) is optional: when installed, calls go out over HTTP/2
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Connection pool settings, per gunicorn worker process
+POOL_CONNECTIONS = int(os.environ.get('SPOTIFY_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('SPOTIFY_POOL_MAXSIZE', 10))
+KEEPALIVE_EXPIRY = float(os.environ.get('SPOTIFY_KEEPALIVE_EXPIRY', 60))
+
+# Timeouts in seconds: (time to connect, time to wait for a response)
+CONNECT_TIMEOUT = float(os.environ.get('SPOTIFY_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('SPOTIFY_READ_TIMEOUT', 10))
+
+# Requests to the Web API share the rate limiter. A 429 is retried up to this many times
+API_URL = 'https://api.spotify.com/'
+MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 5))
+
+USE_HTTP2 = httpx is not None and importlib.util.find_spec('h2') is not None and os.environ.get('SPOTIFY_HTTP2', 'true').lower() != 'false'
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+#====================================================================================
+# Client helpers
+#====================================================================================
+
+def _create_client():
+    """Create a keep-alive client with a bounded connection pool"""
+
+    if USE_HTTP2:
+        return httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+                max_keepalive_connections=POOL_MAXSIZE,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+        )
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_client():
+    """Return this process's pooled client, creating it on first use
+    gunicorn forks workers after the app is imported, so a client inherited from the parent process is replaced
+    """
+
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = _create_client()
+                _client_pid = os.getpid()
+
+    return _client
+
+
+def request(verb, url, headers=None, data=None, params=None):
+    """Send a request over the pooled connection and return the response
+    data may be a dict of form fields or an already encoded JSON string
+
+    Web API requests wait for the shared rate limiter. On a 429, all workers pause for the
+    Retry-After period and the request is retried
+    A request waits at most rate_limit.MAX_WAIT seconds in all, so a worker never blocks past its
+    timeout. Raise RateLimited when a longer wait is needed or the last retry is answered with a 429
+    """
+
+    limited = url.startswith(API_URL)
+    waited = 0
+
+    for attempt in range(MAX_RETRIES + 1):
+        if limited:
+            waited += rate_limit.acquire(max_wait=rate_limit.MAX_WAIT - waited)
+
+        r = _send(verb, url, headers, data, params)
+        metrics.incr('spotify.requests')
+
+        if r.status_code != 429:
+            return r
+
+        metrics.incr('spotify.rate_limited')
+        delay = rate_limit.retry_after(r, attempt)
+        if limited:
+            # Other workers pause too, even when this request gives up
+            rate_limit.block(delay)
+
+        if attempt == MAX_RETRIES or waited + delay > rate_limit.MAX_WAIT:
+            raise RateLimited(delay)
+
+        if limited:
+            # The next acquire waits out the block
+            continue
+
+        metrics.observe('rate_limit.throttled_seconds', delay)
+        time.sleep(delay)
+        waited += delay
+
+
+def _send(verb, url, headers, data, params):
+    """Send one request with the pooled client"""
+
+    client = get_client()
+
+    if USE_HTTP2:
+        if isinstance(data, (str, bytes)):
+            return client.request(verb, url, headers=headers, content=data, params=params)
+        return client.request(verb, url, headers=headers, data=data, params=params)
+
+    return client.request(verb, url, headers=headers, data=data, params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+
+
+def get(url, headers=None, params=None):
+    """GET request over the pooled connection"""
+
+    return request('GET', url, headers=headers, params=params)
+
+
+def post(url, headers=None, data=None):
+    """POST request over the pooled connection"""
+
+    return request('POST', url, headers=headers, data=data)
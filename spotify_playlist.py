@@ -3,7 +3,7 @@
 import json
 from models import Playlist
 from flask import g
-from spotify_query_parse import spotify_request
+from spotify_query_parse import spotify_request, spotify_paginate
 
 #==================================================================================================
 # Spotify Playlist CRUD Methods
@@ -17,6 +17,12 @@ def get_spotify_playlists(limit=20, offset=0):
     return r.json()
 
 
+def iter_spotify_playlists(max_items=None):
+    """Return an iterator over all of the current user's playlists, fetching pages as needed"""
+
+    return spotify_paginate('/me/playlists', max_items=max_items)
+
+
 def create_spotify_playlist(playlist_id):
     """Create a new playlist on Spotify server from local playlist id"""
 
@@ -34,6 +40,7 @@ def create_spotify_playlist(playlist_id):
     #Update local playlist object with spotify_playlist_id and image if available
     playlist.spotify_playlist_id = r.json()['id']
     playlist.spotify_snapshot_id = r.json()['snapshot_id']
+    playlist.spotify_synced_uris = []
     if r.json()['images']:
         playlist.image = r.json()['images'][0]['url']
     Playlist.update()
@@ -41,7 +48,7 @@ def create_spotify_playlist(playlist_id):
     return playlist
 
 
-def add_tracks_to_spotify_playlist(spotify_playlist_id, spotify_uri_list=[], position=None):
+def add_tracks_to_spotify_playlist(spotify_playlist_id, spotify_uri_list=[], position=None, synced_uris=None):
     """
     Add tracks to an existing Spotify playlist
 
@@ -49,6 +56,7 @@ def add_tracks_to_spotify_playlist(spotify_playlist_id, spotify_uri_list=[], pos
     ["spotify:track:0wipEzrv6p17BPiVCKATIE", "spotify:track:2Amj13n8K8JRaSNXh2C10G", ...]
 
     Optional position arg is 0 based index of where to insert uris. Default is to append.
+    Optional synced_uris is the full list of uris on Spotify after this change, saved as the base of the next sync
 
     Returns snapshot_id of playlist
     """
@@ -60,11 +68,7 @@ def add_tracks_to_spotify_playlist(spotify_playlist_id, spotify_uri_list=[], pos
 
     r = spotify_request('POST', f'/playlists/{spotify_playlist_id}/tracks', data=json.dumps(data))
 
-    playlist = Playlist.query.filter(Playlist.spotify_playlist_id==spotify_playlist_id)
-    playlist.spotify_snapshot_id = r.json()['snapshot_id']
-    Playlist.update()
-
-    return playlist
+    return save_snapshot_id(spotify_playlist_id, r, synced_uris)
 
 
 def replace_spotify_playlist_items(spotify_playlist_id, spotify_uri_list=[]):
@@ -85,11 +89,28 @@ def replace_spotify_playlist_items(spotify_playlist_id, spotify_uri_list=[]):
 
     r = spotify_request('PUT', f'/playlists/{spotify_playlist_id}/tracks', data=json.dumps(data))
 
-    playlist = Playlist.query.filter(Playlist.spotify_playlist_id==spotify_playlist_id)
-    playlist.spotify_snapshot_id = r.json()['snapshot_id']
-    Playlist.update()
+    return save_snapshot_id(spotify_playlist_id, r, synced_uris=spotify_uri_list)
 
-    return playlist
+
+def reorder_spotify_playlist_items(spotify_playlist_id, range_start, insert_before, range_length=1, snapshot_id=None, synced_uris=None):
+    """
+    Move range_length tracks starting at range_start to before the track at insert_before
+    Positions are 0 based and refer to the playlist before the move
+    Optional synced_uris is the full list of uris on Spotify after this change, saved as the base of the next sync
+
+    Returns the snapshot_id of the playlist
+    """
+
+    data = {
+        "range_start": range_start,
+        "insert_before": insert_before,
+        "range_length": range_length,
+        "snapshot_id": snapshot_id #Optional, playlist version the positions refer to
+    }
+
+    r = spotify_request('PUT', f'/playlists/{spotify_playlist_id}/tracks', data=json.dumps(data))
+
+    return save_snapshot_id(spotify_playlist_id, r, synced_uris)
 
 
 def update_spotify_playlist_details(spotify_playlist_id, name, description, public, collaborative):
@@ -110,25 +131,51 @@ def update_spotify_playlist_details(spotify_playlist_id, name, description, publ
     return r.status_code
 
 
-def delete_tracks_from_spotify_playlist(spotify_playlist_id, spotify_uri_list=[]):
+def delete_tracks_from_spotify_playlist(spotify_playlist_id, spotify_uri_list=[], snapshot_id=None, synced_uris=None):
     """
     Delete tracks from a spotify playlist
+    Every occurrence of each uri is removed
 
     Given a list of spotify_uris to remove in the following form. Max: 100 uris
     [{"uri":"spotify:track:0wipEzrv6p17BPiVCKATIE"}, {"uri:"spotify:track:2Amj13n8K8JRaSNXh2C10G"}, ...]
+    Optional synced_uris is the full list of uris on Spotify after this change, saved as the base of the next sync
 
     Returns snapshot_id of playlist
     """
 
     data = {
-        "tracks": spotify_uri_list
+        "tracks": spotify_uri_list,
+        "snapshot_id": snapshot_id #Optional, playlist version to delete from
     }
 
 
     r = spotify_request('DELETE', f'/playlists/{spotify_playlist_id}/tracks', data=json.dumps(data))
 
-    playlist = Playlist.query.filter(Playlist.spotify_playlist_id==spotify_playlist_id)
-    playlist.spotify_snapshot_id = r.json()['snapshot_id']
-    Playlist.update()
+    return save_snapshot_id(spotify_playlist_id, r, synced_uris)
+
+
+def get_spotify_playlist_snapshot_id(spotify_playlist_id):
+    """Return the current snapshot_id of a Spotify playlist"""
+
+    r = spotify_request('GET', f'/playlists/{spotify_playlist_id}?fields=snapshot_id')
+
+    return r.json()['snapshot_id']
+
+
+def save_snapshot_id(spotify_playlist_id, r, synced_uris=None):
+    """Save the snapshot_id returned by a playlist change to the local playlist and return it
+    synced_uris is the full list of uris now on Spotify, when known. None forces the next sync to replace all items
+    """
+
+    r.raise_for_status()
+    snapshot_id = r.json()['snapshot_id']
+
+    playlist = Playlist.query.filter(Playlist.spotify_playlist_id==spotify_playlist_id).first()
+    if playlist:
+        playlist.spotify_snapshot_id = snapshot_id
+        playlist.spotify_synced_uris = synced_uris
+        # Spotify now holds only the local tracks
+        playlist.spotify_items_skipped = False
+        Playlist.update()
 
-    return playlist
\ No newline at end of file
+    return snapshot_id
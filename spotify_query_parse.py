@@ -1,11 +1,49 @@
 """Spotify Query and Parse Functions"""
 
+import os
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from models import db, Track, Album, Artist, TrackArtist
-from auth import refresh_token
-from flask import flash, redirect, g
-import requests
+from auth import refresh_user_token, token_expiring, get_client_headers
+from flask import flash, redirect, g, session, current_app
+from sqlalchemy import update, values, column, func, Text, Float, Integer
+from sqlalchemy.dialects.postgresql import insert
+import spotify_client
+import task_queue
+import cache
+from catalog_search import update_search_documents
+from feature_matrix import add_track_features, SIMILARITY_FEATURES
+import ann_index
 from app import BASE_URL
 
+# Maximum Spotify requests sent at once by one app request
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('SPOTIFY_MAX_CONCURRENT_REQUESTS', 4))
+
+# Spotify accepts at most 100 ids per /audio-features request
+AUDIO_FEATURES_LIMIT = 100
+
+# Largest page Spotify returns for saved tracks, top tracks and playlists
+PAGE_LIMIT = 50
+
+# Tracks saved to the db per transaction when ingesting a whole library
+INGEST_BATCH_SIZE = 500
+
+# Audio feature columns of Track with their types
+AUDIO_FEATURES = {
+    "acousticness": Float,
+    "danceability": Float,
+    "energy": Float,
+    "tempo": Float,
+    "instrumentalness": Float,
+    "liveness": Float,
+    "loudness": Float,
+    "speechiness": Float,
+    "valence": Float,
+    "mode": Integer,
+    "key": Integer,
+    "time_signature": Integer
+}
+
 
 #==================================================================================================
 # Spotify Request Method
@@ -16,21 +54,114 @@ def spotify_request(verb, url, data=None):
     verb is the HTTP verb of the request: GET, POST, PUT, PATCH, DELETE
     Security headers are set on the g.headers variable
     For POST, PUT, PATCH and DELETE the optional data variable is used for body data
+    Raise spotify_client.RateLimited if Spotify keeps answering 429: the app answers it with a 429
     """
 
     try:
-        r = requests.request(verb, url=BASE_URL+url, headers=g.headers, data=data)
+        ensure_fresh_token()
+        r = spotify_client.request(verb, BASE_URL+url, headers=g.headers, data=data)
 
         # Token has expired: request refresh
         if r.status_code == 401:
-            g.headers = refresh_token(g.refresh)
-            r = requests.request(verb, url=BASE_URL+url, headers=g.headers, data=data)
+            refresh_headers()
+            r = spotify_client.request(verb, BASE_URL+url, headers=g.headers, data=data)
+    except spotify_client.RateLimited:
+        raise
     except:
         flash("Unable to connect to Spotify. Please try again later.", 'danger')
         return redirect ('/')
 
     return r
 
+
+def spotify_request_many(urls, headers=None):
+    """GET several Spotify urls concurrently
+    headers defaults to the current user's token
+    Return the responses in the order of urls
+    """
+
+    user_token = headers is None
+    if user_token:
+        ensure_fresh_token()
+        headers = g.headers
+    app = current_app._get_current_object()
+
+    def fetch(url):
+        # The rate limiter needs an app context for the database
+        with app.app_context():
+            return spotify_client.request('GET', BASE_URL+url, headers=headers)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(urls) or 1)) as pool:
+        responses = list(pool.map(fetch, urls))
+
+    if not user_token:
+        return responses
+
+    # Token was revoked mid-way: retry with a refreshed token
+    return [spotify_request('GET', url) if r.status_code == 401 else r for url, r in zip(urls, responses)]
+
+
+def spotify_pages(url, limit=PAGE_LIMIT, offset=0, max_items=None, headers=None):
+    """
+    Yield the pages of a paged Spotify endpoint in order, starting at offset
+
+    The first page gives the total: the remaining offsets are then fetched
+    MAX_CONCURRENT_REQUESTS pages at a time, so at most that many pages are held in memory.
+    Pages without a total are followed through their next links
+    Optional max_items stops fetching pages past offset + max_items
+    """
+
+    separator = '&' if '?' in url else '?'
+
+    def page_url(offset):
+        return f'{url}{separator}limit={limit}&offset={offset}'
+
+    def fetch(urls):
+        responses = spotify_request_many(urls, headers)
+        for r in responses:
+            r.raise_for_status()
+        return [r.json() for r in responses]
+
+    page = fetch([page_url(offset)])[0]
+    yield page
+
+    total = page.get('total')
+    if total is None:
+        while page.get('next'):
+            page = fetch([page['next'][len(BASE_URL):]])[0]
+            yield page
+        return
+
+    if max_items is not None:
+        total = min(total, offset + max_items)
+    offsets = list(range(offset + limit, total, limit))
+    for i in range(0, len(offsets), MAX_CONCURRENT_REQUESTS):
+        yield from fetch([page_url(page_offset) for page_offset in offsets[i:i + MAX_CONCURRENT_REQUESTS]])
+
+
+def spotify_paginate(url, limit=PAGE_LIMIT, offset=0, max_items=None, headers=None):
+    """Return an iterator over every item of a paged Spotify endpoint, in order, fetching pages as it is consumed"""
+
+    items = (item for page in spotify_pages(url, limit, offset, max_items, headers) for item in page['items'])
+
+    return islice(items, max_items)
+
+
+def refresh_headers():
+    """Replace the bearer token in g.headers with a refreshed token"""
+
+    username = g.user.username if g.user else None
+    g.headers = refresh_user_token(username, g.refresh, g.token)
+    if 'auth' in session:
+        g.token = session['auth']['access_token']
+
+
+def ensure_fresh_token():
+    """Refresh the bearer token before it expires rather than waiting for a 401"""
+
+    if g.refresh and token_expiring(session.get('auth')):
+        refresh_headers()
+
 #==================================================================================================
 # Spotify Search & Process Methods
 #==================================================================================================
@@ -49,6 +180,22 @@ def get_spotify_track_ids(items):
 def search_spotify(query_string, query_type, query_limit, offset):
     """Search Spotify, add matching tracks to db and return found tracks
     Called by /search
+    Results are the same for every user: they are cached for SEARCH_CACHE_TTL seconds by normalized query
+    """
+
+    return cache.cached('search', 'search', cache.SEARCH_TTL, fetch_spotify_search, store='search',
+        query_string=normalize_query(query_string), query_type=query_type, query_limit=int(query_limit), offset=int(offset))
+
+
+def normalize_query(query_string):
+    """Lowercase a search query and collapse its whitespace: Spotify search ignores both"""
+
+    return ' '.join(query_string.lower().split())
+
+
+def fetch_spotify_search(query_string, query_type, query_limit, offset):
+    """Search Spotify and add matching tracks to db
+    Return the found tracks with their local ids
     """
 
     r = spotify_request('GET', f'/search?q={query_string}type={query_type}&limit={query_limit}&offset={offset}')
@@ -72,13 +219,32 @@ def get_spotify_liked_tracks(limit=25, offset=0):
     Return a list of user's saved Spotify track objects and save to db
     Called by /tracks
     """
+
+    return get_spotify_liked_tracks_page(limit, offset)['tracks']
+
+
+def get_spotify_liked_tracks_page(limit=25, offset=0):
+    """
+    Return a page of the user's saved tracks: {"tracks": list of track dicts, "next": Spotify url of the next page or None}
+    Responses are cached per user for CACHE_LIKED_TRACKS_TTL seconds
+    """
+
+    if not g.user:
+        return fetch_spotify_liked_tracks(limit, offset)
+
+    return cache.cached(cache.user_namespace(g.user.username), 'liked_tracks_page', cache.LIKED_TRACKS_TTL, fetch_spotify_liked_tracks,
+        limit=int(limit), offset=int(offset))
+
+
+def fetch_spotify_liked_tracks(limit=25, offset=0):
+    """Request a page of the user's saved tracks from Spotify and save them to db"""
     
     r = spotify_request('GET', f'/me/tracks?limit={limit}&offset={offset}')
 
     processed_tracks = pre_process_tracks(r.json()['items'])
     tracks = process_tracks(processed_tracks)
     
-    return tracks
+    return {"tracks": tracks, "next": r.json()['next']}
 
 def get_spotify_top_tracks(limit=25, offset=0, time_range='medium_term'):
     """ 
@@ -86,127 +252,250 @@ def get_spotify_top_tracks(limit=25, offset=0, time_range='medium_term'):
     Called by /top
     """
 
+    return get_spotify_top_tracks_page(limit, offset, time_range)['tracks']
+
+
+def get_spotify_top_tracks_page(limit=25, offset=0, time_range='medium_term'):
+    """
+    Return a page of the user's top tracks: {"tracks": list of track dicts, "next": Spotify url of the next page or None}
+    Responses are cached per user for CACHE_TOP_TRACKS_TTL seconds: Spotify updates top tracks at most daily
+    """
+
+    if not g.user:
+        return fetch_spotify_top_tracks(limit, offset, time_range)
+
+    return cache.cached(cache.user_namespace(g.user.username), 'top_tracks_page', cache.TOP_TRACKS_TTL, fetch_spotify_top_tracks,
+        limit=int(limit), offset=int(offset), time_range=time_range)
+
+
+def fetch_spotify_top_tracks(limit=25, offset=0, time_range='medium_term'):
+    """Request a page of the user's top tracks from Spotify and save them to db"""
+
     r = spotify_request('GET', f'/me/top/tracks?limit={limit}&offset={offset}&time_range={time_range}')
 
     tracks = process_tracks(r.json()['items'])
     
-    return tracks
+    return {"tracks": tracks, "next": r.json()['next']}
+
+def iter_spotify_liked_tracks(max_items=None):
+    """Yield every track object in the user's Spotify library, most recently saved first"""
+
+    for item in spotify_paginate('/me/tracks', max_items=max_items):
+        yield item['track']
+
+
+def iter_spotify_top_tracks(time_range='medium_term', max_items=None):
+    """Return an iterator over all of the user's top Spotify track objects for time_range"""
+
+    return spotify_paginate(f'/me/top/tracks?time_range={time_range}', max_items=max_items)
+
+
+def ingest_tracks(tracks, batch_size=INGEST_BATCH_SIZE):
+    """
+    Save tracks from any iterable of Spotify track objects to the db, batch_size tracks per transaction
+    Only one batch is held in memory, so whole libraries can be streamed in from spotify_paginate
+    Return the number of tracks processed
+    """
+
+    count = 0
+    batch = []
+    for track in tracks:
+        batch.append(track)
+        if len(batch) == batch_size:
+            process_tracks(batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        process_tracks(batch)
+        count += len(batch)
+
+    return count
+
 
 def process_tracks(found_tracks):
     """Check if db has each spotify track id
         This is to parse the /search route
 
-        if spotify_track_id not found, create entry return id
-        if spotify_track_id is found, return id
-        return a list of ids (both found and created) from search
+        Tracks already in the db are found with one query
+        Missing tracks are upserted with their albums in a single transaction
+        Artists and audio features of new tracks are added by a background task
+        return a list of dicts (both found and created) in the order of found_tracks
     """
 
-    track_ids = []
+    if not found_tracks:
+        return []
+
+    # A page of results can list the same track twice
+    spotify_tracks = {}
+    for track in found_tracks:
+        spotify_tracks.setdefault(track['id'], track)
+
+    db_tracks = find_tracks(spotify_tracks.keys())
+    new_tracks = [track for track in spotify_tracks.values() if track['id'] not in db_tracks]
+
+    inserted = {}
+    if new_tracks:
+        inserted = insert_tracks(new_tracks)
+        # Includes tracks another request inserted first
+        db_tracks.update(find_tracks([track['id'] for track in new_tracks]))
+
+    db.session.commit()
+
     tracks = []
     for track in found_tracks:
-        #Check if in db
-        track_exists = Track.query.filter(Track.spotify_track_id==track['id']).first()
-
-        #If yes, get id, append to track_ids[]
-        if track_exists:
-            tracks.append({"name": track_exists.name, "id": track_exists.id, "spotify_track_id": track_exists.spotify_track_id})
-
-        #If no, populate db, append id to track_ids[]
-        else:
-            new_track = Track(
-                spotify_track_id=track['id'],
-                name=track['name'],
-                popularity=track['popularity'],
-                spotify_track_uri=track['uri'],
-                release_year=track['album']['release_date'][:4],
-                duration_ms=track['duration_ms'])
-            
-            # check if album in db, if so connect to track else create and connect
-            album = Album.query.filter(Album.spotify_album_id==track['album']['id']).first()
-            if album:
-                new_track.album_id = album.id
-            else:
-                new_album = Album(
-                    spotify_album_id = track['album']['id'],
-                    name = track['album']['name'],
-                    image = track['album']['images'][2]['url']
-                )
-                Album.insert(new_album)
-                new_track.album_id = new_album.id
-            Track.insert(new_track)
-
-            tracks.append({"name": new_track.name, "id": new_track.id, "spotify_track_id": new_track.spotify_track_id})
-            track_ids.append(new_track.id)
-
-        if track_exists:
-             track_id = track_exists.id
-        else:
-            track_id = new_track.id
-
-        #loop through artists
-        for artist in track['artists']:
-            #Check if artist is in db
-            artist_exists = Artist.query.filter(Artist.spotify_artist_id==artist['id']).first()
-
-            #If artist is in db and track new
-            if artist_exists:
-                if not track_exists:
-                    #connect existing artist to new track
-                    new_track_artist = TrackArtist(track_id=track_id, artist_id=artist_exists.id)
-                    db.session.add(new_track_artist)
-                    db.session.commit()
-
-            #Artist not in db: create new artist and link to track
-            else:
-                new_artist = Artist(
-                    spotify_artist_id=artist['id'],
-                    name=artist['name']
-                )
-                Artist.insert(new_artist)
-                new_track_artist = TrackArtist(track_id=track_id, artist_id=new_artist.id)
-                db.session.add(new_track_artist)
-                db.session.commit()
-
-    # Query Spotify database for audio features and populate db if any tracks are new
-    if len(track_ids):
-        get_audio_features(track_ids)
+        db_track = db_tracks[track['id']]
+        tracks.append({"name": db_track.name, "id": db_track.id, "spotify_track_id": db_track.spotify_track_id})
+
+    # Link artists and query Spotify database for audio features if any tracks are new
+    if inserted:
+        task_queue.enqueue('enrich_tracks', track_artists=[
+            [inserted[spotify_id], [{"id": artist['id'], "name": artist['name']} for artist in spotify_tracks[spotify_id]['artists']]]
+            for spotify_id in inserted
+        ])
 
     return tracks
 
 
-def create_track_list(track_ids):
-    """Take a list of track_ids and return a comma separated list of spotify_track_ids
+@task_queue.task('enrich_tracks')
+def enrich_tracks(track_artists):
+    """Background task: link artists to newly ingested tracks, index them for catalog search and save their audio features
+    track_artists is a list of [track_id, list of Spotify artist objects]
+    """
+
+    insert_track_artists(track_artists)
+    update_search_documents([track_id for track_id, artists in track_artists])
+    db.session.commit()
+
+    get_audio_features([track_id for track_id, artists in track_artists], headers=get_client_headers())
+
+
+def find_tracks(spotify_track_ids):
+    """Return a dict of spotify_track_id: (id, name, spotify_track_id) for tracks in db"""
+
+    rows = db.session.query(Track.id, Track.name, Track.spotify_track_id).filter(Track.spotify_track_id.in_(list(spotify_track_ids))).all()
+
+    return {row.spotify_track_id: row for row in rows}
+
+
+def insert_tracks(new_tracks):
+    """Upsert Spotify track objects with their albums
+    Rows that already exist are skipped (ON CONFLICT DO NOTHING), so parallel requests
+    can ingest the same tracks without duplicates
+    Return a dict of spotify_track_id: id for the tracks inserted by this call
+    """
+
+    albums = {}
+    for track in new_tracks:
+        albums[track['album']['id']] = {
+            "spotify_album_id": track['album']['id'],
+            "name": track['album']['name'],
+            "image": track['album']['images'][2]['url']
+        }
+
+    album_ids = upsert_ids(Album, 'spotify_album_id', albums.values())
+
+    # Insert in key order, so parallel ingests lock the same rows in the same order and can't deadlock
+    rows = sorted([{
+        "spotify_track_id": track['id'],
+        "name": track['name'],
+        "popularity": track['popularity'],
+        "spotify_track_uri": track['uri'],
+        "release_year": track['album']['release_date'][:4],
+        "duration_ms": track['duration_ms'],
+        "album_id": album_ids[track['album']['id']]
+    } for track in new_tracks], key=lambda row: row['spotify_track_id'])
+
+    stmt = insert(Track).values(rows).on_conflict_do_nothing(index_elements=['spotify_track_id']).returning(Track.id, Track.spotify_track_id)
+
+    return {row.spotify_track_id: row.id for row in db.session.execute(stmt)}
+
+
+def insert_track_artists(track_artists):
+    """Upsert the artists of tracks and link them to the tracks
+    track_artists is a list of [track_id, list of Spotify artist objects]
+    """
+
+    artists = {}
+    for track_id, track_artist_list in track_artists:
+        for artist in track_artist_list:
+            artists[artist['id']] = {
+                "spotify_artist_id": artist['id'],
+                "name": artist['name']
+            }
+
+    if not artists:
+        return
+
+    artist_ids = upsert_ids(Artist, 'spotify_artist_id', artists.values())
+
+    links = {(track_id, artist_ids[artist['id']]) for track_id, track_artist_list in track_artists for artist in track_artist_list}
+    db.session.execute(insert(TrackArtist).values([{"track_id": track_id, "artist_id": artist_id} for track_id, artist_id in sorted(links)]).on_conflict_do_nothing())
+
+
+def upsert_ids(model, key, rows):
+    """Insert rows, skipping those whose unique key is already in db
+    Rows are inserted in key order, so parallel calls lock keys in the same order and can't deadlock
+    Return a dict of key: id for every row
+    """
+
+    rows = sorted(rows, key=lambda row: row[key])
+    db.session.execute(insert(model).values(rows).on_conflict_do_nothing(index_elements=[key]))
+
+    column = getattr(model, key)
+    return dict(db.session.query(column, model.id).filter(column.in_([row[key] for row in rows])).all())
+
+
+def create_track_list(track_ids, chunk_size=AUDIO_FEATURES_LIMIT):
+    """Take a list of track_ids and return comma separated lists of their spotify_track_ids
+        Each list holds at most chunk_size ids
         Called by get_audio_features
     """
 
-    tracks = ''
-    for track in track_ids:
-        track= Track.query.get(track)
-        tracks += track.spotify_track_id + ','
-    return tracks[:-1]
-   
+    rows = db.session.query(Track.spotify_track_id).filter(Track.id.in_(track_ids)).all()
+    spotify_ids = [row.spotify_track_id for row in rows]
+
+    return [','.join(spotify_ids[i:i + chunk_size]) for i in range(0, len(spotify_ids), chunk_size)]
 
-def get_audio_features(track_ids):
-    """Take list of track_ids, query Spotify and populate db with audio features"""
 
-    tracks = create_track_list(track_ids)
+def get_audio_features(track_ids, headers=None):
+    """Take list of track_ids, query Spotify and populate db with audio features
+    Ids are requested in chunks of 100, fetched concurrently
+    headers defaults to the current user's token
+    """
+
+    if not track_ids:
+        return
 
-    r = spotify_request('GET', '/audio-features?ids=' + tracks)
+    chunks = create_track_list(track_ids)
+    responses = spotify_request_many(['/audio-features?ids=' + chunk for chunk in chunks], headers=headers)
 
     # Save audio features to db
-    for track in r.json()['audio_features']:
-        db_track = Track.query.filter(Track.spotify_track_id==track['id']).first()
-        db_track.danceability = track['danceability']
-        db_track.energy = track['energy']
-        db_track.tempo = track['tempo']
-        db_track.key = track['key']
-        db_track.loudness = track['loudness']
-        db_track.mode = track['mode']
-        db_track.speechiness = track['speechiness']
-        db_track.acousticness = track['speechiness']
-        db_track.instrumentalness = track['acousticness']
-        db_track.liveness = track['liveness']
-        db_track.valence = track['valence']
-        db_track.tempo = track['tempo']
-        db_track.time_signature = track['time_signature']
-        Track.update()
\ No newline at end of file
+    saved = []
+    for r in responses:
+        # Spotify returns null for tracks without audio features
+        features = [track for track in r.json().get('audio_features', []) if track]
+        if features:
+            saved.extend(save_audio_features(features))
+
+    Track.update()
+    add_track_features(saved)
+    ann_index.add_track_features(saved)
+
+
+def save_audio_features(features):
+    """Update tracks with a list of Spotify audio features objects in one UPDATE statement
+    Return rows of (track id, similarity features) of the tracks with every similarity feature
+    """
+
+    columns = [column('spotify_track_id', Text)] + [column(name, type_) for name, type_ in AUDIO_FEATURES.items()]
+    rows = values(*columns, name='features').data(
+        [tuple([track['id']] + [track[name] for name in AUDIO_FEATURES]) for track in features]
+    )
+
+    tracks = Track.__table__
+    stmt = update(tracks).where(tracks.c.spotify_track_id == rows.c.spotify_track_id).values(
+        {**{name: rows.c[name] for name in AUDIO_FEATURES}, "features_updated_at": func.localtimestamp()}
+    ).returning(tracks.c.id, *[tracks.c[name] for name in SIMILARITY_FEATURES])
+
+    return [tuple(row) for row in db.session.execute(stmt) if None not in row]
@@ -1,11 +1,13 @@
 // AJAX file for /tracks (Spotify liked tracks)
 
-const LIMIT = 25;
-let offset = 0; // current search page offset
+const LIMIT = $('#tracks').data('limit'); // Number of tracks per page, set by the server
+let cursors = [null]; // cursors of the pages shown so far, the last is the current page
+let nextCursor = $('#tracks').data('next') || null; // cursor of the page after the current page, null on the last page
 
 // Page request
-const pageRequest = async (offset) => {
-	const res = await axios.get(`${BASE_URL}/me/tracks?offset=${offset}`);
+const pageRequest = async (cursor) => {
+	const res = await axios.get(`${BASE_URL}/me/tracks`, { params: { limit: LIMIT, cursor } });
+	nextCursor = res.data.next;
 	const tracks = res.data.track_dicts;
 	const html = await makeTracksHTML(tracks);
 	$('#tracks').html(html);
@@ -15,19 +17,19 @@ const pageRequest = async (offset) => {
 const nextPage = async () => {
 	console.debug('nextPage');
 
-	offset += 20;
+	if (!nextCursor) return;
+	cursors.push(nextCursor);
 
-	pageRequest(offset);
+	pageRequest(nextCursor);
 };
 
 // Display the previous page of Spotify liked tracks
 const prevPage = async () => {
 	console.debug('prevPage');
 
-	offset -= 20;
-	if (offset < 0) offset = 0;
+	if (cursors.length > 1) cursors.pop();
 
-	pageRequest(offset);
+	pageRequest(cursors[cursors.length - 1]);
 };
 
 // List of available endpoints
@@ -3,7 +3,8 @@ const $body = $('body');
 BASE_URL = '/api';
 
 const LIMIT = 20;
-let offset = 0; // current search page offset
+let cursors = [null]; // cursors of the pages shown so far, the last is the current page
+let nextCursor = $('#spotPlaylists').data('next') || null; // cursor of the page after the current page, null on the last page
 let currentPlaylist; // id of current playlist
 let track_start_index; // for reordering of tracks: track start index
 let track_stop_index; // for reordering of tracks: track finish index
@@ -24,10 +25,11 @@ makeSpotPlaylists = async (playlists, total_spot_playlists) => {
 };
 
 // Page request
-const pageRequest = async (offset) => {
-	const res = await axios.get(
-		`${BASE_URL}/spotify/playlists?limit=${LIMIT}&offset=${offset}`
-	);
+const pageRequest = async (cursor) => {
+	const res = await axios.get(`${BASE_URL}/spotify/playlists`, {
+		params: { limit: LIMIT, cursor }
+	});
+	nextCursor = res.data.next;
 
 	const playlists = res.data.spot_playlists;
 	const total_spot_playlists = res.data.total_spot_playlists;
@@ -39,19 +41,19 @@ const pageRequest = async (offset) => {
 const nextPage = async () => {
 	console.debug('nextPage');
 
-	offset += 10;
+	if (!nextCursor) return;
+	cursors.push(nextCursor);
 
-	pageRequest(offset);
+	pageRequest(nextCursor);
 };
 
 // Display the previous page of Spotify playlists
 const prevPage = async () => {
 	console.debug('prevPage');
 
-	offset -= 10;
-	if (offset < 0) offset = 0;
+	if (cursors.length > 1) cursors.pop();
 
-	pageRequest(offset);
+	pageRequest(cursors[cursors.length - 1]);
 };
 
 // Sync the local playlist with Spotify (update any track changes)
@@ -73,7 +75,7 @@ const spotSync = async (e) => {
 		.removeClass('btn-success')
 		.addClass('btn-light');
 	// Refresh the list of Spotify Playlists
-	pageRequest(offset);
+	pageRequest(cursors[cursors.length - 1]);
 };
 
 // Display an iframe of the selected Spotify playlist
@@ -97,10 +99,17 @@ const showPlaylist = async (e) => {
 	const id = $playlist.data('id');
 	currentPlaylist = id;
 
-	tracks = await axios.get(`${BASE_URL}/playlists/${id}/tracks`);
+	// Follow the pages of the playlist, the sortable list needs every track
+	const tracks = [];
+	let cursor = null;
+	do {
+		const res = await axios.get(`${BASE_URL}/playlists/${id}/tracks`, { params: { cursor } });
+		tracks.push(...res.data.tracks);
+		cursor = res.data.next;
+	} while (cursor);
 
 	playlist_tracks = '';
-	for (let track of tracks.data.tracks) {
+	for (let track of tracks) {
 		playlist_tracks += `<li class="ui-state-default"><span class="ui-icon ui-icon-arrowthick-2-n-s"></span>
         <iframe src="https://open.spotify.com/embed/track/${track}" width="300" height="80" frameborder="0" allowtransparency="true" allow="encrypted-media"></iframe>
         </li>`;
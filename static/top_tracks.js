@@ -1,16 +1,18 @@
 // AJAX file for /top route (top tracks)
 
-const LIMIT = 25; // Number of tracks per page
+const LIMIT = $('#tracks').data('limit'); // Number of tracks per page, set by the server
 // time_range is the time frame top tracks are calculated:
 // long_term=several years including new data as available, medium_term=approx 6 months (Spotify default), short_term=approx 4 weeks
 const TIME_RANGE = 'medium_term';
-let offset = 0; // current search page offset
+let cursors = [null]; // cursors of the pages shown so far, the last is the current page
+let nextCursor = $('#tracks').data('next') || null; // cursor of the page after the current page, null on the last page
 
 // Page request
-const pageRequest = async (offset) => {
-	const res = await axios.get(
-		`${BASE_URL}/me/top/tracks?limit=${LIMIT}&offset=${offset}&time_range=${TIME_RANGE}`
-	);
+const pageRequest = async (cursor) => {
+	const res = await axios.get(`${BASE_URL}/me/top/tracks`, {
+		params: { limit: LIMIT, time_range: TIME_RANGE, cursor }
+	});
+	nextCursor = res.data.next;
 	const tracks = res.data.tracks;
 	const html = await makeTracksHTML(tracks);
 	$('#tracks').html(html);
@@ -20,19 +22,19 @@ const pageRequest = async (offset) => {
 const nextPage = async () => {
 	console.debug('nextPage');
 
-	offset += 20;
+	if (!nextCursor) return;
+	cursors.push(nextCursor);
 
-	pageRequest(offset);
+	pageRequest(nextCursor);
 };
 
 // Display the previous page of top tracks
 const prevPage = async () => {
 	console.debug('prevPage');
 
-	offset -= 20;
-	if (offset < 0) offset = 0;
+	if (cursors.length > 1) cursors.pop();
 
-	pageRequest(offset);
+	pageRequest(cursors[cursors.length - 1]);
 };
 
 // List of available endpoints
@@ -0,0 +1,226 @@
+"""Background task queue for Tuttitracks
+
+Tasks run on a pool of worker threads in each app process, fed by an in-process queue.
+With TASK_QUEUE_DURABLE = 'true', tasks are also saved to the task_jobs table: tasks still
+queued, or left running by a worker that stopped, are picked up again when the next worker starts.
+Workers start with their process's first request or enqueue, and record a heartbeat for the durable
+tasks they run, so a long task is only requeued once its worker stops beating
+"""
+
+import os
+import time
+import queue
+import threading
+import traceback
+from models import db, TaskJob
+import metrics
+
+# Worker threads per app process. 0 runs tasks inline, in the calling request
+WORKERS = int(os.environ.get('TASK_QUEUE_WORKERS', 2))
+DURABLE = os.environ.get('TASK_QUEUE_DURABLE', 'false').lower() == 'true'
+# Seconds without a heartbeat after which a running durable task is assumed lost with its worker
+STALE_AFTER = int(os.environ.get('TASK_QUEUE_STALE_AFTER', 600))
+HEARTBEAT_INTERVAL = STALE_AFTER / 4
+
+_tasks = {}
+_queue = queue.Queue()
+_app = None
+_workers_pid = None
+_workers_lock = threading.Lock()
+# Ids of durable tasks running in this process
+_running = set()
+
+#====================================================================================
+# Task registration and queueing
+#====================================================================================
+
+def task(name):
+    """Decorator registering a function as a background task
+    Task arguments must be JSON serializable when the queue is durable
+    """
+
+    def register(f):
+        _tasks[name] = f
+        return f
+
+    return register
+
+
+def init_app(app):
+    """Set the app that worker threads run tasks in, and expose queue metrics
+    Workers start with the process's first request, picking up durable tasks left by a stopped worker
+    """
+
+    global _app
+    _app = app
+
+    metrics.register_gauge('task_queue.depth', _queue.qsize)
+    metrics.register_gauge('task_queue.lag_seconds', queue_lag)
+
+    if WORKERS:
+        app.before_request(_start_workers)
+
+
+def enqueue(name, durable=True, **kwargs):
+    """Queue a task to run in the background
+    durable=False keeps the task in memory only, e.g. when its arguments include a user's token
+    """
+
+    metrics.incr('task_queue.enqueued')
+
+    if WORKERS == 0:
+        # A failing task rolls back only its own writes, not the calling request's
+        _run(name, kwargs, savepoint=db.session.begin_nested())
+        return
+
+    job_id = None
+    if DURABLE and durable:
+        with db.engine.begin() as conn:
+            job_id = conn.execute(TaskJob.__table__.insert().values(
+                name=name, payload=kwargs, status='queued', created_at=time.time()
+            ).returning(TaskJob.__table__.c.id)).scalar()
+
+    _start_workers()
+    _queue.put((time.time(), name, kwargs, job_id))
+
+
+def queue_lag():
+    """Seconds the oldest queued task has been waiting"""
+
+    with _queue.mutex:
+        if not _queue.queue:
+            return 0
+        return time.time() - _queue.queue[0][0]
+
+#====================================================================================
+# Workers
+#====================================================================================
+
+def _start_workers():
+    """Start this process's worker threads on first use
+    gunicorn forks workers after the app is imported, so threads are started per process
+    """
+
+    global _workers_pid
+
+    if _workers_pid == os.getpid():
+        return
+
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+        for i in range(WORKERS):
+            threading.Thread(target=_work, name=f'task-worker-{i}', daemon=True).start()
+
+        if DURABLE:
+            threading.Thread(target=_heartbeat, name='task-heartbeat', daemon=True).start()
+            _recover()
+
+
+def _recover():
+    """Queue durable tasks left queued, or running without a heartbeat for longer than STALE_AFTER"""
+
+    jobs = TaskJob.__table__
+    stale = time.time() - STALE_AFTER
+
+    with _app.app_context():
+        with db.engine.begin() as conn:
+            conn.execute(jobs.update().where(
+                jobs.c.status == 'running', db.func.coalesce(jobs.c.heartbeat_at, jobs.c.started_at) < stale
+            ).values(status='queued'))
+            rows = conn.execute(jobs.select().where(jobs.c.status == 'queued').order_by(jobs.c.id)).all()
+
+    for row in rows:
+        _queue.put((row.created_at, row.name, row.payload, row.id))
+
+
+def _claim(job_id):
+    """Mark a durable task as running. Return False if another worker claimed it first"""
+
+    jobs = TaskJob.__table__
+    with db.engine.begin() as conn:
+        claimed = conn.execute(jobs.update().where(jobs.c.id == job_id, jobs.c.status == 'queued').values(
+            status='running', started_at=time.time(), heartbeat_at=time.time()
+        )).rowcount
+
+    if claimed == 1:
+        _running.add(job_id)
+
+    return claimed == 1
+
+
+def _heartbeat():
+    """Heartbeat thread: mark the durable tasks running in this process as alive every HEARTBEAT_INTERVAL"""
+
+    jobs = TaskJob.__table__
+
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        running = list(_running)
+        if not running:
+            continue
+
+        try:
+            with _app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(jobs.update().where(jobs.c.id.in_(running), jobs.c.status == 'running').values(heartbeat_at=time.time()))
+        except Exception:
+            _app.logger.exception('Task heartbeat failed')
+
+
+def _finish(job_id, error=None):
+    """Save the result of a durable task"""
+
+    _running.discard(job_id)
+    jobs = TaskJob.__table__
+    with db.engine.begin() as conn:
+        conn.execute(jobs.update().where(jobs.c.id == job_id).values(
+            status='failed' if error else 'done', error=error, finished_at=time.time()
+        ))
+
+
+def _run(name, kwargs, savepoint=None):
+    """Run a task. Return the traceback if it fails
+    savepoint is the caller's savepoint an inline task runs in: a failure rolls back to it
+    """
+
+    start = time.time()
+    try:
+        _tasks[name](**kwargs)
+        # A task that committed has already ended the savepoint
+        if savepoint is not None and savepoint.is_active:
+            savepoint.commit()
+        metrics.incr('task_queue.done')
+        return None
+    except Exception:
+        if savepoint is not None and savepoint.is_active:
+            savepoint.rollback()
+        else:
+            db.session.rollback()
+        metrics.incr('task_queue.failed')
+        _app.logger.exception('Task %s failed', name)
+        return traceback.format_exc()
+    finally:
+        metrics.observe(f'task_queue.{name}_seconds', time.time() - start)
+
+
+def _work():
+    """Worker thread: run tasks from the queue forever"""
+
+    while True:
+        enqueued_at, name, kwargs, job_id = _queue.get()
+        metrics.observe('task_queue.wait_seconds', time.time() - enqueued_at)
+
+        with _app.app_context():
+            try:
+                if job_id is None or _claim(job_id):
+                    error = _run(name, kwargs)
+                    if job_id is not None:
+                        _finish(job_id, error)
+            except Exception:
+                _app.logger.exception('Task worker error running %s', name)
+            finally:
+                db.session.remove()
+                _queue.task_done()
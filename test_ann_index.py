@@ -0,0 +1,157 @@
+"""Tests for the approximate nearest neighbour index"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+
+from app import app
+from models import db, Track
+import ann_index
+from ann_index import write_index, AnnIndex, build_ann_index, get_ann_index
+from feature_matrix import normalize
+from spotify_query_parse import save_audio_features
+from test_feature_matrix import random_features, audio_features
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+
+class AnnIndexTestCase(TestCase):
+    """Tests for searching a written index"""
+
+    def setUp(self):
+        """Write an index of random tracks"""
+
+        rng = np.random.default_rng(0)
+        self.path = tempfile.mkdtemp()
+        self.ids = np.arange(1, 3001)
+        self.vectors = normalize(random_features(rng, 3000))
+        write_index(os.path.join(self.path, 'index'), self.ids, self.vectors, nlist=30)
+        self.index = AnnIndex(os.path.join(self.path, 'index'))
+
+    def tearDown(self):
+        """Delete the index files"""
+
+        shutil.rmtree(self.path)
+
+    def exact(self, row, k):
+        """Return the ids of the k tracks closest to a row, comparing every pair"""
+
+        distances = ((self.vectors - self.vectors[row]) ** 2).sum(axis=1)
+        distances[row] = np.inf
+        return self.ids[np.argsort(distances, kind='stable')[:k]]
+
+    def test_search_recall(self):
+        """Test searching every list is exact, and the default lists find most neighbours"""
+
+        found = 0
+        for row in range(0, 3000, 100):
+            ids, distances = self.index.search(self.vectors[row], k=10, exclude=self.ids[row], nprobe=30)
+            self.assertEqual(sorted(ids.tolist()), sorted(self.exact(row, 10).tolist()))
+
+            ids, distances = self.index.search(self.vectors[row], k=10, exclude=self.ids[row], nprobe=8)
+            found += len(set(ids.tolist()) & set(self.exact(row, 10).tolist()))
+
+        self.assertGreaterEqual(found / 300, 0.9)
+
+    def test_files_memory_mapped(self):
+        """Test workers map the track vectors rather than loading a copy"""
+
+        self.assertIsInstance(self.index.vectors, np.memmap)
+        self.assertIsInstance(self.index.ids, np.memmap)
+
+
+class SharedIndexTestCase(TestCase):
+    """Tests for building the index from the db and adding tracks to its delta"""
+
+    def setUp(self):
+        """Add tracks with audio features and point the index to a temporary directory"""
+
+        db.drop_all()
+        db.create_all()
+
+        for i in range(4):
+            db.session.add(Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=1985, duration_ms=1000))
+        db.session.commit()
+
+        save_audio_features([
+            audio_features('testtrack0', energy=0.9),
+            audio_features('testtrack1', energy=0.8),
+            audio_features('testtrack2', energy=0.1)
+        ])
+        db.session.commit()
+        self.track_ids = [Track.query.filter_by(spotify_track_id=f'testtrack{i}').one().id for i in range(4)]
+
+        self.original_path = ann_index.ANN_INDEX_PATH
+        ann_index.ANN_INDEX_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Rollback problems from failed tests and delete the index files"""
+
+        db.session.rollback()
+        shutil.rmtree(ann_index.ANN_INDEX_PATH)
+        ann_index.ANN_INDEX_PATH = self.original_path
+
+    def test_delta(self):
+        """Test tracks saved after the build are found, with their newest features"""
+
+        self.assertIsNone(get_ann_index())
+        build_ann_index()
+        self.assertEqual(len(get_ann_index()), 3)
+
+        ann_index.add_track_features(save_audio_features([
+            audio_features('testtrack3', energy=0.85),
+            audio_features('testtrack2', energy=0.93)
+        ]))
+        db.session.commit()
+
+        ids, distances = ann_index.similar_tracks(self.track_ids[0], k=3)
+        self.assertEqual(ids.tolist(), [self.track_ids[2], self.track_ids[3], self.track_ids[1]])
+        self.assertAlmostEqual(distances[0], 0.03, places=4)
+
+    def test_rebuild(self):
+        """Test a rebuild replaces the index in use and starts an empty delta"""
+
+        first = build_ann_index()
+        ann_index.add_track_features(save_audio_features([audio_features('testtrack3', energy=0.85)]))
+        db.session.commit()
+
+        second = build_ann_index()
+        index = get_ann_index()
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(index.directory, os.path.join(ann_index.ANN_INDEX_PATH, second))
+        self.assertEqual(len(index.ids), 4)
+        self.assertEqual(len(index.read_delta()[0]), 0)
+        # Workers may still be reading the previous index
+        self.assertTrue(os.path.exists(os.path.join(ann_index.ANN_INDEX_PATH, first)))
+
+        third = build_ann_index()
+
+        self.assertFalse(os.path.exists(os.path.join(ann_index.ANN_INDEX_PATH, first)))
+        self.assertTrue(os.path.exists(os.path.join(ann_index.ANN_INDEX_PATH, second)))
+        self.assertTrue(os.path.exists(os.path.join(ann_index.ANN_INDEX_PATH, third)))
+
+    def test_removed_index(self):
+        """Test an index removed by later builds still answers searches in a worker that has it open"""
+
+        build_ann_index()
+        ann_index.add_track_features(save_audio_features([audio_features('testtrack3', energy=0.85)]))
+        db.session.commit()
+        index = get_ann_index()
+        self.assertEqual(len(index), 4)
+
+        build_ann_index()
+        build_ann_index()
+        self.assertFalse(os.path.exists(index.directory))
+
+        self.assertEqual(len(index), 4)
+        ids, distances = index.search(index.vectors[0], k=1)
+        self.assertEqual(len(ids), 1)
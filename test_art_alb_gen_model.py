@@ -163,6 +163,19 @@ class PlaylistModelTestCase(TestCase):
 
         self.assertEqual(test_album.image, TEST_ALBUM_1['image'])
 
+    def test_duplicate_spotify_album_id(self):
+        """Test spotify_album_id is unique"""
+
+        duplicate_album = Album(
+            spotify_album_id=TEST_ALBUM_1['spotify_album_id'],
+            name=TEST_ALBUM_1['name'],
+            image=TEST_ALBUM_1['image']
+        )
+        db.session.add(duplicate_album)
+
+        with self.assertRaises(exc.IntegrityError) as context:
+            db.session.commit()
+
     def test_album_to_track(self):
         """Test relationship from album to track"""
 
@@ -204,6 +217,18 @@ class PlaylistModelTestCase(TestCase):
 
         self.assertEqual(test_artist.name, TEST_ARTIST_1['name'])
 
+    def test_duplicate_spotify_artist_id(self):
+        """Test spotify_artist_id is unique"""
+
+        duplicate_artist = Artist(
+            spotify_artist_id=TEST_ARTIST_1['spotify_artist_id'],
+            name=TEST_ARTIST_1['name']
+        )
+        db.session.add(duplicate_artist)
+
+        with self.assertRaises(exc.IntegrityError) as context:
+            db.session.commit()
+
     def test_artist_to_track(self):
         """Test artist to track relationship"""
 
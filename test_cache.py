@@ -0,0 +1,95 @@
+"""Tests for the response cache backends"""
+
+import time
+from unittest import TestCase
+
+from app import app
+from models import db, CacheEntry
+import cache
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+
+class CacheTestCase(TestCase):
+    """Tests for the in-process and database cache backends"""
+
+    def setUp(self):
+        """Start every test with an empty cache table"""
+
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def check_backend(self, backend):
+        """Check get, set, expiry, LRU eviction and invalidation of a backend holding 2 entries"""
+
+        backend.set('user:a:liked', 'user:a', [1, 2], 60)
+        self.assertEqual(backend.get('user:a:liked'), (True, [1, 2]))
+        self.assertEqual(backend.get('user:a:top'), (False, None))
+
+        backend.set('user:a:expired', 'user:a', [3], -1)
+        self.assertEqual(backend.get('user:a:expired'), (False, None))
+
+        # user:a:liked was used last, so user:b:top is evicted first
+        backend.set('user:b:top', 'user:b', [4], 60)
+        time.sleep(0.01)
+        backend.get('user:a:liked')
+        backend.set('user:b:liked', 'user:b', [5], 60)
+        self.assertEqual(backend.get('user:b:top'), (False, None))
+        self.assertEqual(backend.get('user:a:liked'), (True, [1, 2]))
+
+        backend.invalidate('user:a')
+        self.assertEqual(backend.get('user:a:liked'), (False, None))
+        self.assertEqual(backend.get('user:b:liked'), (True, [5]))
+
+    def test_memory_cache(self):
+        """Test the in-process backend"""
+
+        self.check_backend(cache.MemoryCache(max_entries=2))
+
+    def test_db_cache(self):
+        """Test the shared database backend"""
+
+        self.check_backend(cache.DbCache(max_entries=2))
+        self.assertEqual(db.session.query(CacheEntry).count(), 1)
+
+    def test_cached(self):
+        """Test cached only calls fetch on a miss, with the same parameters in any order"""
+
+        calls = []
+
+        def fetch(limit, offset):
+            calls.append((limit, offset))
+            return [limit, offset]
+
+        namespace = cache.user_namespace('testuser')
+        self.assertEqual(cache.cached(namespace, 'test', 60, fetch, limit=25, offset=0), [25, 0])
+        self.assertEqual(cache.cached(namespace, 'test', 60, fetch, offset=0, limit=25), [25, 0])
+        self.assertEqual(len(calls), 1)
+
+        cache.invalidate(namespace)
+        cache.cached(namespace, 'test', 60, fetch, limit=25, offset=0)
+        self.assertEqual(len(calls), 2)
+
+    def test_db_caches_bounded_separately(self):
+        """Test search results don't evict per user responses"""
+
+        responses = cache.DbCache(max_entries=1, name='responses')
+        search = cache.DbCache(max_entries=1, name='search')
+
+        responses.set('user:a:liked', 'user:a', [1], 60)
+        search.set('search:a', 'search', [2], 60)
+        search.set('search:b', 'search', [3], 60)
+
+        self.assertEqual(responses.get('user:a:liked'), (True, [1]))
+        self.assertEqual(search.get('search:a'), (False, None))
+        self.assertEqual(search.get('search:b'), (True, [3]))
@@ -0,0 +1,120 @@
+"""Tests for streaming catalog and playlist exports"""
+
+import csv
+import json
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Track, Album, Artist, TrackArtist, Playlist, PlaylistTrack
+from db_api_methods import INDEX_GAP
+import catalog_export
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+app.config['SECRET_KEY'] = 'testsecretkey'
+
+
+class CatalogExportTestCase(TestCase):
+    """Tests for /api/export/tracks and /api/export/playlists"""
+
+    def setUp(self):
+        """Add two users, each with a playlist of tracks, and one playlist without tracks"""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        db.session.add(User(username='otheruser', password='testpassword', email='otheremail@test.com'))
+        album = Album(spotify_album_id='testalbum', name='testalbumname', image='http://www.testimage.com')
+        artists = [Artist(spotify_artist_id=f'testartist{i}', name=f'testartistname{i}') for i in range(2)]
+        playlist = Playlist(username='testuser', name='testplaylistname')
+        empty_playlist = Playlist(username='testuser', name='emptyplaylistname')
+        other_playlist = Playlist(username='otheruser', name='otherplaylistname')
+        db.session.add_all([album, *artists, playlist, empty_playlist, other_playlist])
+        db.session.flush()
+
+        tracks = [Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+            release_year=1985, duration_ms=1000, album_id=album.id, energy=i / 10) for i in range(4)]
+        db.session.add_all(tracks)
+        db.session.flush()
+
+        db.session.add_all([TrackArtist(track_id=tracks[0].id, artist_id=artist.id) for artist in artists])
+        # The playlist holds tracks 2, 0, 1 in that order, the other user's playlist holds track 3
+        for index, track in enumerate([tracks[2], tracks[0], tracks[1]]):
+            db.session.add(PlaylistTrack(playlist_id=playlist.id, track_id=track.id, index=index * INDEX_GAP))
+        db.session.add(PlaylistTrack(playlist_id=other_playlist.id, track_id=tracks[3].id, index=0))
+
+        db.session.commit()
+        self.playlist_ids = [playlist.id, empty_playlist.id]
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = 'testuser'
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def test_export_tracks_ndjson(self):
+        """Test the tracks export has one line per track in the user's playlists, with album and artists"""
+
+        # Small batches make the export span several reads of the cursor
+        catalog_export.EXPORT_BATCH_SIZE, batch_size = 2, catalog_export.EXPORT_BATCH_SIZE
+        try:
+            res = self.client.get('/api/export/tracks')
+        finally:
+            catalog_export.EXPORT_BATCH_SIZE = batch_size
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        tracks = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+
+        self.assertEqual([track['spotify_track_id'] for track in tracks], ['testtrack0', 'testtrack1', 'testtrack2'])
+        self.assertEqual(tracks[0]['artists'], ['testartistname0', 'testartistname1'])
+        self.assertEqual(tracks[1]['artists'], [])
+        self.assertEqual(tracks[2]['album_name'], 'testalbumname')
+        self.assertEqual(tracks[2]['energy'], 0.2)
+
+    def test_export_tracks_csv(self):
+        """Test the CSV tracks export has a header and one row per track"""
+
+        res = self.client.get('/api/export/tracks?format=csv')
+        rows = list(csv.DictReader(res.get_data(as_text=True).splitlines()))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertIn('attachment; filename=tracks.csv', res.headers['Content-Disposition'])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['artists'], 'testartistname0;testartistname1')
+
+    def test_export_playlists(self):
+        """Test the playlists export holds each playlist with its tracks in playlist order"""
+
+        res = self.client.get('/api/export/playlists')
+        playlists = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([playlist['id'] for playlist in playlists], self.playlist_ids)
+        self.assertEqual([track['spotify_track_id'] for track in playlists[0]['tracks']], ['testtrack2', 'testtrack0', 'testtrack1'])
+        self.assertEqual(playlists[1]['tracks'], [])
+
+        res = self.client.get('/api/export/playlists?format=csv')
+        rows = list(csv.DictReader(res.get_data(as_text=True).splitlines()))
+
+        self.assertEqual([row['spotify_track_id'] for row in rows], ['testtrack2', 'testtrack0', 'testtrack1', ''])
+        self.assertEqual(rows[0]['playlist_name'], 'testplaylistname')
+
+    def test_export_rejects_unknown_format_and_signed_out(self):
+        """Test an unknown format is refused and a signed out user can't export"""
+
+        self.assertEqual(self.client.get('/api/export/tracks?format=xml').status_code, 400)
+
+        with self.client.session_transaction() as session:
+            del session[CURR_USER_KEY]
+
+        self.assertEqual(self.client.get('/api/export/playlists').status_code, 401)
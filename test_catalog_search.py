@@ -0,0 +1,114 @@
+"""Tests for local catalog search"""
+
+from unittest import TestCase
+
+from app import app
+from models import db, Track, Album, Artist, TrackArtist
+import catalog_search
+from catalog_search import update_search_documents, search_catalog, search_local_catalog
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+# (track name, artist name, album name, release year, popularity)
+TEST_TRACKS = [
+    ("Help", "The Beatles", "Help!", 1965, 80),
+    ("Yesterday", "The Beatles", "Help!", 1965, 90),
+    ("Helpless", "Neil Young", "Deja Vu", 1970, 60),
+    ("Blackbird", "The Beatles", "The White Album", 1968, 70),
+    ("Help Me", "Joni Mitchell", "Court and Spark", 1974, 50)
+]
+
+
+class CatalogSearchTestCase(TestCase):
+    """Tests for search_catalog and search_local_catalog"""
+
+    def setUp(self):
+        """Add tracks with albums and artists, then index them"""
+
+        db.drop_all()
+        db.create_all()
+
+        artists = {}
+        for i, (name, artist_name, album_name, year, popularity) in enumerate(TEST_TRACKS):
+            album = Album(spotify_album_id=f'testalbum{i}', name=album_name, image='http://www.testimage.com')
+            if artist_name not in artists:
+                artists[artist_name] = Artist(spotify_artist_id=f'testartist{i}', name=artist_name)
+            track = Track(spotify_track_id=f'testtrack{i}', name=name, spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=year, duration_ms=1000, popularity=popularity, album=album)
+            db.session.add_all([album, artists[artist_name], track])
+            db.session.flush()
+            db.session.add(TrackArtist(track_id=track.id, artist_id=artists[artist_name].id))
+
+        db.session.flush()
+        update_search_documents([track.id for track in Track.query.all()])
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def test_search_ranks_track_names_first(self):
+        """Test a word in the track name ranks above the same word in an album name"""
+
+        tracks, total, next_after = search_catalog('help')
+        names = [track['name'] for track in tracks]
+
+        self.assertEqual(names[:2], ['Help', 'Help Me'])
+        self.assertIn('Yesterday', names)
+        self.assertEqual(total, len(tracks))
+
+    def test_search_every_word(self):
+        """Test every word of the query must match the track, its artists or album"""
+
+        tracks, total, next_after = search_catalog('beatles help')
+
+        self.assertEqual(sorted(track['name'] for track in tracks), ['Help', 'Yesterday'])
+
+    def test_search_year_and_pages(self):
+        """Test the year filter and pagination"""
+
+        tracks, total, next_after = search_catalog('beatles', year=1965, limit=1, offset=1)
+
+        self.assertEqual(total, 2)
+        self.assertEqual([track['name'] for track in tracks], ['Help'])
+
+    def test_search_cursor_pages(self):
+        """Test following the after of each page reads every match once, counting them on the first page only"""
+
+        tracks, total, after = search_catalog('beatles', limit=2)
+        names = [track['name'] for track in tracks]
+        self.assertEqual(total, 3)
+
+        while after:
+            tracks, total, after = search_catalog('beatles', limit=2, after=after)
+            names += [track['name'] for track in tracks]
+            self.assertIsNone(total)
+
+        self.assertEqual(names, [track['name'] for track in search_catalog('beatles', limit=10)[0]])
+
+    def test_search_uses_index(self):
+        """Test the full text search can use the GIN index"""
+
+        db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+        plan = db.session.execute(db.text(
+            "EXPLAIN SELECT id FROM tracks WHERE search_vector @@ plainto_tsquery('simple', 'help')"
+        )).scalars().all()
+
+        self.assertIn('ix_tracks_search_vector', ' '.join(plan))
+
+    def test_local_catalog_coverage(self):
+        """Test local results are only used when the catalog holds enough matches"""
+
+        original = catalog_search.LOCAL_SEARCH_MIN_RESULTS
+        try:
+            catalog_search.LOCAL_SEARCH_MIN_RESULTS = 3
+            self.assertIsNone(search_local_catalog('beatles blackbird', limit=2))
+            self.assertEqual(len(search_local_catalog('beatles', limit=2)), 2)
+        finally:
+            catalog_search.LOCAL_SEARCH_MIN_RESULTS = original
@@ -0,0 +1,144 @@
+"""Tests for the columnar catalog snapshot"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import pyarrow.parquet as pq
+
+from app import app
+from models import db, Track, Album, Artist, TrackArtist
+import catalog_snapshot
+from catalog_snapshot import snapshot_catalog, read_snapshot, read_manifest
+import feature_matrix
+from feature_matrix import SIMILARITY_FEATURES
+from spotify_query_parse import save_audio_features
+from test_feature_matrix import audio_features
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+
+class CatalogSnapshotTestCase(TestCase):
+    """Tests for writing and reading the snapshot"""
+
+    def setUp(self):
+        """Add tracks from two years, three with audio features, and point the snapshot to a temporary directory"""
+
+        db.drop_all()
+        db.create_all()
+
+        album = Album(spotify_album_id='testalbum', name='testalbumname', image='http://www.testimage.com')
+        artist = Artist(spotify_artist_id='testartist', name='testartistname')
+        db.session.add_all([album, artist])
+        db.session.flush()
+
+        for i, year in enumerate([1990, 1985, 1990, 1985]):
+            db.session.add(Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=year, duration_ms=1000, album_id=album.id))
+        db.session.flush()
+        db.session.add(TrackArtist(track_id=Track.query.filter_by(spotify_track_id='testtrack0').one().id, artist_id=artist.id))
+        db.session.commit()
+
+        save_audio_features([
+            audio_features('testtrack0', energy=0.9),
+            audio_features('testtrack1', energy=0.8),
+            audio_features('testtrack2', energy=0.1)
+        ])
+        db.session.commit()
+        self.track_ids = [Track.query.filter_by(spotify_track_id=f'testtrack{i}').one().id for i in range(4)]
+
+        self.original_path = catalog_snapshot.CATALOG_SNAPSHOT_PATH
+        catalog_snapshot.CATALOG_SNAPSHOT_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Rollback problems from failed tests and delete the snapshot files"""
+
+        db.session.rollback()
+        shutil.rmtree(catalog_snapshot.CATALOG_SNAPSHOT_PATH)
+        catalog_snapshot.CATALOG_SNAPSHOT_PATH = self.original_path
+        feature_matrix._matrix = None
+        feature_matrix.FROM_SNAPSHOT = False
+
+    def test_first_snapshot(self):
+        """Test the first run writes every track with features, one row group per release year"""
+
+        self.assertEqual(read_snapshot(), (None, None))
+        self.assertEqual(snapshot_catalog(), 3)
+
+        table, synced_at = read_snapshot()
+        rows = {row['id']: row for row in table.to_pylist()}
+
+        self.assertEqual(sorted(rows), sorted(self.track_ids[:3]))
+        self.assertEqual(rows[self.track_ids[0]]['artists'], ['testartistname'])
+        self.assertEqual(rows[self.track_ids[1]]['artists'], [])
+        self.assertEqual(rows[self.track_ids[2]]['album_name'], 'testalbumname')
+        self.assertIsNotNone(synced_at)
+
+        part = pq.ParquetFile(os.path.join(catalog_snapshot.CATALOG_SNAPSHOT_PATH, read_manifest()['parts'][0]))
+        years = [part.metadata.row_group(i).column(3).statistics for i in range(part.num_row_groups)]
+        self.assertEqual([(stats.min, stats.max) for stats in years], [(1985, 1985), (1990, 1990)])
+
+        table, synced_at = read_snapshot(['name'], filters=[('release_year', '=', 1985)])
+        self.assertEqual(table.column_names, ['id', 'name'])
+        self.assertEqual(table['name'].to_pylist(), ['testname1'])
+
+    def test_incremental_snapshot(self):
+        """Test later runs append only tracks whose features were saved since, and reads keep the newest row"""
+
+        snapshot_catalog()
+        self.assertEqual(snapshot_catalog(), 0)
+        self.assertEqual(len(read_manifest()['parts']), 1)
+
+        save_audio_features([audio_features('testtrack3', energy=0.85), audio_features('testtrack2', energy=0.95)])
+        db.session.commit()
+
+        self.assertEqual(snapshot_catalog(), 2)
+        self.assertEqual(len(read_manifest()['parts']), 2)
+
+        table, synced_at = read_snapshot(['energy'])
+        energy = dict(zip(table['id'].to_pylist(), table['energy'].to_pylist()))
+
+        self.assertEqual(len(table), 4)
+        self.assertEqual(energy[self.track_ids[2]], 0.95)
+        self.assertEqual(energy[self.track_ids[3]], 0.85)
+
+    def test_features_without_time(self):
+        """Test a track whose features were saved without features_updated_at is in the snapshot and the matrix built from it"""
+
+        # Features saved before the column was added, or by seed.py
+        db.session.execute(db.update(Track).where(Track.id == self.track_ids[3]).values(
+            **{name: 0.5 for name in SIMILARITY_FEATURES}, energy=0.85, tempo=120.0, loudness=-10.0, mode=1
+        ))
+        db.session.commit()
+
+        self.assertEqual(snapshot_catalog(), 4)
+        table, synced_at = read_snapshot(['features_updated_at'])
+        rows = dict(zip(table['id'].to_pylist(), table['features_updated_at'].to_pylist()))
+        self.assertIn(self.track_ids[3], rows)
+        self.assertIsNone(rows[self.track_ids[3]])
+
+        feature_matrix.FROM_SNAPSHOT = True
+        feature_matrix._matrix = None
+
+        self.assertEqual(len(feature_matrix.get_feature_matrix()), 4)
+        ids, distances = feature_matrix.similar_tracks(self.track_ids[0], k=1)
+        self.assertEqual(ids.tolist(), [self.track_ids[3]])
+
+    def test_feature_matrix_from_snapshot(self):
+        """Test the feature matrix built from the snapshot catches up with features saved since"""
+
+        snapshot_catalog()
+        save_audio_features([audio_features('testtrack3', energy=0.85)])
+        db.session.commit()
+
+        feature_matrix.FROM_SNAPSHOT = True
+        feature_matrix._matrix = None
+
+        self.assertEqual(len(feature_matrix.get_feature_matrix()), 4)
+        ids, distances = feature_matrix.similar_tracks(self.track_ids[0], k=2)
+        self.assertEqual(ids.tolist(), [self.track_ids[3], self.track_ids[1]])
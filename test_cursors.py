@@ -0,0 +1,124 @@
+"""Tests for opaque cursors and the list endpoints paged with them"""
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY, BASE_URL
+from models import db, User, Track, Playlist, PlaylistTrack
+from db_api_methods import get_playlist_track_ids, INDEX_GAP
+from cursors import encode_cursor, decode_cursor, encode_spotify_cursor, decode_spotify_cursor
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+app.config['SECRET_KEY'] = 'testsecretkey'
+
+
+class CursorTestCase(TestCase):
+    """Tests for encoding and decoding cursors"""
+
+    def test_round_trip(self):
+        """Test a cursor decodes to its position"""
+
+        self.assertEqual(decode_cursor('playlist_tracks', encode_cursor('playlist_tracks', [65536, 12])), [65536, 12])
+        self.assertIsNone(encode_cursor('playlist_tracks', None))
+        self.assertIsNone(decode_cursor('playlist_tracks', None))
+        self.assertIsNone(decode_cursor('playlist_tracks', ''))
+
+    def test_rejects_edited_and_other_list_cursors(self):
+        """Test a cursor that was edited or made for another list raises ValueError"""
+
+        cursor = encode_cursor('track_query', 100)
+
+        with self.assertRaises(ValueError):
+            decode_cursor('track_query', cursor[:-2] + ('aa' if cursor[-2:] != 'aa' else 'bb'))
+        with self.assertRaises(ValueError):
+            decode_cursor('my_playlists', cursor)
+        with self.assertRaises(ValueError):
+            decode_cursor('track_query', 'notacursor')
+
+    def test_spotify_cursor(self):
+        """Test a cursor wrapping Spotify's next url decodes to the url's query string arguments"""
+
+        cursor = encode_spotify_cursor('top_tracks', f'{BASE_URL}/me/top/tracks?offset=20&limit=20&time_range=short_term')
+
+        self.assertEqual(decode_spotify_cursor('top_tracks', cursor), {'offset': '20', 'limit': '20', 'time_range': 'short_term'})
+        self.assertNotIn('api.spotify.com', decode_cursor('top_tracks', cursor))
+        self.assertIsNone(encode_spotify_cursor('top_tracks', None))
+        self.assertEqual(decode_spotify_cursor('top_tracks', None), {})
+
+
+class PagedRoutesTestCase(TestCase):
+    """Tests for following cursors through local lists"""
+
+    def setUp(self):
+        """Add a user with playlists, one holding tracks with a tied index"""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        playlists = [Playlist(username='testuser', name=f'testplaylistname{i}') for i in range(5)]
+        db.session.add_all(playlists)
+        db.session.flush()
+
+        for i in range(9):
+            track = Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=1985, duration_ms=1000)
+            db.session.add(track)
+            db.session.flush()
+            # Tracks 3 and 4 share an index, the id breaks the tie
+            db.session.add(PlaylistTrack(playlist_id=playlists[0].id, track_id=track.id, index=(3 if i == 4 else i) * INDEX_GAP))
+
+        db.session.commit()
+        self.playlist_ids = [playlist.id for playlist in playlists]
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def follow(self, url, key):
+        """Return every item of a paged list and the number of pages read"""
+
+        items, cursor, pages = [], None, 0
+        while True:
+            res = self.client.get(url, query_string={'limit': 2, 'cursor': cursor})
+            self.assertEqual(res.status_code, 200)
+            data = res.get_json()
+            items.extend(data[key])
+            pages += 1
+            cursor = data['next']
+            if not cursor:
+                return items, pages
+
+    def test_playlist_track_pages(self):
+        """Test the pages of a playlist's tracks hold every track once, in playlist order"""
+
+        tracks, pages = self.follow(f'/api/playlists/{self.playlist_ids[0]}/tracks', 'tracks')
+
+        self.assertEqual(tracks, get_playlist_track_ids(self.playlist_ids[0]))
+        self.assertEqual(len(tracks), 9)
+        self.assertEqual(pages, 5)
+
+    def test_playlist_cursor_is_bound_to_its_playlist(self):
+        """Test a cursor of one playlist is refused by another"""
+
+        cursor = self.client.get(f'/api/playlists/{self.playlist_ids[0]}/tracks?limit=2').get_json()['next']
+        res = self.client.get(f'/api/playlists/{self.playlist_ids[1]}/tracks', query_string={'cursor': cursor})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_my_playlist_pages(self):
+        """Test the pages of the user's playlists hold every playlist once"""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = 'testuser'
+
+        playlists, pages = self.follow('/api/me/playlists', 'playlists')
+
+        self.assertEqual([playlist['id'] for playlist in playlists], self.playlist_ids)
+        self.assertEqual(pages, 3)
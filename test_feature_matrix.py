@@ -0,0 +1,141 @@
+"""Tests for the audio feature matrix and similar tracks"""
+
+from unittest import TestCase
+import numpy as np
+
+from app import app
+from models import db, Track
+import feature_matrix
+from feature_matrix import FeatureMatrix, SIMILARITY_FEATURES, normalize
+from spotify_query_parse import save_audio_features
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+
+def random_features(rng, count):
+    """Return count rows of raw features spread over their ranges"""
+
+    low = np.array([low for low, high in SIMILARITY_FEATURES.values()])
+    high = np.array([high for low, high in SIMILARITY_FEATURES.values()])
+    return low + rng.random((count, len(SIMILARITY_FEATURES))) * (high - low)
+
+
+def audio_features(spotify_track_id, **features):
+    """Return a Spotify audio features object"""
+
+    track = {name: 0.5 for name in SIMILARITY_FEATURES}
+    track.update({"id": spotify_track_id, "tempo": 120.0, "loudness": -10.0, "mode": 1, "key": 0, "time_signature": 4})
+    track.update(features)
+    return track
+
+
+class FeatureMatrixTestCase(TestCase):
+    """Tests for nearest neighbours in FeatureMatrix"""
+
+    def test_nearest_matches_brute_force(self):
+        """Test the vectorized search returns the same tracks as comparing every pair"""
+
+        rng = np.random.default_rng(0)
+        features = random_features(rng, 2000)
+        track_ids = rng.permutation(5000)[:2000] + 1
+
+        matrix = FeatureMatrix(capacity=16)
+        for i in range(0, 2000, 300):
+            matrix.upsert(track_ids[i:i + 300], features[i:i + 300])
+
+        vectors = normalize(features)
+        for row in (0, 999, 1999):
+            ids, distances = matrix.nearest(vectors[row], k=10, exclude=track_ids[row])
+
+            expected = np.sqrt(((vectors - vectors[row]) ** 2).sum(axis=1))
+            expected[row] = np.inf
+            order = np.argsort(expected, kind='stable')[:10]
+
+            self.assertEqual(ids.tolist(), track_ids[order].tolist())
+            np.testing.assert_allclose(distances, expected[order], atol=1e-5)
+
+    def test_upsert_replaces_features(self):
+        """Test saving features of a track again moves it rather than adding a row"""
+
+        matrix = FeatureMatrix()
+        matrix.upsert([1, 2, 3], [[0.0] * 10, [0.5] * 10, [1.0] * 10])
+        matrix.upsert([1], [[1.0] * 10])
+
+        self.assertEqual(len(matrix), 3)
+        ids, distances = matrix.nearest(matrix.vector(3), k=5, exclude=3)
+        self.assertEqual(ids.tolist(), [1, 2])
+        self.assertEqual(distances[0], 0)
+        self.assertIsNone(matrix.vector(4))
+
+
+class SimilarTracksTestCase(TestCase):
+    """Tests for the process matrix kept in sync with the tracks table"""
+
+    def setUp(self):
+        """Add tracks with and without audio features"""
+
+        db.drop_all()
+        db.create_all()
+
+        for i in range(4):
+            db.session.add(Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=1985, duration_ms=1000))
+        db.session.commit()
+
+        save_audio_features([
+            audio_features('testtrack0', energy=0.9),
+            audio_features('testtrack1', energy=0.8),
+            audio_features('testtrack2', energy=0.1)
+        ])
+        db.session.commit()
+
+        feature_matrix._matrix = None
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+        feature_matrix._matrix = None
+
+    def test_similar_route(self):
+        """Test similar tracks are closest first and tracks without features are left out"""
+
+        track = Track.query.filter_by(spotify_track_id='testtrack0').one()
+        res = self.client.get(f'/api/tracks/{track.id}/similar')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([t['name'] for t in data['tracks']], ['testname1', 'testname2'])
+        self.assertAlmostEqual(data['tracks'][0]['distance'], 0.1, places=4)
+
+        missing = Track.query.filter_by(spotify_track_id='testtrack3').one()
+        self.assertEqual(self.client.get(f'/api/tracks/{missing.id}/similar').status_code, 404)
+
+    def test_matrix_sync(self):
+        """Test features saved in this process are added at once, and others on refresh"""
+
+        matrix = feature_matrix.get_feature_matrix()
+        self.assertEqual(len(matrix), 3)
+
+        saved = save_audio_features([audio_features('testtrack3', energy=0.85)])
+        db.session.commit()
+        feature_matrix.add_track_features(saved)
+        self.assertEqual(len(matrix), 4)
+
+        # Features saved by another process
+        db.session.execute(db.update(Track).where(Track.spotify_track_id == 'testtrack2').values(
+            energy=0.9, features_updated_at=db.func.localtimestamp()
+        ))
+        db.session.commit()
+        feature_matrix._checked_at = 0
+        feature_matrix.get_feature_matrix()
+
+        track = Track.query.filter_by(spotify_track_id='testtrack0').one()
+        ids, distances = feature_matrix.similar_tracks(track.id, k=1)
+        self.assertEqual(ids.tolist(), [Track.query.filter_by(spotify_track_id='testtrack2').one().id])
@@ -0,0 +1,132 @@
+"""Tests for importing a user's saved Spotify tracks"""
+
+import time
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, LibraryImport
+import library_import
+from library_import import import_library
+import task_queue
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+app.config['SECRET_KEY'] = 'testsecretkey'
+
+# A library of 5 saved tracks, read 2 at a time
+LIBRARY = [{'id': f'testtrack{i}'} for i in range(5)]
+PAGE_SIZE = 2
+
+
+class LibraryImportTestCase(TestCase):
+    """Tests for the LibraryImport model, the import routes and resuming an import"""
+
+    def setUp(self):
+        """Add a signed in user, and replace queueing, Spotify pages and track saving with fakes"""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        db.session.commit()
+
+        self.enqueued = []
+        self.saved = []
+        # Offset of the page that raises, as if the token expired
+        self.fail_at = None
+
+        def spotify_pages(path, offset=0, headers=None):
+            for start in range(offset, len(LIBRARY), PAGE_SIZE):
+                if start == self.fail_at:
+                    raise ValueError('Token expired')
+                yield {'items': [{'track': track} for track in LIBRARY[start:start + PAGE_SIZE]], 'offset': start, 'total': len(LIBRARY)}
+
+        self.originals = task_queue.enqueue, library_import.spotify_pages, library_import.process_tracks, library_import.INGEST_BATCH_SIZE
+        task_queue.enqueue = lambda name, durable=True, **kwargs: self.enqueued.append((name, kwargs))
+        library_import.spotify_pages = spotify_pages
+        library_import.process_tracks = lambda tracks: self.saved.extend(track['id'] for track in tracks)
+        library_import.INGEST_BATCH_SIZE = PAGE_SIZE
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = 'testuser'
+            session['auth'] = {'access_token': 'testtoken'}
+
+    def tearDown(self):
+        """Rollback problems from failed tests and restore the replaced functions"""
+
+        db.session.rollback()
+        task_queue.enqueue, library_import.spotify_pages, library_import.process_tracks, library_import.INGEST_BATCH_SIZE = self.originals
+
+    def test_serialize(self):
+        """Test a library import's defaults and dictionary"""
+
+        db.session.add(LibraryImport(username='testuser', started_at=1.0, updated_at=2.0))
+        db.session.commit()
+
+        job = db.session.get(LibraryImport, 'testuser')
+
+        self.assertEqual(job.serialize(), {
+            'username': 'testuser', 'status': 'queued', 'offset': 0, 'total': None, 'error': None,
+            'started_at': 1.0, 'updated_at': 2.0, 'finished_at': None
+        })
+
+    def test_start_and_progress_routes(self):
+        """Test starting an import queues it once, and its progress can be read"""
+
+        res = self.client.get('/api/me/library/import')
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client.post('/api/me/library/import')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['import']['status'], 'queued')
+
+        # Started again while still queued: the same import is returned, not queued twice
+        res = self.client.post('/api/me/library/import')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.enqueued, [('import_library', {'username': 'testuser', 'headers': {'Authorization': 'Bearer testtoken'}})])
+
+        res = self.client.get('/api/me/library/import')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['import']['username'], 'testuser')
+
+    def test_resume_from_checkpoint(self):
+        """Test a failed import keeps its last checkpoint, and starting it again resumes from there"""
+
+        headers = {'Authorization': 'Bearer testtoken'}
+        library_import.start_library_import('testuser', headers)
+
+        self.fail_at = 4
+        with self.assertRaises(ValueError):
+            import_library('testuser', headers)
+
+        job = db.session.get(LibraryImport, 'testuser')
+        self.assertEqual((job.status, job.offset, job.total, job.error), ('failed', 4, 5, 'Token expired'))
+        self.assertEqual(self.saved, ['testtrack0', 'testtrack1', 'testtrack2', 'testtrack3'])
+
+        self.fail_at = None
+        job = library_import.start_library_import('testuser', headers)
+        self.assertEqual((job.status, job.offset), ('queued', 4))
+
+        import_library('testuser', headers)
+
+        job = db.session.get(LibraryImport, 'testuser')
+        self.assertEqual((job.status, job.offset), ('done', 5))
+        self.assertEqual(self.saved, [f'testtrack{i}' for i in range(5)])
+        self.assertEqual(len(self.enqueued), 2)
+
+    def test_restart_stale_import(self):
+        """Test an import that stopped making progress is queued again"""
+
+        stale = time.time() - library_import.IMPORT_STALE_AFTER - 1
+        db.session.add(LibraryImport(username='testuser', status='running', offset=2, started_at=stale, updated_at=stale))
+        db.session.commit()
+
+        job = library_import.start_library_import('testuser', {'Authorization': 'Bearer testtoken'})
+
+        self.assertEqual((job.status, job.offset), ('queued', 2))
+        self.assertEqual(len(self.enqueued), 1)
@@ -0,0 +1,151 @@
+"""Tests for mirroring Spotify playlists into local playlists"""
+
+from unittest import TestCase
+
+from app import app
+from models import db, User, Track, Album, Playlist
+from db_api_methods import get_playlist_tracks, append_playlist_tracks
+import playlist_mirror
+from playlist_mirror import mirror_spotify_playlists, mirror_playlist_items
+import task_queue
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+HEADERS = {'Authorization': 'Bearer testtoken'}
+
+
+def spotify_playlist(snapshot_id, name='testplaylistname'):
+    """Return a Spotify playlist object as listed by /me/playlists"""
+
+    return {
+        'id': 'testspotifyplaylist', 'name': name, 'description': 'testdescription', 'public': True,
+        'collaborative': False, 'images': [], 'snapshot_id': snapshot_id
+    }
+
+
+def track_item(i):
+    """Return a Spotify playlist item of a saved track"""
+
+    return {'track': {'id': f'testtrack{i}', 'type': 'track', 'uri': f'spotify:track:testtrack{i}'}}
+
+
+class PlaylistMirrorTestCase(TestCase):
+    """Tests for listing Spotify playlists and refetching their items"""
+
+    def setUp(self):
+        """Add a user and tracks, and replace queueing, Spotify items and track saving with fakes"""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        album = Album(spotify_album_id='testalbum', name='testalbumname', image='http://www.testimage.com')
+        db.session.add(album)
+        db.session.flush()
+        db.session.add_all([Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+            release_year=1985, duration_ms=1000, album_id=album.id) for i in range(3)])
+        db.session.commit()
+
+        self.enqueued = []
+        self.items = [track_item(0), track_item(1)]
+
+        def process_tracks(tracks):
+            ids = dict(db.session.query(Track.spotify_track_id, Track.id).filter(Track.spotify_track_id.in_([track['id'] for track in tracks])))
+            return [{'id': ids[track['id']]} for track in tracks]
+
+        self.originals = task_queue.enqueue, playlist_mirror.spotify_paginate, playlist_mirror.process_tracks
+        task_queue.enqueue = lambda name, durable=True, **kwargs: self.enqueued.append(kwargs)
+        playlist_mirror.spotify_paginate = lambda url, limit=None, headers=None: iter(self.items)
+        playlist_mirror.process_tracks = process_tracks
+
+    def tearDown(self):
+        """Rollback problems from failed tests and restore the replaced functions"""
+
+        db.session.rollback()
+        playlist_mirror._mirroring.clear()
+        task_queue.enqueue, playlist_mirror.spotify_paginate, playlist_mirror.process_tracks = self.originals
+
+    def mirror(self, playlist):
+        """Mirror a listing of one playlist, then run the refetches it queued. Return the local playlist"""
+
+        local_ids = mirror_spotify_playlists('testuser', [playlist], HEADERS)
+        for kwargs in self.enqueued:
+            mirror_playlist_items(**kwargs)
+
+        return db.session.get(Playlist, local_ids['testspotifyplaylist'])
+
+    def test_new_playlist(self):
+        """Test a new Spotify playlist is saved once, and its tracks fetched once"""
+
+        local_ids = mirror_spotify_playlists('testuser', [spotify_playlist('snap1')], HEADERS)
+        # Listed again before the refetch ran
+        self.assertEqual(mirror_spotify_playlists('testuser', [spotify_playlist('snap1')], HEADERS), local_ids)
+
+        self.assertEqual(Playlist.query.count(), 1)
+        self.assertEqual(len(self.enqueued), 1)
+
+        mirror_playlist_items(**self.enqueued[0])
+        playlist = db.session.get(Playlist, local_ids['testspotifyplaylist'])
+
+        self.assertEqual(playlist.spotify_snapshot_id, 'snap1')
+        self.assertEqual(get_playlist_tracks(playlist.id), ['spotify:track:testtrack0', 'spotify:track:testtrack1'])
+        self.assertEqual(playlist.spotify_synced_uris, ['spotify:track:testtrack0', 'spotify:track:testtrack1'])
+        self.assertFalse(playlist.spotify_items_skipped)
+
+    def test_unchanged_snapshot(self):
+        """Test a playlist with the same snapshot_id has its details updated but its tracks not refetched"""
+
+        self.mirror(spotify_playlist('snap1'))
+        self.enqueued.clear()
+
+        playlist = self.mirror(spotify_playlist('snap1', name='renamedplaylist'))
+
+        self.assertEqual(self.enqueued, [])
+        self.assertEqual(playlist.name, 'renamedplaylist')
+
+    def test_changed_snapshot_with_local_edits(self):
+        """Test a playlist changed on Spotify is refetched, unless it was edited locally since"""
+
+        playlist = self.mirror(spotify_playlist('snap1'))
+        self.enqueued.clear()
+
+        self.items = [track_item(1)]
+        playlist = self.mirror(spotify_playlist('snap2'))
+        self.assertEqual(len(self.enqueued), 1)
+        self.assertEqual(get_playlist_tracks(playlist.id), ['spotify:track:testtrack1'])
+        self.enqueued.clear()
+
+        append_playlist_tracks(playlist.id, [Track.query.filter_by(spotify_track_id='testtrack2').one().id])
+        self.items = [track_item(0)]
+        playlist = self.mirror(spotify_playlist('snap3'))
+
+        self.assertEqual(self.enqueued, [])
+        self.assertEqual(playlist.spotify_snapshot_id, 'snap2')
+        self.assertEqual(get_playlist_tracks(playlist.id), ['spotify:track:testtrack1', 'spotify:track:testtrack2'])
+
+    def test_local_files(self):
+        """Test a playlist holding local files and episodes keeps its tracks as the base, and is still refetched"""
+
+        self.items = [
+            track_item(0),
+            {'track': {'id': None, 'type': 'track', 'uri': 'spotify:local:artist:album:song:100'}},
+            {'track': {'id': 'testepisode', 'type': 'episode', 'uri': 'spotify:episode:testepisode'}},
+            track_item(1)
+        ]
+        playlist = self.mirror(spotify_playlist('snap1'))
+
+        self.assertEqual(playlist.spotify_synced_uris, ['spotify:track:testtrack0', 'spotify:track:testtrack1'])
+        self.assertTrue(playlist.spotify_items_skipped)
+        self.enqueued.clear()
+
+        self.items = [track_item(2)]
+        playlist = self.mirror(spotify_playlist('snap2'))
+
+        self.assertEqual(len(self.enqueued), 1)
+        self.assertEqual(get_playlist_tracks(playlist.id), ['spotify:track:testtrack2'])
+        self.assertFalse(playlist.spotify_items_skipped)
@@ -4,8 +4,10 @@ from unittest import TestCase
 
 from app import app
 from models import db, User, Track, Album, Playlist, PlaylistTrack
+from db_api_methods import get_playlist_tracks, get_playlist_track_ids, insert_playlist_track, move_playlist_track, delete_playlist_track
 from flask import Flask, session
-from sqlalchemy import exc
+from sqlalchemy import exc, text
+from sqlalchemy.dialects import postgresql
 
 # Use test database
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
@@ -266,4 +268,67 @@ class PlaylistModelTestCase(TestCase):
         user = test_playlist.user
 
         self.assertEqual(user.username, TEST_USER['username'])
- 
\ No newline at end of file
+ 
+
+    def test_get_playlist_tracks(self):
+        """Test playlist track uris are returned in index order"""
+
+        self.assertEqual(get_playlist_tracks(self.test_playlist_id), [TEST_TRACK_1['spotify_track_uri'], TEST_TRACK_2['spotify_track_uri']])
+
+    def test_get_playlist_track_ids(self):
+        """Test playlist spotify track ids are returned in index order"""
+
+        playlist_track = PlaylistTrack.query.get(self.test_playlist_track_1_id)
+        playlist_track.index = 3
+        db.session.commit()
+
+        self.assertEqual(get_playlist_track_ids(self.test_playlist_id), [TEST_TRACK_2['spotify_track_id'], TEST_TRACK_1['spotify_track_id']])
+
+    def test_playlist_queries_use_index(self):
+        """Test playlist queries are planned with the (playlist_id, index) index"""
+
+        queries = [
+            # get_playlist_tracks, get_playlist_track_ids
+            db.session.query(Track.spotify_track_uri).join(PlaylistTrack, PlaylistTrack.track_id==Track.id).filter(PlaylistTrack.playlist_id==self.test_playlist_id).order_by(PlaylistTrack.index),
+            # append_playlist_tracks
+            PlaylistTrack.query.filter(PlaylistTrack.playlist_id==self.test_playlist_id).order_by(PlaylistTrack.index.desc()).limit(1),
+            # insert_playlist_track, move_playlist_track, delete_playlist_track
+            PlaylistTrack.query.filter(PlaylistTrack.playlist_id==self.test_playlist_id, PlaylistTrack.index >= 1).order_by(PlaylistTrack.index),
+            PlaylistTrack.query.filter(PlaylistTrack.playlist_id==self.test_playlist_id, PlaylistTrack.index==1)
+        ]
+
+        # The test tables are tiny: stop the planner preferring a sequential scan
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+
+        for query in queries:
+            sql = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+            plan = '\n'.join(db.session.execute(text(f'EXPLAIN {sql}')).scalars())
+
+            self.assertIn('ix_playlists_tracks_playlist_id_index', plan)
+
+    def test_move_playlist_track(self):
+        """Test moving a track writes only the moved row"""
+
+        move_playlist_track(self.test_playlist_id, 1, 0)
+        playlist_track = PlaylistTrack.query.get(self.test_playlist_track_1_id)
+
+        self.assertEqual(get_playlist_track_ids(self.test_playlist_id), [TEST_TRACK_2['spotify_track_id'], TEST_TRACK_1['spotify_track_id']])
+        self.assertEqual(playlist_track.index, TEST_PLAYLIST_TRACK_1['index'])
+
+    def test_insert_playlist_track(self):
+        """Test inserting a track between adjacent keys rebalances the playlist"""
+
+        insert_playlist_track(self.test_playlist_id, self.track_2_id, 1)
+
+        self.assertEqual(get_playlist_track_ids(self.test_playlist_id), [TEST_TRACK_1['spotify_track_id'], TEST_TRACK_2['spotify_track_id'], TEST_TRACK_2['spotify_track_id']])
+
+        insert_playlist_track(self.test_playlist_id, self.track_1_id, 3)
+
+        self.assertEqual(get_playlist_track_ids(self.test_playlist_id)[3], TEST_TRACK_1['spotify_track_id'])
+
+    def test_delete_playlist_track(self):
+        """Test deleting a track from a playlist"""
+
+        delete_playlist_track(self.test_playlist_id, self.track_1_id)
+
+        self.assertEqual(get_playlist_track_ids(self.test_playlist_id), [TEST_TRACK_2['spotify_track_id']])
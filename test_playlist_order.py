@@ -0,0 +1,115 @@
+"""Tests for ordering playlists by key and tempo"""
+
+from unittest import TestCase
+import numpy as np
+
+from app import app
+from models import db, User, Track, Playlist, PlaylistTrack
+from db_api_methods import get_playlist_track_ids, INDEX_GAP
+from playlist_order import camelot_code, transition_costs, order_tracks, path_cost
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+# Spotify keys of C, G, D ... going clockwise round the Camelot wheel
+FIFTHS = [(7 * i) % 12 for i in range(12)]
+
+
+class TransitionCostTestCase(TestCase):
+    """Tests for transition costs and ordering without the db"""
+
+    def test_camelot_code(self):
+        """Test Spotify keys and modes map to the Camelot wheel"""
+
+        self.assertEqual(camelot_code(0, 1), '8B')
+        self.assertEqual(camelot_code(9, 0), '8A')
+        self.assertEqual(camelot_code(7, 1), '9B')
+        self.assertEqual(camelot_code(5, 0), '4A')
+        self.assertIsNone(camelot_code(-1, 1))
+        self.assertIsNone(camelot_code(None, None))
+
+    def test_transition_costs(self):
+        """Test compatible keys cost one step and half or double tempo costs nothing"""
+
+        # C major, G major, A minor, F-sharp major, C major at double tempo, unknown key
+        costs = transition_costs([0, 7, 9, 6, 0, None], [1, 1, 0, 1, 1, None], [120, 120, 120, 120, 240, 120])
+
+        self.assertEqual(costs[0, 1], 1)
+        self.assertEqual(costs[0, 2], 1)
+        self.assertEqual(costs[0, 3], 6)
+        self.assertEqual(costs[0, 4], 0)
+        self.assertEqual(costs[0, 5], 2)
+        np.testing.assert_array_equal(costs, costs.T)
+
+    def test_order_tracks(self):
+        """Test a shuffled walk round the wheel is put back in wheel order"""
+
+        rng = np.random.default_rng(0)
+        shuffled = rng.permutation(12)
+        keys = [FIFTHS[i] for i in shuffled]
+        costs = transition_costs(keys, [1] * 12, [120] * 12)
+
+        order = order_tracks(costs)
+
+        self.assertEqual(sorted(order), list(range(12)))
+        self.assertEqual(path_cost(costs, order), 11)
+
+
+class OrderPlaylistTestCase(TestCase):
+    """Tests for the playlist order route"""
+
+    def setUp(self):
+        """Add a playlist of tracks in a random order"""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        playlist = Playlist(username='testuser', name='testplaylistname')
+        db.session.add(playlist)
+        db.session.flush()
+
+        rng = np.random.default_rng(1)
+        for position, i in enumerate(rng.permutation(12)):
+            track = Track(spotify_track_id=f'testtrack{i}', name=f'testname{i}', spotify_track_uri=f'spotify:track:testtrack{i}',
+                release_year=1985, duration_ms=1000, key=FIFTHS[i], mode=1, tempo=120.0)
+            db.session.add(track)
+            db.session.flush()
+            db.session.add(PlaylistTrack(playlist_id=playlist.id, track_id=track.id, index=position))
+
+        db.session.commit()
+        self.playlist_id = playlist.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def test_order_playlist_route(self):
+        """Test the playlist is saved in the returned order, one wheel step apart"""
+
+        res = self.client.post(f'/api/playlists/{self.playlist_id}/tracks/order')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        spotify_track_ids = [db.session.get(Track, track['id']).spotify_track_id for track in data['tracks']]
+        self.assertEqual(spotify_track_ids, get_playlist_track_ids(self.playlist_id))
+
+        numbers = [int(track['key'][:-1]) for track in data['tracks']]
+        steps = [min(abs(a - b), 12 - abs(a - b)) for a, b in zip(numbers, numbers[1:])]
+        self.assertEqual(steps, [1] * 11)
+
+        indexes = [row.index for row in PlaylistTrack.query.filter_by(playlist_id=self.playlist_id).order_by(PlaylistTrack.index)]
+        self.assertEqual(indexes, [i * INDEX_GAP for i in range(12)])
+
+    def test_order_missing_playlist(self):
+        """Test ordering a playlist that doesn't exist fails"""
+
+        res = self.client.post('/api/playlists/999/tracks/order')
+
+        self.assertEqual(res.status_code, 404)
@@ -0,0 +1,99 @@
+"""Tests for planning diff syncs of playlists to Spotify"""
+
+import random
+from unittest import TestCase
+
+from app import app
+from playlist_sync import plan_playlist_sync, apply_operation, replace_cost
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+
+def uris(n, prefix='track'):
+    """Return n distinct test uris"""
+
+    return [f'spotify:track:{prefix}{i}' for i in range(n)]
+
+
+def apply_plan(old_uris, plan):
+    """Return the uris left on Spotify after applying plan to old_uris"""
+
+    for op in plan:
+        old_uris = apply_operation(old_uris, op)
+
+    return old_uris
+
+
+class PlaylistSyncTestCase(TestCase):
+    """Tests for plan_playlist_sync"""
+
+    def test_no_changes(self):
+        """Test an unchanged playlist needs no requests"""
+
+        self.assertEqual(plan_playlist_sync(uris(500), uris(500)), [])
+
+    def test_move_one_track(self):
+        """Test moving a track is one reorder request, whatever the playlist size"""
+
+        old = uris(1000)
+        new = old[:10] + [old[900]] + old[10:900] + old[901:]
+        plan = plan_playlist_sync(old, new)
+
+        self.assertEqual(plan, [('reorder', 900, 10, 1)])
+        self.assertEqual(apply_plan(old, plan), new)
+
+    def test_add_and_remove(self):
+        """Test adds are inserted at their positions and removed tracks deleted"""
+
+        old = uris(300)
+        new = uris(2, 'new') + old[:100] + old[101:250] + uris(3, 'other') + old[250:]
+        plan = plan_playlist_sync(old, new)
+
+        self.assertEqual([op[0] for op in plan], ['remove', 'add', 'add'])
+        self.assertEqual(apply_plan(old, plan), new)
+
+    def test_duplicate_tracks(self):
+        """Test removing one copy of a repeated track keeps the others"""
+
+        old = uris(300) + uris(1)
+        new = uris(300)
+        plan = plan_playlist_sync(old, new)
+
+        self.assertEqual(apply_plan(old, plan), new)
+
+    def test_random_edits(self):
+        """Test random edits always plan the exact new playlist"""
+
+        rng = random.Random(7)
+        for n in range(50):
+            old = [f'spotify:track:track{rng.randrange(300)}' for i in range(100 + rng.randrange(300))]
+            new = list(old)
+            for edit in range(rng.randrange(6)):
+                if new and rng.random() < 0.5:
+                    new.insert(rng.randrange(len(new)), new.pop(rng.randrange(len(new))))
+                else:
+                    new.insert(rng.randrange(len(new) + 1), f'spotify:track:track{rng.randrange(400)}')
+            plan = plan_playlist_sync(old, new)
+
+            if plan is not None:
+                self.assertLessEqual(len(plan), replace_cost(new))
+                self.assertEqual(apply_plan(old, plan), new)
+
+    def test_resume_partial_upload(self):
+        """Test a sync that failed after some chunks only sends the remaining chunks"""
+
+        new = uris(10000)
+        plan = plan_playlist_sync(new[:4000], new)
+
+        self.assertEqual(len(plan), 60)
+        self.assertEqual(apply_plan(new[:4000], plan), new)
+
+    def test_shuffle_replaces(self):
+        """Test a shuffled playlist is replaced when that takes fewer requests"""
+
+        old = uris(200)
+        new = list(old)
+        random.Random(1).shuffle(new)
+
+        self.assertIsNone(plan_playlist_sync(old, new))
@@ -0,0 +1,157 @@
+"""Tests for the shared Spotify rate limiter"""
+
+import time
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, RateLimit
+import rate_limit
+import spotify_client
+from spotify_client import RateLimited
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+TEST_BUCKET = 'testbucket'
+
+
+class FakeResponse():
+    """Stand-in for a Spotify response with a status code and headers only"""
+
+    def __init__(self, headers, status_code=429):
+        self.headers = headers
+        self.status_code = status_code
+
+
+class RateLimitTestCase(TestCase):
+    """Tests for the token bucket rate limiter"""
+
+    def setUp(self):
+        """Start every test without buckets"""
+
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def test_acquire_creates_bucket(self):
+        """Test first acquire creates a full bucket and takes one token"""
+
+        wait = rate_limit.acquire(TEST_BUCKET)
+        bucket = db.session.get(RateLimit, TEST_BUCKET)
+
+        self.assertEqual(wait, 0)
+        self.assertAlmostEqual(bucket.tokens, rate_limit.BURST - 1, places=0)
+
+    def test_acquire_waits_when_empty(self):
+        """Test acquire waits for a token once the burst is used up"""
+
+        rate_limit.acquire(TEST_BUCKET)
+        db.session.query(RateLimit).filter(RateLimit.name==TEST_BUCKET).update({"tokens": 0, "updated_at": time.time()})
+        db.session.commit()
+
+        wait = rate_limit.acquire(TEST_BUCKET)
+
+        self.assertGreater(wait, 0)
+        self.assertLess(wait, 2 / rate_limit.RATE)
+
+    def test_block(self):
+        """Test block pauses the bucket until the Retry-After time"""
+
+        rate_limit.acquire(TEST_BUCKET)
+        rate_limit.block(30, TEST_BUCKET)
+        bucket = db.session.get(RateLimit, TEST_BUCKET)
+
+        self.assertGreater(bucket.blocked_until, time.time() + 25)
+
+    def test_acquire_gives_up_past_max_wait(self):
+        """Test acquire raises RateLimited without waiting, and gives its token back, when the bucket is blocked too long"""
+
+        rate_limit.acquire(TEST_BUCKET)
+        rate_limit.block(60, TEST_BUCKET)
+        tokens = db.session.get(RateLimit, TEST_BUCKET).tokens
+        db.session.rollback()
+
+        start = time.time()
+        with self.assertRaises(rate_limit.RateLimited) as raised:
+            rate_limit.acquire(TEST_BUCKET, max_wait=1)
+
+        self.assertLess(time.time() - start, 1)
+        self.assertGreater(raised.exception.retry_after, 55)
+        self.assertAlmostEqual(db.session.get(RateLimit, TEST_BUCKET).tokens, tokens, places=0)
+
+    def test_retry_after(self):
+        """Test Retry-After header is used, else exponential backoff"""
+
+        self.assertEqual(rate_limit.retry_after(FakeResponse({'Retry-After': '7'}), 0), 7)
+        self.assertEqual(rate_limit.retry_after(FakeResponse({}), 3), 8)
+
+
+class RateLimitedTestCase(TestCase):
+    """Tests for giving up once Spotify keeps answering 429"""
+
+    def setUp(self):
+        """Answer every Spotify request with a 429 and don't wait between retries"""
+
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+        db.session.commit()
+
+        self.sent = []
+        self.retry_after = '1'
+        self.originals = spotify_client._send, rate_limit.acquire, rate_limit.block
+        spotify_client._send = lambda verb, url, headers, data, params: self.sent.append(url) or FakeResponse({'Retry-After': self.retry_after})
+        rate_limit.acquire = lambda name=rate_limit.SPOTIFY_BUCKET, max_wait=None: 0
+        rate_limit.block = lambda seconds, name=rate_limit.SPOTIFY_BUCKET: None
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Restore the client and rate limiter"""
+
+        db.session.rollback()
+        spotify_client._send, rate_limit.acquire, rate_limit.block = self.originals
+
+    def test_request_raises_after_retries(self):
+        """Test the last 429 raises RateLimited with the Retry-After period"""
+
+        with app.app_context():
+            with self.assertRaises(RateLimited) as raised:
+                spotify_client.get(spotify_client.API_URL + 'v1/me/tracks')
+
+        self.assertEqual(raised.exception.retry_after, 1)
+        self.assertEqual(len(self.sent), spotify_client.MAX_RETRIES + 1)
+
+    def test_request_gives_up_on_long_retry_after(self):
+        """Test a Retry-After longer than a request may wait raises at once rather than blocking the worker"""
+
+        self.retry_after = str(rate_limit.MAX_WAIT + 55)
+
+        with app.app_context():
+            with self.assertRaises(RateLimited) as raised:
+                spotify_client.get(spotify_client.API_URL + 'v1/me/tracks')
+
+        self.assertEqual(raised.exception.retry_after, rate_limit.MAX_WAIT + 55)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_route_answers_429(self):
+        """Test a route calling Spotify answers a JSON 429 rather than failing on the 429 body"""
+
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = 'testuser'
+            session['auth'] = {'access_token': 'testtoken'}
+
+        self.retry_after = '7'
+        res = self.client.get('/api/me/top/tracks?time_range=short_term')
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '7')
+        self.assertFalse(res.get_json()['success'])
@@ -0,0 +1,117 @@
+"""Tests for the background task queue"""
+
+import time
+from unittest import TestCase
+
+from app import app
+from models import db, User, TaskJob
+import task_queue
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+# Arguments of every run of the test tasks
+runs = []
+
+
+@task_queue.task('test_record')
+def record(value):
+    """Test task: remember its argument"""
+
+    runs.append(value)
+
+
+@task_queue.task('test_fail')
+def fail(value):
+    """Test task: write to the db, then fail"""
+
+    runs.append(value)
+    db.session.add(User(username='taskuser', password='testpassword', email='taskemail@test.com'))
+    db.session.flush()
+    raise ValueError(f'Task failed with {value}')
+
+
+class TaskQueueTestCase(TestCase):
+    """Tests for running tasks inline, on worker threads, and recovering durable tasks"""
+
+    def setUp(self):
+        """Start every test with no task jobs or runs"""
+
+        db.drop_all()
+        db.create_all()
+        runs.clear()
+
+        self.workers, self.durable = task_queue.WORKERS, task_queue.DURABLE
+
+    def tearDown(self):
+        """Rollback problems from failed tests and restore the queue settings"""
+
+        db.session.rollback()
+        task_queue.WORKERS, task_queue.DURABLE = self.workers, self.durable
+
+    def test_inline(self):
+        """Test an inline task runs before enqueue returns, and a failing one keeps the caller's writes"""
+
+        task_queue.WORKERS = 0
+
+        with app.app_context():
+            task_queue.enqueue('test_record', value=1)
+            self.assertEqual(runs, [1])
+
+            db.session.add(User(username='testuser', password='testpassword', email='testemail@test.com'))
+            db.session.flush()
+            task_queue.enqueue('test_fail', value=2)
+            db.session.commit()
+
+            self.assertEqual(runs, [1, 2])
+            self.assertEqual([user.username for user in User.query.all()], ['testuser'])
+
+    def test_workers(self):
+        """Test durable tasks run on worker threads and save their result, with the traceback of a failure"""
+
+        task_queue.DURABLE = True
+
+        with app.app_context():
+            task_queue.enqueue('test_record', value=1)
+            task_queue.enqueue('test_fail', value=2)
+            task_queue.enqueue('test_record', durable=False, value=3)
+            task_queue._queue.join()
+
+            jobs = TaskJob.query.order_by(TaskJob.id).all()
+
+            self.assertEqual(sorted(runs), [1, 2, 3])
+            self.assertEqual([job.status for job in jobs], ['done', 'failed'])
+            self.assertIn('Task failed with 2', jobs[1].error)
+            self.assertIsNone(db.session.get(User, 'taskuser'))
+
+    def test_recover(self):
+        """Test a starting worker runs durable tasks left queued or without a recent heartbeat"""
+
+        task_queue.DURABLE = True
+        now = time.time()
+        stale = now - task_queue.STALE_AFTER - 1
+
+        with app.app_context():
+            db.session.add_all([
+                TaskJob(name='test_record', payload={'value': 1}, status='queued', created_at=now),
+                # Long running task whose worker is still alive
+                TaskJob(name='test_record', payload={'value': 2}, status='running', created_at=stale, started_at=stale, heartbeat_at=now),
+                TaskJob(name='test_record', payload={'value': 3}, status='running', created_at=stale, started_at=stale, heartbeat_at=stale),
+                TaskJob(name='test_record', payload={'value': 4}, status='done', created_at=stale, started_at=stale, finished_at=stale)
+            ])
+            db.session.commit()
+
+            # As if this process just started
+            task_queue._workers_pid = None
+            task_queue._start_workers()
+            task_queue._queue.join()
+
+            db.session.expire_all()
+            jobs = TaskJob.query.order_by(TaskJob.id).all()
+
+            self.assertEqual(sorted(runs), [1, 3])
+            self.assertEqual([job.status for job in jobs], ['done', 'running', 'done', 'done'])
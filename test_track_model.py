@@ -237,4 +237,20 @@ class TrackModelTestCase(TestCase):
 
         test_track = Track.query.get(self.track_id)
 
-        self.assertEqual(test_track.lyrics, TEST_TRACK_1['lyrics'])
\ No newline at end of file
+        self.assertEqual(test_track.lyrics, TEST_TRACK_1['lyrics'])
+
+    def test_duplicate_spotify_track_id(self):
+        """Test spotify_track_id is unique"""
+
+        duplicate_track = Track(
+            spotify_track_id=TEST_TRACK_1['spotify_track_id'],
+            name=TEST_TRACK_1['name'],
+            spotify_track_uri=TEST_TRACK_1['spotify_track_uri'],
+            release_year=TEST_TRACK_1['release_year'],
+            duration_ms=TEST_TRACK_1['duration_ms'],
+            album_id=self.album_id
+        )
+        db.session.add(duplicate_track)
+
+        with self.assertRaises(exc.IntegrityError) as context:
+            db.session.commit()
@@ -0,0 +1,133 @@
+"""Tests for feature range queries over the local catalog"""
+
+from unittest import TestCase
+
+from app import app
+from models import db
+from track_query import compile_track_query, query_tracks
+
+# Use test database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///spotiflavor_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+app.config['SECRET_KEY'] = 'testsecretkey'
+
+# Random tracks, repeatable with setseed
+SEED_TRACKS = """
+    SELECT setseed(0.5);
+    INSERT INTO tracks (spotify_track_id, name, spotify_track_uri, release_year, duration_ms, popularity,
+        acousticness, danceability, energy, instrumentalness, liveness, loudness, speechiness, valence,
+        tempo, mode, key, time_signature)
+    SELECT 'testtrack' || i, 'testname' || i, 'spotify:track:testtrack' || i, 1960 + floor(random() * 64), 1000,
+        floor(random() * 100), random(), random(), random(), random(), random(), -60 * random(), random(), random(),
+        60 + 140 * random(), floor(random() * 2), floor(random() * 12), 4
+    FROM generate_series(1, 20000) AS i;
+    ANALYZE tracks;
+"""
+
+
+class TrackQueryTestCase(TestCase):
+    """Tests for compiling feature filters and their query plans"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Add random tracks once: the tests only read them"""
+
+        db.drop_all()
+        db.create_all()
+        db.session.execute(db.text(SEED_TRACKS))
+        db.session.commit()
+
+    def setUp(self):
+        """Create the test client"""
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+
+    def explain(self, args, limit=20, after=None):
+        """Return the query plan of a track query as one string"""
+
+        stmt = compile_track_query(args, limit, after)
+        sql = str(stmt.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        return '\n'.join(db.session.execute(db.text('EXPLAIN ' + sql)).scalars())
+
+    def test_filters(self):
+        """Test every track returned matches the filters, in id order"""
+
+        args = {"danceability_min": "0.7", "tempo_min": "120", "tempo_max": "128", "mode": "major", "release_year_min": "2016"}
+        tracks, next_after = query_tracks(args, limit=100)
+
+        self.assertTrue(tracks)
+        for track in tracks:
+            self.assertGreaterEqual(track['danceability'], 0.7)
+            self.assertTrue(120 <= track['tempo'] <= 128)
+            self.assertEqual(track['mode'], 1)
+            self.assertGreaterEqual(track['release_year'], 2016)
+        self.assertEqual([track['id'] for track in tracks], sorted(track['id'] for track in tracks))
+
+    def test_keyset_pages(self):
+        """Test following after reads every match once"""
+
+        args = {"tempo_min": "100", "tempo_max": "110"}
+        expected = [track['id'] for track in query_tracks(args, limit=100)[0]]
+
+        ids, after = [], None
+        while True:
+            tracks, after = query_tracks(args, limit=7, after=after)
+            ids.extend(track['id'] for track in tracks)
+            if after is None or len(ids) >= len(expected):
+                break
+
+        self.assertEqual(ids[:len(expected)], expected)
+
+    def test_selective_ranges_use_bitmap_indexes(self):
+        """Test narrow ranges combine feature indexes rather than scanning the table"""
+
+        plan = self.explain({"tempo_min": "120", "tempo_max": "121", "release_year_min": "2022", "danceability_min": "0.95"})
+
+        self.assertIn('Bitmap Index Scan on ix_tracks_tempo', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_integer_filters_keep_index(self):
+        """Test integer columns are compared to integers, not cast to numeric"""
+
+        plan = self.explain({"release_year_min": "2023", "tempo_min": "120", "tempo_max": "122"})
+
+        self.assertNotIn('numeric', plan)
+        self.assertIn('Index Cond: (release_year >= 2023)', plan)
+
+    def test_next_page_seeks_primary_key(self):
+        """Test the next page of a broad query starts from after in the primary key"""
+
+        plan = self.explain({"energy_min": "0.1"}, after=10000)
+
+        self.assertIn('tracks_pkey', plan)
+        self.assertIn('id > 10000', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_query_route(self):
+        """Test the route returns a page with the cursor of the next page, and rejects unknown filters"""
+
+        res = self.client.get('/api/tracks/query?energy_min=0.5&limit=5')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['tracks']), 5)
+
+        res = self.client.get('/api/tracks/query', query_string={'energy_min': '0.5', 'limit': 5, 'cursor': data['next']})
+        next_data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([track['id'] for track in data['tracks'] + next_data['tracks']],
+            [track['id'] for track in query_tracks({'energy_min': '0.5'}, limit=10)[0]])
+
+        res = self.client.get('/api/tracks/query?loudness_min=loud')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get('/api/tracks/query?colour=blue').status_code, 400)
+        self.assertEqual(self.client.get('/api/tracks/query?cursor=notacursor').status_code, 400)
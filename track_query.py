@@ -0,0 +1,88 @@
+"""Query the local catalog by ranges of audio features
+
+Filters are query string arguments: <feature>_min and <feature>_max for the range features, and
+exact values for key, mode and time_signature, e.g.
+    /api/tracks/query?danceability_min=0.7&tempo_min=120&tempo_max=128&mode=major&release_year_min=2016
+Every range feature has a B-tree index, so Postgres can combine the indexes of several ranges in a
+bitmap scan. Pages are in track id order: after is the last id of the previous page, sent to
+clients in an opaque cursor
+"""
+
+from sqlalchemy import select
+from models import db, Track, TRACK_RANGE_FEATURES
+
+# Features filtered by exact value: too few values for an index to pay off
+EXACT_FEATURES = ['key', 'mode', 'time_signature']
+
+MODES = {'minor': 0, 'major': 1}
+
+QUERY_MAX_LIMIT = 100
+
+
+def parse_value(name, value, type_):
+    """Return a filter's value as type_, raise ValueError naming the filter if it isn't one"""
+
+    try:
+        return type_(value)
+    except ValueError:
+        raise ValueError(f"Invalid value for {name}: {value}")
+
+
+def parse_filters(args):
+    """
+    Return a list of SQLAlchemy conditions for the filters of a dict of query string arguments
+    Raise ValueError for an unknown filter or a value that isn't a number
+    """
+
+    conditions = []
+
+    for name, value in args.items():
+        if name in ('limit', 'cursor'):
+            continue
+
+        feature, bound = name.rsplit('_', 1) if name.endswith(('_min', '_max')) else (name, None)
+
+        if bound and feature in TRACK_RANGE_FEATURES:
+            column = getattr(Track, feature)
+            # A value of the column's own type keeps its index usable
+            value = parse_value(name, value, column.type.python_type)
+            conditions.append(column >= value if bound == 'min' else column <= value)
+
+        elif not bound and feature in EXACT_FEATURES:
+            value = MODES[value] if feature == 'mode' and value in MODES else parse_value(name, value, int)
+            conditions.append(getattr(Track, feature) == value)
+
+        else:
+            raise ValueError(f"Unknown filter {name}")
+
+    return conditions
+
+
+def compile_track_query(args, limit=20, after=None):
+    """Return the SELECT statement of a page of tracks matching query string arguments, with one extra row"""
+
+    stmt = select(
+        Track.id, Track.name, Track.spotify_track_id, Track.release_year, Track.popularity,
+        *[getattr(Track, feature) for feature in TRACK_RANGE_FEATURES[:-2] + EXACT_FEATURES]
+    ).where(*parse_filters(args))
+
+    if after is not None:
+        stmt = stmt.where(Track.id > after)
+
+    # The extra row tells if there is a next page
+    return stmt.order_by(Track.id).limit(limit + 1)
+
+
+def query_tracks(args, limit=20, after=None):
+    """
+    Return (a page of track dicts matching query string arguments, the after of the next page)
+    The next page's after is None on the last page
+    """
+
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
+    rows = db.session.execute(compile_track_query(args, limit, after)).all()
+
+    tracks = [row._asdict() for row in rows[:limit]]
+    next_after = rows[limit - 1].id if len(rows) > limit else None
+
+    return tracks, next_after